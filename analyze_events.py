@@ -0,0 +1,209 @@
+"""
+ライフサイクルイベントログ（app.py の log_event が書く events.log*）の集計。
+
+    python analyze_events.py                      # ./events.log と ローテーション済み events.log.1 …
+    python analyze_events.py logs/events.log* --json
+    python analyze_events.py events.log --idle-hours 12
+
+- 照会ファネル（照会 → 店舗送信 → 店舗OK → 候補表示 → 予約申請 → 確定 / 締切で0件）
+- 受付ファネル（時間選択 → 照会確認 → 照会 → 予約確認 → 確定）
+- 店舗ごとの返信時間の p50 / p90 / p99 と OK率
+
+ログは1行ずつ読み、照会・セッションごとの途中状態は最後のイベントから --idle-hours 経ったら
+集計に畳んで捨てる（同時に抱えるのは「進行中」の分だけ）。返信時間は対数バケットの
+ヒストグラムで持つので、件数が何百万でもメモリは店舗数に比例するだけ（誤差は約5%）。
+"""
+import argparse, glob, gzip, json, math, os, sys
+from collections import OrderedDict
+
+REQ_STAGES = ["inquiry", "store_push", "store_ok", "candidate_shown", "book_draft", "confirmed"]
+USER_STAGES = ["ask_time", "ask_confirm", "inquiry", "book_confirm_shown", "confirmed"]
+MAX_OPEN = 200_000          # 進行中として抱える照会・セッションの上限（超えたら古い順に畳む）
+HIST_BASE = 1.05            # 返信時間ヒストグラムのバケット幅（比）
+
+
+# ====== 入力 ======
+def log_files(paths):
+    """指定が無ければ events.log*。ローテーション済み（.N が大きいほど古い）を古い順に並べる"""
+    files = []
+    for p in paths or ["events.log*"]:
+        files.extend(glob.glob(p) or [p])
+
+    def age(path):
+        suffix = path.rsplit(".log", 1)[-1].lstrip(".").removesuffix(".gz")
+        return -int(suffix) if suffix.isdigit() else 0
+
+    return sorted(set(files), key=lambda p: (os.path.dirname(p), os.path.basename(p).split(".log")[0], age(p)))
+
+
+def iter_events(files):
+    for path in files:
+        opener = gzip.open if path.endswith(".gz") else open
+        try:
+            with opener(path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except FileNotFoundError:
+            print(f"[ANALYZE] not found: {path}", file=sys.stderr)
+
+
+# ====== 返信時間（対数バケット） ======
+class LatencyHist:
+    __slots__ = ("buckets", "n")
+
+    def __init__(self):
+        self.buckets = {}
+        self.n = 0
+
+    def add(self, sec):
+        b = int(math.log(max(sec, 0.1)) / math.log(HIST_BASE))
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+        self.n += 1
+
+    def quantile(self, q):
+        if not self.n:
+            return None
+        rank = q * self.n
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= rank:
+                return round(HIST_BASE ** (b + 0.5), 1)
+        return None
+
+
+# ====== 集計 ======
+class Funnel:
+    """キー（照会ID・ユーザー）ごとに到達段階を持ち、止まったら counts へ畳む"""
+
+    def __init__(self, stages, idle_sec):
+        self.stages = stages
+        self.bit = {s: 1 << i for i, s in enumerate(stages)}
+        self.idle_sec = idle_sec
+        self.open = OrderedDict()   # key -> [last_t, mask, extra flags]
+        self.counts = [0] * len(stages)
+        self.flags = {}
+
+    def mark(self, key, stage, t, flag=None):
+        st = self.open.pop(key, None) or [t, 0, set()]
+        st[0] = t
+        if stage in self.bit:
+            st[1] |= self.bit[stage]
+        if flag:
+            st[2].add(flag)
+        self.open[key] = st   # 末尾 = 最近
+        self.expire(t)
+
+    def restart(self, key, t):
+        """同じユーザーが新しく受付を始めたら、前のセッションを畳む"""
+        st = self.open.pop(key, None)
+        if st:
+            self._fold(st)
+
+    def expire(self, now):
+        while self.open:
+            key, st = next(iter(self.open.items()))
+            if len(self.open) <= MAX_OPEN and now - st[0] < self.idle_sec:
+                break
+            self.open.popitem(last=False)
+            self._fold(st)
+
+    def close(self):
+        while self.open:
+            self._fold(self.open.popitem(last=False)[1])
+
+    def _fold(self, st):
+        for i, s in enumerate(self.stages):
+            if st[1] & self.bit[s]:
+                self.counts[i] += 1
+        for f in st[2]:
+            self.flags[f] = self.flags.get(f, 0) + 1
+
+    def report(self):
+        top = self.counts[0] or 1
+        return {
+            "stages": [{"stage": s, "count": c, "rate": round(c / top, 3)} for s, c in zip(self.stages, self.counts)],
+            "flags": self.flags,
+        }
+
+
+def analyze(events, idle_hours=6.0):
+    idle = idle_hours * 3600
+    reqs = Funnel(REQ_STAGES, idle)
+    users = Funnel(USER_STAGES, idle)
+    stores = {}   # store_id -> {"lat": LatencyHist, "ok", "no", "late", "push", "push_ng"}
+    n = 0
+    for e in events:
+        n += 1
+        ev, t, req, u = e.get("ev"), e.get("t", 0), e.get("req"), e.get("u")
+        sid = e.get("store")
+        if sid and ev in ("store_push", "store_reply"):
+            st = stores.setdefault(sid, {"lat": LatencyHist(), "ok": 0, "no": 0, "late": 0, "push": 0, "push_ng": 0})
+            if ev == "store_push":
+                st["push" if e.get("ok", True) else "push_ng"] += 1
+            else:
+                st["ok" if e.get("status") == "ok" else "no"] += 1
+                if e.get("late"):
+                    st["late"] += 1
+                if e.get("lat") is not None:
+                    st["lat"].add(float(e["lat"]))
+
+        if req:
+            stage = "store_ok" if ev == "store_reply" and e.get("status") == "ok" else ev
+            flag = "timeout" if ev == "timeout" else ("cancel" if ev == "cancel" else None)
+            reqs.mark(req, stage, t, flag)
+        if u:
+            if ev == "ask_time":
+                users.restart(u, t)
+            flag = {"cancel": "cancel", "inquiry_reused": "reused", "inquiry_throttled": "throttled"}.get(ev)
+            users.mark(u, ev, t, flag)
+    reqs.close()
+    users.close()
+
+    per_store = {}
+    for sid, st in sorted(stores.items()):
+        replies = st["ok"] + st["no"]
+        per_store[sid] = {
+            "pushed": st["push"], "push_failed": st["push_ng"],
+            "replies": replies, "ok_rate": round(st["ok"] / replies, 3) if replies else None,
+            "late_replies": st["late"],
+            "p50_sec": st["lat"].quantile(0.5), "p90_sec": st["lat"].quantile(0.9), "p99_sec": st["lat"].quantile(0.99),
+        }
+    return {"events": n, "inquiry_funnel": reqs.report(), "session_funnel": users.report(), "stores": per_store}
+
+
+def print_report(r):
+    print(f"events: {r['events']}")
+    for title, key in (("inquiry funnel", "inquiry_funnel"), ("session funnel", "session_funnel")):
+        print(f"\n== {title}")
+        for row in r[key]["stages"]:
+            print(f"  {row['stage']:<20} {row['count']:>8}  {row['rate'] * 100:6.1f}%")
+        for f, c in sorted(r[key]["flags"].items()):
+            print(f"  ({f}) {c}")
+    print("\n== store reply time (sec)")
+    print(f"  {'store':<10} {'pushed':>7} {'replies':>8} {'ok%':>6} {'p50':>7} {'p90':>7} {'p99':>7}")
+    for sid, s in r["stores"].items():
+        ok = f"{s['ok_rate'] * 100:.0f}" if s["ok_rate"] is not None else "-"
+        q = [f"{v:.0f}" if v is not None else "-" for v in (s["p50_sec"], s["p90_sec"], s["p99_sec"])]
+        print(f"  {sid:<10} {s['pushed']:>7} {s['replies']:>8} {ok:>6} {q[0]:>7} {q[1]:>7} {q[2]:>7}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="events.log のファネルと店舗返信時間の集計")
+    ap.add_argument("paths", nargs="*", help="ログファイル（glob 可、.gz 可）。省略時は events.log*")
+    ap.add_argument("--idle-hours", type=float, default=6.0, help="この時間動きの無い照会・セッションは終わったとみなす")
+    ap.add_argument("--json", action="store_true", help="JSON で出力")
+    args = ap.parse_args(argv)
+
+    result = analyze(iter_events(log_files(args.paths)), idle_hours=args.idle_hours)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
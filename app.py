@@ -1,33 +1,163 @@
-import os, json, re, math, datetime
+import os, sys, json, re, math, datetime, bisect, time
+import importlib
+
+# ====== 起動時間の計測（重いモジュールの import 時間を記録、/readyz で確認） ======
+# 先に import_module で読み込んで時間を測る。下の from-import は sys.modules から取るだけなので速い
+_BOOT_T0 = time.perf_counter()
+IMPORT_TIMES = {}
+for _mod in ("flask", "requests", "linebot"):
+    _t = time.perf_counter()
+    importlib.import_module(_mod)
+    IMPORT_TIMES[_mod] = round((time.perf_counter() - _t) * 1000, 1)
+
 from datetime import timedelta, timezone
-from flask import Flask, request, abort
+from flask import Flask, request, abort, Response, stream_with_context
 import csv, io, requests
 import threading
+import hashlib
+import cProfile, pstats, marshal, random, collections
+import heapq
+import contextlib
+import logging, logging.handlers
+import contextvars
+import sqlite3
 import unicodedata
 
+import catalog
+import geo
+
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, PostbackEvent,
     QuickReply, QuickReplyButton, PostbackAction,
-    FlexSendMessage, BubbleContainer, BoxComponent, TextComponent, ButtonComponent,
+    FlexSendMessage, BubbleContainer, CarouselContainer, BoxComponent, TextComponent, ButtonComponent,
     URIAction
 )
 
+# ====== テナント（tenants.py で複数チャネルを1プロセスに載せるとき） ======
+# tenants.py はテナントごとにこのファイルを別モジュールとして読み込み、実行前に
+#   TENANT（名前）・TENANT_CONFIG（環境変数の上書き）・SHARED（共有の HTTP セッション）
+# を差し込む。店舗・セッション・照会などのグローバルは、そのモジュールの中だけの状態になる。
+# 単独で動かすとき（gunicorn app:app）はどれも空で、従来どおり環境変数だけを見る。
+TENANT = globals().get("TENANT", "")
+TENANT_CONFIG = globals().get("TENANT_CONFIG", {})
+SHARED = globals().get("SHARED", {})
+
+
+def _env(name, default=None):
+    v = TENANT_CONFIG.get(name)
+    return str(v) if v is not None else os.getenv(name, default)
+
+
 # ====== 基本設定 ======
 JST = timezone(timedelta(hours=9))
-LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
-LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+LINE_CHANNEL_ACCESS_TOKEN = _env("LINE_CHANNEL_ACCESS_TOKEN")
+LINE_CHANNEL_SECRET = _env("LINE_CHANNEL_SECRET")
 if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     raise RuntimeError("LINE env missing")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# 受付時間（JST・時）。受付開始〜受付終了の間だけ予約を受け、予約枠は枠の開始〜終了（30分刻み）
+SERVICE_OPEN_HOUR = int(_env("SERVICE_OPEN_HOUR", "16"))
+SERVICE_CLOSE_HOUR = int(_env("SERVICE_CLOSE_HOUR", "22"))
+SLOT_FIRST_HOUR = int(_env("SLOT_FIRST_HOUR", "18"))
+SLOT_LAST_HOUR = int(_env("SLOT_LAST_HOUR", "22"))
+
+# LINE API への接続は keep-alive のセッションで使い回す（テナント間でも1つのプールを共有）
+LINE_HTTP_POOL = int(_env("LINE_HTTP_POOL", "20"))
+
+
+def new_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=LINE_HTTP_POOL)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+if "http_session" not in SHARED:
+    SHARED["http_session"] = new_http_session()
+
+
+class _PooledHttpClient(RequestsHttpClient):
+    """RequestsHttpClient と同じだが、リクエストごとに接続を張らずセッションを使う"""
+    session = SHARED["http_session"]
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return RequestsHttpResponse(self.session.get(
+            url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout))
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return RequestsHttpResponse(self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout))
+
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=_PooledHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 app = Flask(__name__)
 
+IMPORT_TIMES["total"] = round((time.perf_counter() - _BOOT_T0) * 1000, 1)
+IMPORT_BUDGET_MS = float(_env("IMPORT_BUDGET_MS", "800"))
+print(f"[BOOT] import times(ms)={IMPORT_TIMES} budget={IMPORT_BUDGET_MS:.0f}")
+if IMPORT_TIMES["total"] > IMPORT_BUDGET_MS:
+    print(f"[BOOT] import time over budget: {IMPORT_TIMES['total']}ms > {IMPORT_BUDGET_MS:.0f}ms")
+
+# ====== 店舗レコード ======
+STORE_FIELDS = ("store_id", "name", "profile", "map_url", "pickup_ok", "pickup_point",
+                "instagram_url", "line_user_id", "open_slots", "open_slots_date", "lat", "lon")
+
+
+class Store:
+    """店舗1件（読み取り専用・__slots__）。従来の dict と同じく s["name"] / s.get("name") で読める"""
+    __slots__ = STORE_FIELDS
+
+    def __init__(self, store_id="", name="", profile="", map_url="", pickup_ok=False, pickup_point="",
+                 instagram_url="", line_user_id="", open_slots="", open_slots_date="", lat=None, lon=None):
+        _set = object.__setattr__
+        _set(self, "store_id", store_id)
+        _set(self, "name", name)
+        _set(self, "profile", profile)
+        _set(self, "map_url", map_url)
+        _set(self, "pickup_ok", bool(pickup_ok))
+        _set(self, "pickup_point", pickup_point)
+        _set(self, "instagram_url", instagram_url)
+        _set(self, "line_user_id", line_user_id)
+        _set(self, "open_slots", open_slots)
+        _set(self, "open_slots_date", open_slots_date)
+        _set(self, "lat", lat)   # 位置（任意）。無い店は距離で絞り込まない
+        _set(self, "lon", lon)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Store is read-only")
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in STORE_FIELDS
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in STORE_FIELDS else default
+
+    def as_dict(self) -> dict:
+        return {k: getattr(self, k) for k in STORE_FIELDS}
+
+    def __repr__(self):
+        return f"Store({self.store_id!r}, {self.name!r})"
+
+
 # ====== ストア（仮） ======
 # line_user_id は各店舗のLINEユーザーID（個別トークできるID）を入れてください
-STORES = [
+STORES = [Store(**d) for d in [
     {
         "store_id": "ST1",
         "name": "島料理 A",
@@ -48,13 +178,14 @@ STORES = [
         "instagram_url": "",            # ★追加
         "line_user_id": "UYYYYYYYYYYYYYYY"
     },
-]
+]]
 
 STORE_BY_ID = {s["store_id"]: s for s in STORES}
+STORE_BY_UID = {s["line_user_id"]: s for s in STORES}  # 店舗LINE ID → 店舗（店舗からの操作判定用）
 
 # ====== ストア情報：スプレッドシート連携 ======
-STORES_SHEET_CSV_URL = os.getenv("STORES_SHEET_CSV_URL")
-STORES_RELOAD_TOKEN = os.getenv("STORES_RELOAD_TOKEN", "")
+STORES_SHEET_CSV_URL = _env("STORES_SHEET_CSV_URL")
+STORES_RELOAD_TOKEN = _env("STORES_RELOAD_TOKEN", "")
 
 # 置換：pickup_ok を robust に解釈する
 def _parse_bool(v):
@@ -68,66 +199,122 @@ def _parse_bool(v):
     # 不明は False 扱い（必要ならログに出す）
     return False
 
-def _load_stores_from_csv(url: str):
-    resp = requests.get(url, timeout=10)
-    resp.raise_for_status()
-    f = io.StringIO(resp.text)
-    reader = csv.DictReader(f)
-    stores = []
+def _parse_sheet_date(v: str) -> str:
+    """'2026-10-19' / '2026/10/19' → '2026-10-19'（読めなければ空文字）"""
+    s = unicodedata.normalize("NFKC", v or "").strip().replace("/", "-")
+    try:
+        return datetime.date.fromisoformat(s).isoformat()
+    except ValueError:
+        return ""
+
+
+# シート読込の検証結果（/admin/stores_preview で確認）。問題は最初の STORES_REPORT_MAX 件まで残す
+STORES_REPORT = {"loaded": 0, "rejected": 0, "warnings": 0, "issues": []}
+STORES_REPORT_MAX = 200
+_PICKUP_WORDS = {"1","true","t","yes","y","on","ok","〇","○","可","はい","有","可能",
+                 "0","false","f","no","n","off","ng","×","✕","✖","不可","いいえ","無",""}
+
+
+def parse_store_rows(lines):
+    """CSV の行（イテレータ）を1行ずつ Store にする → (stores, report)。
+    多くの店で同じ値になる列（集合場所・空き枠の日付）は sys.intern で1つの文字列を共有する
+    （店ごとに違う ID などは intern すると表の分だけかえって増えるのでそのまま）"""
+    intern = sys.intern
+    stores, seen_ids, seen_uids = [], set(), set()
+    report = {"loaded": 0, "rejected": 0, "warnings": 0, "issues": []}
+
+    def issue(kind, row_no, sid, reason):
+        report["rejected" if kind == "rejected" else "warnings"] += 1
+        if len(report["issues"]) < STORES_REPORT_MAX:
+            report["issues"].append({"row": row_no, "store_id": sid, "kind": kind, "reason": reason})
+
+    reader = csv.reader(lines)
+    header = [h.strip() for h in next(reader, [])]
+    width = len(header)
+    col = {h: i for i, h in enumerate(header)}
+    # 無い列は行末に足す空欄（width 番目）を読む
+    (c_sid, c_name, c_profile, c_map, c_pickup, c_point, c_ig, c_uid, c_slots, c_slots_date, c_lat, c_lon) = (
+        col.get(k, width) for k in STORE_FIELDS)
+    blank = [""] * (width + 1)
+
     for row in reader:
-        sid         = (row.get("store_id") or "").strip()
-        name        = (row.get("name") or "").strip()
-        profile     = (row.get("profile") or "").strip()
-        map_url     = (row.get("map_url") or "").strip()
-        pickup_ok   = _parse_bool(row.get("pickup_ok"))
-        # ★ここでInstagram列を読む（無ければ空文字）
-        instagram_url = (row.get("instagram_url") or "").strip()
-        # （すでに運用しているなら pickup_point もここで読む想定）
-        pickup_point  = (row.get("pickup_point") or "").strip()
-        line_user_id  = (row.get("line_user_id") or "").strip()
+        row_no = reader.line_num
+        if len(row) <= width:
+            row.extend(blank[len(row):])
+        sid, name, line_user_id = row[c_sid].strip(), row[c_name].strip(), row[c_uid].strip()
 
         # 必須: store_id, name, line_user_id
         if not sid or not name or not line_user_id:
+            if any(row):
+                missing = [k for k, v in (("store_id", sid), ("name", name), ("line_user_id", line_user_id)) if not v]
+                issue("rejected", row_no, sid, "missing " + ", ".join(missing))
+            continue
+        if sid in seen_ids:
+            issue("rejected", row_no, sid, "duplicate store_id")
             continue
+        if line_user_id in seen_uids:
+            issue("warning", row_no, sid, "line_user_id shared with another store")
+
+        pickup_raw = row[c_pickup].strip()
+        if pickup_raw.lower() not in _PICKUP_WORDS:
+            issue("warning", row_no, sid, f"pickup_ok not understood: {pickup_raw[:20]} (treated as no)")
+        # 空き枠（任意）例: "19:00-20:30/6; 21:00-22:00/4"。open_slots_date の日だけ有効
+        open_slots = row[c_slots].strip()
+        open_slots_date = _parse_sheet_date(row[c_slots_date]) if row[c_slots_date] else ""
+        if open_slots and not open_slots_date:
+            issue("warning", row_no, sid, "open_slots ignored (open_slots_date missing or invalid)")
+        # 位置（任意）: 緯度・経度の両方が読めたときだけ使う
+        lat, lon = geo.parse_coord(row[c_lat]), geo.parse_coord(row[c_lon])
+        if (row[c_lat].strip() or row[c_lon].strip()) and not geo.valid_coord(lat, lon):
+            issue("warning", row_no, sid, "lat/lon ignored (both needed, decimal degrees)")
+            lat = lon = None
+
+        seen_ids.add(sid)
+        seen_uids.add(line_user_id)
+        stores.append(Store(
+            sid, name, row[c_profile].strip(), row[c_map].strip(), _parse_bool(pickup_raw),
+            intern(row[c_point].strip()), row[c_ig].strip(), line_user_id,
+            open_slots, intern(open_slots_date), lat, lon,
+        ))
+    report["loaded"] = len(stores)
+    return stores, report
 
-        # デバッグログ（任意）
-        try:
-            print(f"[STORES] load: sid={sid} name={name} pickup_ok_raw={row.get('pickup_ok')} -> {pickup_ok} ig={instagram_url[:40]}")
-        except Exception:
-            pass
 
-        stores.append({
-            "store_id": sid,
-            "name": name,
-            "profile": profile,
-            "map_url": map_url,
-            "pickup_ok": pickup_ok,
-            "pickup_point": pickup_point,       # 既に使っている場合は残す
-            "instagram_url": instagram_url,     # ★追加
-            "line_user_id": line_user_id
-        })
-    return stores
+def _load_csv_url(url: str, parse):
+    """シートの CSV を受信しながら1行ずつ parse に渡す（全文をメモリに載せない）"""
+    with requests.get(url, timeout=10, stream=True) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True  # gzip 転送でも展開しながら読む
+        resp.raw.auto_close = False     # 読み終わりの判定は TextIOWrapper に任せる
+        text = io.TextIOWrapper(resp.raw, encoding="utf-8-sig", newline="")
+        return parse(text)
+
+
+def _load_stores_from_csv(url: str):
+    return _load_csv_url(url, parse_store_rows)
 
 
 def refresh_stores():
     """環境変数のCSV URLがあれば、STORES/STORE_BY_IDを上書き"""
-    global STORES, STORE_BY_ID
+    global STORES, STORE_BY_ID, STORE_BY_UID, STORES_REPORT
     if not STORES_SHEET_CSV_URL:
         print("[STORES] STORES_SHEET_CSV_URL not set; using in-code STORES")
         return
     try:
-        new_stores = _load_stores_from_csv(STORES_SHEET_CSV_URL)
+        new_stores, STORES_REPORT = _load_stores_from_csv(STORES_SHEET_CSV_URL)
+        print(f"[STORES] sheet rows: loaded={STORES_REPORT['loaded']} "
+              f"rejected={STORES_REPORT['rejected']} warnings={STORES_REPORT['warnings']}")
         if new_stores:
             STORES = new_stores
             STORE_BY_ID = {s["store_id"]: s for s in STORES}
+            STORE_BY_UID = {s["line_user_id"]: s for s in STORES}
             print(f"[STORES] Loaded {len(STORES)} stores from sheet")
         else:
             print("[STORES] Sheet had no valid rows; keeping previous list")
     except Exception as e:
         print("[STORES] Failed to load sheet:", e)
 
-# 起動時に一度ロード（環境変数があればシートで上書き）
-refresh_stores()
+# 起動時のロード（環境変数があればシートで上書き）は、末尾のウォームアップで行う
 
 # 手動リロード用（token一致時のみ）
 @app.route("/admin/reload_stores")
@@ -141,7 +328,7 @@ def admin_reload_stores():
 # 簡易プレビュー（任意）
 @app.route("/admin/stores_preview")
 def admin_stores_preview():
-    return {"count": len(STORES), "stores": STORES[:5]}
+    return {"count": len(STORES), "stores": [s.as_dict() for s in STORES[:5]], "report": STORES_REPORT}
 
 # 追加ここから（/admin/stores_preview の直後）
 @app.route("/admin/test_push")
@@ -153,6 +340,8 @@ def admin_test_push():
     txt = request.args.get("text","TEST: store push ok?")
     if not uid:
         return "uid missing", 400
+    if not admit(PRIO_LOW):
+        return "busy", 503, {"Retry-After": str(int(ADMIT_RETRY_SEC))}
     ok = safe_push(uid, TextSendMessage(txt), "TEST")
     return "sent" if ok else "failed"
 
@@ -161,34 +350,152 @@ def admin_test_push_all():
     token = request.args.get("token","")
     if token != STORES_RELOAD_TOKEN:
         return abort(403)
-    sent = 0
-    for s in STORES:
+    sent = skipped = 0
+    for i, s in enumerate(STORES):
+        if not admit(PRIO_LOW):  # 途中で混んできたら残りは送らない
+            if not i:
+                return "busy", 503, {"Retry-After": str(int(ADMIT_RETRY_SEC))}
+            return f"sent {sent}/{len(STORES)} (stopped: busy)"
+        if delivery_skip(s["line_user_id"]):  # 隔離中の店は /admin/delivery で確認
+            skipped += 1
+            continue
         if safe_push(s["line_user_id"], TextSendMessage(f"TEST to {s['name']}"), s["name"]):
             sent += 1
-    return f"sent {sent}/{len(STORES)}"
+    return f"sent {sent}/{len(STORES)}" + (f" (quarantined {skipped})" if skipped else "")
 # 追加ここまで
 
 
 
 # ====== 簡易セッション／リクエスト保持（メモリ） ======
-SESS = {}       # user_id -> {lang,time_iso,pax,pickup,hotel, req_id}
-REQUESTS = {}   # req_id -> {user_id, deadline, wanted_iso, pax, pickup, hotel, candidates:set, closed:bool}
+SESS = {}       # user_id -> {lang,time_iso,alt_times,pax,pickup,hotel,pickup_point, req_id}
+REQUESTS = {}   # req_id -> {user_id, deadline, wanted_iso, slots, slot_by_store, pax, pickup, hotel, pickup_point, candidates:set, closed:bool}
 PENDING_BOOK = {}  # user_id -> {"req_id","store_id","step", "name"}
 
+# ====== 時計（テスト・シミュレーションでは仮想時計に差し替える） ======
+# 現在時刻・タイマー（段階送信の窓・候補のまとめ送り）・ジョブのポーリングはすべて CLOCK を通す。
+# use_clock(VirtualClock(開始時刻)) にすると、時刻は advance() / advance_to() で進めたときだけ進み、
+# その途中で期限の来たタイマーとジョブ（締切・リマインド・ダイジェスト）を時刻順にその場で実行する。
+# 受付時間帯・10分締切・15分前リマインドを実時間を待たずに確かめられる（simulate.py で一晩分を数秒）。
+class SystemClock:
+    virtual = False
+
+    def now(self):
+        return datetime.datetime.now(JST)
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def call_later(self, delay: float, fn, *args):
+        t = threading.Timer(delay, fn, args=args)
+        t.start()
+        return t
+
+
+class VirtualClock:
+    """手で進める時計。タイマーとジョブは advance を呼んだスレッドで実行する"""
+    virtual = True
+
+    def __init__(self, start: datetime.datetime, poll_sec: float | None = None):
+        self._now = start.astimezone(JST)
+        self._timers = []   # (due, seq, fn, args) のヒープ
+        self._seq = 0
+        self._lock = threading.Lock()
+        self.poll_sec = poll_sec or JOBS_POLL_SEC
+        self._next_poll = self._now
+        self.fired = {"timers": 0, "polls": 0}
+
+    def now(self):
+        return self._now
+
+    def time(self) -> float:
+        return self._now.timestamp()
+
+    def monotonic(self) -> float:
+        return self._now.timestamp()
+
+    def call_later(self, delay: float, fn, *args):
+        with self._lock:
+            self._seq += 1
+            heapq.heappush(self._timers, (self._now + timedelta(seconds=max(0.0, delay)), self._seq, fn, args))
+
+    def pending_timers(self) -> int:
+        with self._lock:
+            return len(self._timers)
+
+    def _poll_at(self):
+        """次にジョブを回す時刻（ポーリング間隔の刻みのまま、取れるジョブが無い間の空振りは飛ばす）"""
+        due = next_job_due()
+        if due is None:
+            return None
+        t = self._next_poll
+        if due > t.timestamp():
+            t += timedelta(seconds=math.ceil((due - t.timestamp()) / self.poll_sec) * self.poll_sec)
+        return t
+
+    def advance_to(self, until: datetime.datetime):
+        """until まで進める。同時刻ならタイマーを先に、ジョブのポーリングはその後"""
+        while True:
+            poll = self._poll_at()
+            with self._lock:
+                timer = None
+                if self._timers and self._timers[0][0] <= until and (poll is None or self._timers[0][0] <= poll):
+                    timer = heapq.heappop(self._timers)
+            if timer:
+                self._now = max(self._now, timer[0])
+                self.fired["timers"] += 1
+                try:
+                    timer[2](*timer[3])
+                except Exception as e:
+                    print(f"[CLOCK] timer {getattr(timer[2], '__name__', timer[2])} failed:", e)
+                continue
+            if poll is None or poll > until:
+                break
+            self._now = max(self._now, poll)
+            self._next_poll = poll + timedelta(seconds=self.poll_sec)
+            self.fired["polls"] += 1
+            try:
+                run_due_jobs()
+            except Exception as e:
+                print("[CLOCK] job poll failed:", e)
+        self._now = max(self._now, until)
+        if self._next_poll <= until:
+            ticks = math.floor((until - self._next_poll).total_seconds() / self.poll_sec) + 1
+            self._next_poll += timedelta(seconds=ticks * self.poll_sec)
+
+    def advance(self, seconds: float):
+        self.advance_to(self._now + timedelta(seconds=seconds))
+
+
+CLOCK = SystemClock()
+
+
+def use_clock(clock):
+    """時計を差し替えて前の時計を返す（送信枠は時刻の基準が変わるので満タンに戻す）"""
+    global CLOCK
+    prev, CLOCK = CLOCK, clock
+    _REMINDER_BUCKET[:] = [float(REMINDER_BURST), clock.monotonic()]
+    with _INQUIRY_LOCK:
+        INQUIRY_BUCKETS.clear()
+    return prev
+
+
 # ====== ユーティリティ ======
 def now_jst():
-    return datetime.datetime.now(JST)
+    return CLOCK.now()
 
 def next_half_hour_slots(count: int = 6, must_be_after: datetime.datetime | None = None):
     """
-    18:00〜22:00 の間で 30分刻みの候補を返す。
+    SLOT_FIRST_HOUR〜SLOT_LAST_HOUR（既定 18:00〜22:00）の間で 30分刻みの候補を返す。
     かつ 'must_be_after'（例: 現在+45分）以降を最低条件にする。
     """
     now = now_jst()
 
     # きょうの 18:00 と 22:00（JST）
-    start_of_window = now.replace(hour=18, minute=0, second=0, microsecond=0)
-    end_of_window   = now.replace(hour=22, minute=0, second=0, microsecond=0)
+    start_of_window = now.replace(hour=SLOT_FIRST_HOUR, minute=0, second=0, microsecond=0)
+    end_of_window   = now.replace(hour=SLOT_LAST_HOUR, minute=0, second=0, microsecond=0)
 
     # “今+45分”などの条件と、18:00 を比較して遅い方から開始
     min_start = must_be_after or (now + timedelta(minutes=45))
@@ -208,48 +515,373 @@ def next_half_hour_slots(count: int = 6, must_be_after: datetime.datetime | None
     return slots
 
 
+# 希望時間は第1〜第 MAX_SLOTS 希望まで。1回の照会でまとめて店に聞き、店は入れる時間を1つ選んで返す
+# （満席で「別の時間で再照会」→ もう一度全店へ一斉送信、の往復を減らす）。
+MAX_SLOTS = int(_env("INQUIRY_MAX_SLOTS", "3"))
+
+
+def wanted_slots(r) -> list:
+    """希望時間の ISO 文字列（希望順）。r は SESS でも REQUESTS でもよい"""
+    if "slots" in r:
+        return list(r["slots"])
+    first = r.get("time_iso") or r.get("wanted_iso")
+    return ([first] if first else []) + list(r.get("alt_times") or [])
+
+
+def store_slot_iso(req, store_id) -> str:
+    """その店で入れる時間（店の回答・空き枠で決まった時間。無ければ第1希望）"""
+    return req.get("slot_by_store", {}).get(store_id) or req["wanted_iso"]
+
+
+def slot_rank(req, store_id) -> int:
+    slots = wanted_slots(req)
+    iso = store_slot_iso(req, store_id)
+    return slots.index(iso) if iso in slots else len(slots)
+
+
+def slots_label(slots, sep=" / ") -> str:
+    return sep.join(datetime.datetime.fromisoformat(iso).astimezone(JST).strftime("%H:%M") for iso in slots)
+
+
 def qreply(items):
     return QuickReply(items=[QuickReplyButton(action=a) for a in items])
 
-def lang_text(lang, jp, en):
-    return jp if lang == "jp" else en
-
 def bi(jp: str, en: str) -> str:
     """日本語 + 英語を1通にまとめる（改行区切り）"""
     return f"{jp}\n{en}"
 
 
-def make_req_id():
-    return "REQ-" + now_jst().strftime("%Y%m%d-%H%M%S")
+# ====== 文面（catalog.py） ======
+# お客さま・店舗向けの文面は catalog.py に言語別に置き、ここからキーで引く。
+# LOCALES は言語選択メニューに出す言語（catalog にある言語なら、ここに足すだけで選べるようになる）
+LOCALES = [c for c in _env("LOCALES", "jp,en").split(",") if c in catalog.CATALOG]
 
-# --- reply→失敗時はpushへフォールバック ---
-def reply_or_push(user_id, reply_token, *messages):
-    msg = list(messages)
-    if len(msg) == 1:
-        msg = msg[0]
+
+tr = catalog.render  # tr(key, lang, **values) -> str
+
+
+def tr_bi(key, lang=None, **values) -> str:
+    """言語未選択などで2言語を1通に（日本語 + 選択言語。未選択・日本語なら英語）"""
+    other = lang if lang and lang != "jp" else "en"
+    return bi(tr(key, "jp", **values), tr(key, other, **values))
+
+
+def pickup_label(lang, need) -> str:
+    return tr("label.need" if need else "label.no", lang)
+
+
+def foreign_hint(lang, short=False) -> str:
+    """店舗向けの「※外国人のお客様（英語）」。日本語のお客さまなら空"""
+    if not lang or lang == "jp":
+        return ""
+    return tr("store.foreign_short" if short else "store.foreign",
+              lang_name=catalog.LOCALE_NAMES_JP.get(lang, lang))
+
+
+_LAST_REQ_ID = ["", 1]  # [秒までの ID, その秒の通し番号]
+
+
+def make_req_id():
+    """同じ秒に複数の照会が来たら -2, -3 … を付ける（_INQUIRY_LOCK の中で呼ぶ）"""
+    base = "REQ-" + now_jst().strftime("%Y%m%d-%H%M%S")
+    if _LAST_REQ_ID[0] == base:
+        _LAST_REQ_ID[1] += 1
+        return f"{base}-{_LAST_REQ_ID[1]}"
+    _LAST_REQ_ID[:] = [base, 1]
+    return base
+
+# ====== トレース（req_id ごとの処理区間。OTLP 互換 JSON でファイルへ） ======
+# TRACE_PATH を指定すると、照会1件を1トレースとして区間（span）を1行ずつ書き出す
+# （OpenTelemetry Collector の otlpjsonfile receiver などでそのまま読める形）。
+# trace_id は req_id から決めるので、webhook・タイマー・ジョブ・別ワーカーをまたいでも同じトレースにまとまる。
+# 各区間の親は照会全体の区間「booking」（確定・締切・取り消しのときに書き出す）。
+# 直近 TRACE_KEEP 件の照会は /admin/trace/<req_id> でも確認できる。
+TRACE_PATH = _env("TRACE_PATH", "")
+TRACE_SERVICE_NAME = _env("TRACE_SERVICE_NAME", "line-booking")
+TRACE_KEEP = int(_env("TRACE_KEEP", "300"))
+_TRACE_CTX = contextvars.ContextVar("trace_ctx", default=None)  # (trace_id, span_id, req_id)
+_TRACE_LOCK = threading.Lock()
+RECENT_TRACES = collections.OrderedDict()  # req_id -> [span]
+
+
+def _trace_id(req_id: str) -> str:
+    return hashlib.sha256(req_id.encode("utf-8")).hexdigest()[:32]
+
+
+def _root_span_id(req_id: str) -> str:
+    return hashlib.sha256((req_id + ":booking").encode("utf-8")).hexdigest()[:16]
+
+
+def _otlp_value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    if isinstance(v, (list, tuple, set)):
+        return {"arrayValue": {"values": [_otlp_value(x) for x in v]}}
+    return {"stringValue": str(v)}
+
+
+def emit_span(req_id, name, start_ns, end_ns, span_id=None, parent_id=None, attrs=None, error=None):
+    if not TRACE_PATH or not req_id:
+        return
+    span = {
+        "traceId": _trace_id(req_id),
+        "spanId": span_id or os.urandom(8).hex(),
+        "name": name,
+        "kind": 1,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [{"key": "req_id", "value": {"stringValue": req_id}}]
+                      + [{"key": k, "value": _otlp_value(v)} for k, v in (attrs or {}).items() if v is not None],
+        "status": {"code": 2, "message": error} if error else {"code": 1},
+    }
+    if parent_id:
+        span["parentSpanId"] = parent_id
+    line = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+        "scopeSpans": [{"scope": {"name": "app"}, "spans": [span]}],
+    }]}, ensure_ascii=False, separators=(",", ":"))
+    with _TRACE_LOCK:
+        RECENT_TRACES.setdefault(req_id, []).append(span)
+        RECENT_TRACES.move_to_end(req_id)
+        while len(RECENT_TRACES) > TRACE_KEEP:
+            RECENT_TRACES.popitem(last=False)
+        try:
+            with open(TRACE_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print("[TRACE] write failed:", e)
+
+
+@contextlib.contextmanager
+def trace_span(name, req_id=None, parent=None, **attrs):
+    """with trace_span("store_push", req_id, store="ST1") as a: ... a["ok"] = True
+    req_id を省略すると、実行中の区間（または parent に渡した文脈）のトレースにぶら下げる。どちらも無ければ何もしない"""
+    ctx = parent or _TRACE_CTX.get()
+    if not req_id and ctx:
+        req_id = ctx[2]
+    if not TRACE_PATH or not req_id:
+        yield attrs
+        return
+    parent_id = ctx[1] if ctx and ctx[2] == req_id else _root_span_id(req_id)
+    span_id = os.urandom(8).hex()
+    token = _TRACE_CTX.set((_trace_id(req_id), span_id, req_id))
+    start, error = time.time_ns(), None
     try:
-        line_bot_api.reply_message(reply_token, msg)
+        yield attrs
     except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        _TRACE_CTX.reset(token)
+        emit_span(req_id, name, start, time.time_ns(), span_id, parent_id, attrs, error)
+
+
+def end_booking_trace(req_id: str, outcome: str):
+    """照会全体の区間（booking）を書き出す。1照会につき1回"""
+    req = REQUESTS.get(req_id)
+    if not TRACE_PATH or not req or req.get("trace_done") or not req.get("trace_start_ns"):
+        return
+    req["trace_done"] = True
+    emit_span(req_id, "booking", req["trace_start_ns"], time.time_ns(), span_id=_root_span_id(req_id),
+              attrs={"outcome": outcome, "store_id": req.get("store_id"),
+                     "candidates": len(req.get("candidates") or ()), "pushed": len(req.get("pushed_at") or ())})
+
+
+def _plain_value(v):
+    if "arrayValue" in v:
+        return [_plain_value(x) for x in v["arrayValue"]["values"]]
+    return next(iter(v.values()))
+
+
+def current_trace():
+    return _TRACE_CTX.get()
+
+
+# ====== 混雑時の受付制御（優先度と負荷制限） ======
+# LINE API が遅い・送信が詰まっているときに全部を同じ扱いで送ると、予約確定まで一緒に遅くなる。
+# 仕事を4つの優先度に分け、混雑度（0: 平常 1: soft 2: hard）に応じて低いものから後回し・打ち切りにする。
+#   CRITICAL … 予約確定・15分前リマインド・店舗ダイジェスト・締切通知（常に送る）
+#   HIGH     … 候補カード（常に送る）
+#   NORMAL   … 店舗への照会（段階送信のウェーブ）。hard の間は ADMIT_RETRY_SEC 秒ずつ後回しにし、
+#              お客さまには「混雑中・自動で再送」と返す。後回しの合計が ADMIT_MAX_DEFER_SEC に
+#              届いたら混んでいても送る（予約完了までの時間に上限を付けるため）
+#   LOW      … 管理用のテスト送信。soft 以上なら 503 で断る
+# 混雑度は LINE API 呼び出しの同時実行数（asgi.py では送信待ちも含む）と所要時間の移動平均で決める。
+# 判定はワーカープロセスごと。
+PRIO_CRITICAL, PRIO_HIGH, PRIO_NORMAL, PRIO_LOW = 0, 1, 2, 3
+PRIO_NAMES = ("critical", "high", "normal", "low")
+_REFUSE_AT = (None, None, 2, 1)   # 優先度ごとに、断り始める混雑度（None は断らない）
+ADMIT_QUEUE_SOFT = int(_env("ADMIT_QUEUE_SOFT", "20"))
+ADMIT_QUEUE_HARD = int(_env("ADMIT_QUEUE_HARD", "50"))
+ADMIT_LATENCY_SOFT_MS = float(_env("ADMIT_LATENCY_SOFT_MS", "1500"))
+ADMIT_LATENCY_HARD_MS = float(_env("ADMIT_LATENCY_HARD_MS", "4000"))
+ADMIT_LATENCY_STALE_SEC = 30      # これより古い計測は使わない（送っていない間の遅さは分からない）
+ADMIT_RETRY_SEC = float(_env("ADMIT_RETRY_SEC", "15"))
+ADMIT_MAX_DEFER_SEC = float(_env("ADMIT_MAX_DEFER_SEC", "60"))
+LOAD = {"inflight": 0, "latency_ms": 0.0, "sampled_at": 0.0, "level": 0}
+ADMISSION_STATS = {}              # 優先度名 -> {"admitted","refused","forced"}
+_LOAD_LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def outbound_load():
+    """LINE API 1回分の同時実行数と所要時間（実時間）を混雑度に反映する"""
+    with _LOAD_LOCK:
+        LOAD["inflight"] += 1
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        now = time.monotonic()
+        with _LOAD_LOCK:
+            LOAD["inflight"] -= 1
+            fresh = now - LOAD["sampled_at"] <= ADMIT_LATENCY_STALE_SEC
+            LOAD["latency_ms"] = LOAD["latency_ms"] * 0.8 + ms * 0.2 if fresh else ms
+            LOAD["sampled_at"] = now
+
+
+def load_level() -> int:
+    with _LOAD_LOCK:
+        inflight = LOAD["inflight"]
+        fresh = time.monotonic() - LOAD["sampled_at"] <= ADMIT_LATENCY_STALE_SEC
+        lat = LOAD["latency_ms"] if fresh else 0.0
+        if inflight >= ADMIT_QUEUE_HARD or lat >= ADMIT_LATENCY_HARD_MS:
+            level = 2
+        elif inflight >= ADMIT_QUEUE_SOFT or lat >= ADMIT_LATENCY_SOFT_MS:
+            level = 1
+        else:
+            level = 0
+        prev, LOAD["level"] = LOAD["level"], level
+    if level != prev:
+        print(f"[LOAD] level {prev}→{level} inflight={inflight} latency={lat:.0f}ms")
+    return level
+
+
+def _count_admission(prio: int, key: str):
+    with _LOAD_LOCK:
+        st = ADMISSION_STATS.setdefault(PRIO_NAMES[prio], {"admitted": 0, "refused": 0, "forced": 0})
+        st[key] += 1
+
+
+def admit(prio: int) -> bool:
+    """この優先度の仕事を今始めてよいか（断られたら呼び出し側で後回し・打ち切りにする）"""
+    limit = _REFUSE_AT[prio]
+    ok = limit is None or load_level() < limit
+    _count_admission(prio, "admitted" if ok else "refused")
+    return ok
+
+
+# ====== 送信レイヤ（reply 優先・push は必要なときだけ） ======
+# reply は無料・push は有料枠を消費する。reply トークンは受信から約1分・1回限りなので、
+# 受信時刻と使用済みかを覚えておき、使えないと分かっているトークンでは reply を試さない。
+REPLY_TOKEN_TTL_SEC = 50     # LINE の有効期限（約1分）より少し手前で諦める
+REPLY_MAX_MESSAGES = 5       # 1回の reply / push に載せられる上限
+REPLY_TOKENS = {}            # reply_token -> {"at": 受信時刻(epoch秒), "used": bool}
+OUTBOUND_STATS = {}          # path -> {"reply","push","fallback","fail"}（送信回数。メッセージ数ではない）
+_OUTBOUND_LOCK = threading.Lock()
+
+# 非同期エントリ（asgi.py）から呼ばれたときは、送信をここに溜めて
+# 呼び出し側が async クライアントでまとめて await する（None なら従来どおり同期送信）
+OUTBOX = contextvars.ContextVar("outbox", default=None)
+
+
+def note_reply_token(event):
+    """webhook イベントの reply トークンを受信時刻つきで登録（再送イベントは元の時刻）"""
+    token = getattr(event, "reply_token", None)
+    if not token:
+        return
+    ts = getattr(event, "timestamp", None)
+    at = ts / 1000.0 if ts else CLOCK.time()
+    with _OUTBOUND_LOCK:
+        if len(REPLY_TOKENS) > 1000:
+            cutoff = CLOCK.time() - REPLY_TOKEN_TTL_SEC * 2
+            for t in [t for t, v in REPLY_TOKENS.items() if v["at"] < cutoff]:
+                del REPLY_TOKENS[t]
+        REPLY_TOKENS.setdefault(token, {"at": at, "used": False})
+
+
+def _claim_reply_token(token) -> bool:
+    """トークンを使ってよければ使用済みにして True（未登録のトークンは試してみる）"""
+    if not token:
+        return False
+    with _OUTBOUND_LOCK:
+        info = REPLY_TOKENS.get(token)
+        if info is None:
+            return True
+        if info["used"] or CLOCK.time() - info["at"] > REPLY_TOKEN_TTL_SEC:
+            return False
+        info["used"] = True
+        return True
+
+
+def _count_outbound(path: str, key: str):
+    with _OUTBOUND_LOCK:
+        st = OUTBOUND_STATS.setdefault(path, {"reply": 0, "push": 0, "fallback": 0, "fail": 0})
+        st[key] += 1
+
+
+def _chunks(messages):
+    for i in range(0, len(messages), REPLY_MAX_MESSAGES):
+        chunk = messages[i:i + REPLY_MAX_MESSAGES]
+        yield chunk[0] if len(chunk) == 1 else chunk
+
+
+# --- reply→失敗時はpushへフォールバック ---
+def reply_or_push(user_id, reply_token, *messages, path=None, fallback=True):
+    """
+    先頭5件を reply で送り、溢れた分・reply できなかった分だけ push する。
+    path は送信回数の集計キー（省略時は呼び出し元の関数名）。
+    fallback=False なら reply できなければ送らない（連打への念押しなど）。
+    """
+    path = path or sys._getframe(1).f_code.co_name
+    msgs = list(messages)
+    box = OUTBOX.get()
+    if box is not None:
+        box.append(("reply", user_id, reply_token if _claim_reply_token(reply_token) else None, msgs, path, fallback,
+                    current_trace()))
+        return
+    rest = msgs
+    if _claim_reply_token(reply_token):
+        head = msgs[:REPLY_MAX_MESSAGES]
         try:
-            if user_id:
-                line_bot_api.push_message(user_id, msg)
-                print("[FALLBACK] reply→push", e)
-            else:
-                print("[FALLBACK] reply failed (no user_id)", e)
+            with outbound_load(), trace_span("line.reply", path=path):
+                line_bot_api.reply_message(reply_token, head[0] if len(head) == 1 else head)
+            _count_outbound(path, "reply")
+            rest = msgs[REPLY_MAX_MESSAGES:]
+        except Exception as e:
+            print(f"[FALLBACK] {path} reply→push", e)
+            _count_outbound(path, "fallback")
+    if not rest or not fallback:
+        return
+    if not user_id:
+        print(f"[FALLBACK] {path} reply unavailable (no user_id)")
+        _count_outbound(path, "fail")
+        return
+    for chunk in _chunks(rest):
+        try:
+            with outbound_load(), trace_span("line.push", path=path):
+                line_bot_api.push_message(user_id, chunk)
+            _count_outbound(path, "push")
         except Exception as e2:
-            print("[FALLBACK] both failed", e, e2)
+            print(f"[FALLBACK] {path} push failed", e2)
+            _count_outbound(path, "fail")
 
 def service_window_state(now: datetime.datetime | None = None) -> str:
     """
-    受付時間の状態を返す:
+    受付時間の状態を返す（名前は既定の時刻のまま。実際の時刻は SERVICE_OPEN_HOUR / SERVICE_CLOSE_HOUR）:
       - "before16" … 16:00 前（受付前）
       - "inside"   … 16:00〜22:00（受付中）
       - "after22"  … 22:00 以降（受付終了）
     """
     now = now or now_jst()
     now = now.astimezone(JST)
-    start = now.replace(hour=16, minute=0, second=0, microsecond=0)
-    end   = now.replace(hour=22, minute=0, second=0, microsecond=0)
+    start = now.replace(hour=SERVICE_OPEN_HOUR, minute=0, second=0, microsecond=0)
+    end   = now.replace(hour=SERVICE_CLOSE_HOUR, minute=0, second=0, microsecond=0)
     if now < start:
         return "before16"
     if now >= end:
@@ -257,6 +889,55 @@ def service_window_state(now: datetime.datetime | None = None) -> str:
     return "inside"
 
 
+# ====== ライフサイクルイベントログ（追記のみ・ローテーション） ======
+# 状態が変わるたびに 1行 JSON を追記する（集計は analyze_events.py でオフラインに）。
+#   {"t": 1760000000.123, "ev": "store_reply", "req": "REQ-...", "u": "3f2a…", "store": "ST1", "status": "ok", "lat": 42.1}
+# ev: ask_time / ask_confirm / inquiry / store_push / store_reply / candidate_shown /
+#     book_draft / book_confirm_shown / confirmed / reminder / timeout / cancel
+# ユーザーIDはそのまま残さず、EVENT_LOG_SALT 付きハッシュ（u）にする。EVENT_LOG_PATH を空にすると無効。
+EVENT_LOG_PATH = _env("EVENT_LOG_PATH", "events.log")
+EVENT_LOG_MAX_BYTES = int(_env("EVENT_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+EVENT_LOG_BACKUPS = int(_env("EVENT_LOG_BACKUPS", "10"))
+EVENT_LOG_SALT = _env("EVENT_LOG_SALT", "")
+
+_event_logger = logging.getLogger(f"booking.events.{TENANT}" if TENANT else "booking.events")
+_event_logger.propagate = False
+_event_logger.setLevel(logging.INFO)
+if EVENT_LOG_PATH:
+    try:
+        _h = logging.handlers.RotatingFileHandler(
+            EVENT_LOG_PATH, maxBytes=EVENT_LOG_MAX_BYTES, backupCount=EVENT_LOG_BACKUPS, encoding="utf-8")
+        _h.setFormatter(logging.Formatter("%(message)s"))
+        _event_logger.addHandler(_h)
+    except OSError as e:
+        print("[EVENTS] log disabled:", e)
+
+
+def user_key(user_id) -> str:
+    """ログ用の仮名ID（同じユーザーは同じ値・元のIDには戻せない）"""
+    if not user_id:
+        return ""
+    return hashlib.sha256((EVENT_LOG_SALT + user_id).encode("utf-8")).hexdigest()[:16]
+
+
+def log_event(ev: str, req_id=None, user_id=None, **fields):
+    if not _event_logger.handlers:
+        return
+    rec = {"t": round(now_jst().timestamp(), 3), "ev": ev}
+    if req_id:
+        rec["req"] = req_id
+    if user_id:
+        rec["u"] = user_key(user_id)
+    rec.update(fields)
+    try:
+        _event_logger.info(json.dumps(rec, ensure_ascii=False, separators=(",", ":")))
+    except Exception as e:
+        print("[EVENTS] write failed:", e)
+
+
+# 人数の手入力（5名以上）
+_PAX_NUMBER_RE = re.compile(r"^\d{1,2}$")
+
 # --- phone helpers (ADD just below reply_or_push) ---
 def _clean_phone(s: str) -> str:
     # スペース・ハイフン・括弧などを除去（+ と数字だけ残す）
@@ -264,7 +945,7 @@ def _clean_phone(s: str) -> str:
 
 def _valid_phone(s: str, lang: str) -> bool:
     s = _clean_phone(s)
-    if lang == "en":
+    if lang != "jp":
         # 国番号つき（+から始まり 6〜15桁）
         return bool(re.match(r"^\+\d{6,15}$", s))
     else:
@@ -272,21 +953,139 @@ def _valid_phone(s: str, lang: str) -> bool:
         return bool(re.match(r"^0\d{9,10}$", s))
 
 
+# ====== 店舗への配信の健全性（届かない店は照会の対象から外す） ======
+# 店舗の LINE ID ごとに push の結果を記録する（連続失敗回数・エラーコード別の回数・最後の成功）。
+# ブロック・友だち解除・ID の書き間違いのような恒久的なエラー（DELIVERY_PERMANENT_CODES）が
+# DELIVERY_QUARANTINE_AFTER 回続いた店は隔離し、一斉照会・テスト送信から外す（無駄な API 呼び出しと待ちを省く）。
+# 隔離中でも DELIVERY_PROBE_SEC ごとに1回だけは対象に戻して様子を見る（probe）。成功すれば隔離を解く。
+# 一時的なエラー（429・5xx・通信エラー）は数えるだけで隔離しない。予約確定・リマインドの送信は隔離中でも止めない。
+DELIVERY_QUARANTINE_AFTER = int(_env("DELIVERY_QUARANTINE_AFTER", "3"))
+DELIVERY_PROBE_SEC = float(_env("DELIVERY_PROBE_SEC", "1800"))
+DELIVERY_PERMANENT_CODES = {400, 403, 404}
+DELIVERY = {}  # line_user_id -> {"fails","permanent","codes":{code: 回数},"last_ok","last_fail","quarantined","next_probe"}
+_DELIVERY_LOCK = threading.Lock()
+
+
+def record_delivery(uid, ok: bool, code=None):
+    """店舗への push の結果を記録（店舗以外の宛先は記録しない）。code は HTTP ステータス（通信エラーは None）"""
+    store = STORE_BY_UID.get(uid)
+    if store is None:
+        return
+    now = CLOCK.time()
+    with _DELIVERY_LOCK:
+        h = DELIVERY.setdefault(uid, {"fails": 0, "permanent": 0, "codes": {}, "last_ok": None,
+                                      "last_fail": None, "quarantined": None, "next_probe": None})
+        if ok:
+            recovered = h["quarantined"] is not None
+            h.update(fails=0, permanent=0, last_ok=now, quarantined=None, next_probe=None)
+        else:
+            key = str(code) if code is not None else "error"
+            h["codes"][key] = h["codes"].get(key, 0) + 1
+            h["fails"] += 1
+            h["last_fail"] = now
+            h["permanent"] = h["permanent"] + 1 if code in DELIVERY_PERMANENT_CODES else 0
+            quarantine = h["quarantined"] is None and h["permanent"] >= DELIVERY_QUARANTINE_AFTER
+            if quarantine:
+                h["quarantined"] = now
+                h["next_probe"] = now + DELIVERY_PROBE_SEC
+    if ok and recovered:
+        print(f"[DELIVERY] {store['store_id']} recovered")
+        log_event("store_recovered", store=store["store_id"])
+    elif not ok and quarantine:
+        print(f"[DELIVERY] {store['store_id']} quarantined after {DELIVERY_QUARANTINE_AFTER} failures code={code}")
+        log_event("store_quarantined", store=store["store_id"], code=code)
+
+
+def delivery_skip(uid, probe=True) -> bool:
+    """
+    隔離中で送らない店なら True。probe の時刻が来ていれば False で、probe=True なら
+    今から送る1回を probe として使う（次の probe は DELIVERY_PROBE_SEC 後）。probe=False は見るだけ。
+    """
+    h = DELIVERY.get(uid)
+    if not h or h["quarantined"] is None:
+        return False
+    now = CLOCK.time()
+    with _DELIVERY_LOCK:
+        if h["quarantined"] is None:
+            return False
+        if now < h["next_probe"]:
+            return True
+        if not probe:
+            return False
+        h["next_probe"] = now + DELIVERY_PROBE_SEC
+    print(f"[DELIVERY] probe {STORE_BY_UID.get(uid, {}).get('store_id', uid)}")
+    return False
+
+
+def release_delivery(uid) -> bool:
+    with _DELIVERY_LOCK:
+        h = DELIVERY.pop(uid, None)
+    return bool(h and h["quarantined"] is not None)
+
+
 # 追加ここから（reply_or_pushの直後に置く）
-def safe_push(uid, message, store_name=""):
+PUSH_QUEUED = "queued"  # OUTBOX に積んだだけでまだ送っていない（成否は asgi.py 側で記録する）
+
+
+def log_push_results(push_log, ok: bool):
+    """push_log: 送信の成否が分かったら store_push として記録する (req_id, 追加項目) の並び"""
+    for req_id, extra in push_log:
+        log_event("store_push", req_id, ok=ok, **extra)
+
+
+def safe_push(uid, message, store_name="", path=None, push_log=()):
+    """True/False は送れたかどうか。asgi.py 経由（OUTBOX）のときは PUSH_QUEUED を返し、成功扱いの記録はしない"""
+    path = path or sys._getframe(1).f_code.co_name
+    box = OUTBOX.get()
+    if box is not None:
+        box.append(("push", uid, [message], path, store_name, current_trace(), tuple(push_log)))
+        return PUSH_QUEUED
+    ok = False
     try:
-        line_bot_api.push_message(uid, message)
+        with outbound_load(), trace_span("line.push", path=path):
+            line_bot_api.push_message(uid, message)
         print(f"[PUSH OK] {store_name} {uid}")
-        return True
+        _count_outbound(path, "push")
+        record_delivery(uid, True)
+        ok = True
     except LineBotApiError as e:
         detail = getattr(e, "error", None)
         print(f"[PUSH NG] {store_name} {uid} status={getattr(e,'status_code',None)} detail={detail}")
+        record_delivery(uid, False, getattr(e, "status_code", None))
     except Exception as e:
         print(f"[PUSH NG] {store_name} {uid} err={e}")
-    return False
+        record_delivery(uid, False)
+    if not ok:
+        _count_outbound(path, "fail")
+    log_push_results(push_log, ok)
+    return ok
 # 追加ここまで
 # ====== Flex: 候補カード ======
-def candidate_bubble(store, lang="jp"):
+# 店舗×言語ごとに組み立て済みのカードを使い回す（表示内容をキーにするので、シート再読込後は自然に作り直される）
+# 店舗数×言語×時間ラベルで増えるので、古く使われていないものから BUBBLE_CACHE_MAX 件を超えた分を捨てる
+BUBBLE_CACHE_MAX = int(_env("BUBBLE_CACHE_MAX", "2000"))
+BUBBLE_WARM_STORES = int(_env("BUBBLE_WARM_STORES", "50"))  # 起動時に先に組み立てておく店舗数
+_BUBBLE_CACHE = collections.OrderedDict()
+_BUBBLE_LOCK = threading.Lock()
+
+def candidate_bubble(store, lang="jp", time_label=""):
+    """time_label は希望時間が複数の照会で、その店で入れる時間（"19:30"）"""
+    key = (lang, store.get("store_id"), store.get("name", ""), store.get("profile", ""),
+           store.get("map_url", ""), (store.get("instagram_url") or "").strip(), time_label)
+    with _BUBBLE_LOCK:
+        b = _BUBBLE_CACHE.get(key)
+        if b is not None:
+            _BUBBLE_CACHE.move_to_end(key)
+            return b
+    b = _build_candidate_bubble(store, lang, time_label)
+    with _BUBBLE_LOCK:
+        _BUBBLE_CACHE[key] = b
+        while len(_BUBBLE_CACHE) > BUBBLE_CACHE_MAX:
+            _BUBBLE_CACHE.popitem(last=False)
+    return b
+
+
+def _build_candidate_bubble(store, lang, time_label=""):
     title   = store.get("name", "")
     body1   = store.get("profile", "")
     map_url = store.get("map_url", "")
@@ -297,7 +1096,7 @@ def candidate_bubble(store, lang="jp"):
         ButtonComponent(
             style="primary",
             action=URIAction(
-                label=lang_text(lang, "Googleマップ", "Google Maps"),
+                label=tr("card.map", lang),
                 uri=map_url or "https://maps.google.com"  # map_urlが空でも落ちないように保険
             )
         )
@@ -309,7 +1108,7 @@ def candidate_bubble(store, lang="jp"):
             ButtonComponent(
                 style="secondary",
                 action=URIAction(
-                    # ブランド名として英語固定でOK。日本語にしたいなら lang_text に変えてください。
+                    # ブランド名として英語固定でOK。訳したいなら catalog に card.instagram を足してください。
                     label="Instagram",
                     uri=ig_url
                 )
@@ -321,19 +1120,23 @@ def candidate_bubble(store, lang="jp"):
         ButtonComponent(
             style="link",
             action=PostbackAction(
-                label=lang_text(lang, "この店に予約申請", "Book this place"),
+                label=tr("card.book", lang),
                 data=json.dumps({"type": "book", "store_id": store.get("store_id")})
             )
         )
     )
 
+    # 本文（希望時間が複数の照会なら、この店で入れる時間を店名の下に）
+    body_contents = [TextComponent(text=title, weight="bold", size="lg", wrap=True)]
+    if time_label:
+        body_contents.append(TextComponent(text=tr("card.time", lang, time=time_label),
+                                           size="sm", weight="bold", color="#1DB446", margin="sm"))
+    body_contents.append(TextComponent(text=body1, size="sm", wrap=True, margin="md"))
+
     return BubbleContainer(
         body=BoxComponent(
             layout="vertical",
-            contents=[
-                TextComponent(text=title, weight="bold", size="lg", wrap=True),
-                TextComponent(text=body1, size="sm", wrap=True, margin="md"),
-            ],
+            contents=body_contents,
         ),
         footer=BoxComponent(
             layout="vertical",
@@ -342,32 +1145,259 @@ def candidate_bubble(store, lang="jp"):
         )
     )
 
-def schedule_timeout_notice(req_id: str):
-    """締切時点で候補0件ならユーザーへ『満席でした』を自動通知してクローズ"""
-    def _notify():
-        req = REQUESTS.get(req_id)
-        if not req or req.get("closed"):
-            return
-        if len(req.get("candidates", set())) == 0:
-            lang = SESS.get(req["user_id"], {}).get("lang", "jp")
-            jp = "現在、すべての登録店舗が満席でした。時間や人数を変えて再度お試しください。"
-            en = "All registered restaurants were full for your request. Please try another time or party size."
-            try:
-                line_bot_api.push_message(req["user_id"], TextSendMessage(lang_text(lang, jp, en)))
-            except Exception as e:
-                print("timeout notice failed:", e)
-        req["closed"] = True
+# ====== 永続ジョブ（締切通知・15分前リマインド） ======
+# threading.Timer だけだと再起動で消え、gunicorn の複数ワーカー間でも誰が担当か決まらない。
+# そこで予定を SQLite のジョブ表に書き、各ワーカーのポーリングスレッドが
+# リース（lease_until まで自分が担当）付きで1件ずつ取り合う。取れたワーカーだけが実行する。
+# 同一ホスト上のワーカー間で共有する前提（JOBS_DB_PATH は永続ディスク上に置くこと）。
+# 締切通知のように中身が登録したワーカーのメモリ（REQUESTS）にしか無いジョブは owner を付けて登録し、
+# そのワーカーだけが取る。owner の生存確認（workers 表の seen_at）が JOBS_LEASE_SEC 途絶えたら、
+# ほかのワーカーが取って片付ける（中身は失われているので skipped になる）。
+JOBS_DB_PATH = _env("JOBS_DB_PATH", "jobs.sqlite3")
+JOBS_POLL_SEC = float(_env("JOBS_POLL_SEC", "1"))
+JOBS_LEASE_SEC = 60          # 実行中にワーカーが落ちたら、この秒数後に別ワーカーが拾い直す
+JOBS_MAX_ATTEMPTS = 3
+JOBS_KEEP_DAYS = 2           # 終わったジョブを残す日数
+_JOBS_WORKER_ID = f"{os.getpid()}-{os.urandom(3).hex()}"
+_JOBS_RUNNER_PID = None
+_JOBS_RUNNER_LOCK = threading.Lock()
+_JOBS_HEARTBEAT = {"at": None}  # このワーカーが workers 表へ最後に生存を書いた時刻
+
+
+def _jobs_db():
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_jobs_db():
+    with _jobs_db() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_key     TEXT UNIQUE,
+                kind        TEXT NOT NULL,
+                req_id      TEXT,
+                due_at      REAL NOT NULL,
+                status      TEXT NOT NULL DEFAULT 'pending',
+                payload     TEXT NOT NULL DEFAULT '{}',
+                lease_owner TEXT,
+                lease_until REAL,
+                attempts    INTEGER NOT NULL DEFAULT 0,
+                updated_at  REAL NOT NULL,
+                owner       TEXT
+            )""")
+        if "owner" not in {r["name"] for r in conn.execute("PRAGMA table_info(jobs)")}:
+            conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")  # 以前の版で作った DB
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, due_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+        conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done','skipped','failed') AND updated_at < ?",
+            (time.time() - JOBS_KEEP_DAYS * 86400,))
+
+
+def enqueue_job(kind: str, req_id: str, due: datetime.datetime, key: str, payload: dict | None = None,
+                owned: bool = False):
+    """ジョブを登録（同じ key は1件だけ＝ワーカーをまたいだ多重登録を防ぐ）。owned=True ならこのワーカーだけが取る"""
+    with _jobs_db() as conn:
+        if owned:
+            _jobs_heartbeat(conn, CLOCK.time())
+        conn.execute(
+            "INSERT OR IGNORE INTO jobs (job_key, kind, req_id, due_at, payload, updated_at, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, kind, req_id, due.timestamp(), json.dumps(payload or {}, ensure_ascii=False), time.time(),
+             _JOBS_WORKER_ID if owned else None))
+
+
+def _jobs_heartbeat(conn, now_ts: float):
+    """このワーカーが生きていることを workers 表に書く（JOBS_LEASE_SEC の 1/4 ごと）"""
+    last = _JOBS_HEARTBEAT["at"]
+    if last is not None and 0 <= now_ts - last < JOBS_LEASE_SEC / 4:
+        return
+    conn.execute("INSERT OR REPLACE INTO workers (worker_id, seen_at) VALUES (?, ?)", (_JOBS_WORKER_ID, now_ts))
+    conn.execute("DELETE FROM workers WHERE seen_at < ?", (now_ts - JOBS_KEEP_DAYS * 86400,))
+    _JOBS_HEARTBEAT["at"] = now_ts
+
+
+def _claim_due_jobs(now_ts: float):
+    """期限の来たジョブをリース付きで取る（UPDATE が当たったものだけが自分の担当）"""
+    with _jobs_db() as conn:
+        _jobs_heartbeat(conn, now_ts)
+        rows = conn.execute(
+            "SELECT * FROM jobs WHERE due_at <= ? AND "
+            "(status = 'pending' OR (status = 'running' AND lease_until < ?)) AND "
+            "(owner IS NULL OR owner = ? OR owner NOT IN (SELECT worker_id FROM workers WHERE seen_at >= ?)) "
+            "ORDER BY due_at LIMIT 20", (now_ts, now_ts, _JOBS_WORKER_ID, now_ts - JOBS_LEASE_SEC)).fetchall()
+        claimed = []
+        for row in rows:
+            cur = conn.execute(
+                "UPDATE jobs SET status='running', lease_owner=?, lease_until=?, attempts=attempts+1, updated_at=? "
+                "WHERE id=? AND (status='pending' OR (status='running' AND lease_until < ?))",
+                (_JOBS_WORKER_ID, now_ts + JOBS_LEASE_SEC, time.time(), row["id"], now_ts))
+            if cur.rowcount == 1:
+                claimed.append(row)
+        return claimed
+
+
+def next_job_due() -> float | None:
+    """次に取れるジョブの時刻（epoch 秒。無ければ None）。仮想時計が空のポーリングを飛ばすのに使う"""
+    with _jobs_db() as conn:
+        row = conn.execute(
+            "SELECT (SELECT MIN(due_at) FROM jobs WHERE status = 'pending'), "
+            "(SELECT MIN(lease_until) FROM jobs WHERE status = 'running')").fetchone()
+    due = [t for t in row if t is not None]
+    return min(due) if due else None
+
+
+def _finish_job(job_id: int, status: str):
+    with _jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status=?, lease_owner=NULL, lease_until=NULL, updated_at=? "
+            "WHERE id=? AND lease_owner=?",
+            (status, time.time(), job_id, _JOBS_WORKER_ID))
+
+
+def _defer_job(job_id: int, due_ts: float):
+    with _jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status='pending', lease_owner=NULL, lease_until=NULL, due_at=?, "
+            "attempts=attempts-1, updated_at=? WHERE id=? AND lease_owner=?",
+            (due_ts, time.time(), job_id, _JOBS_WORKER_ID))
+
+
+def _retry_job(row):
+    status = "failed" if row["attempts"] + 1 >= JOBS_MAX_ATTEMPTS else "pending"  # attempts は取得前の値
+    with _jobs_db() as conn:
+        conn.execute(
+            "UPDATE jobs SET status=?, lease_owner=NULL, lease_until=NULL, due_at=?, updated_at=? "
+            "WHERE id=? AND lease_owner=?",
+            (status, now_jst().timestamp() + 30, time.time(), row["id"], _JOBS_WORKER_ID))
+
+
+def run_due_jobs():
+    now = now_jst()
+    for row in _claim_due_jobs(now.timestamp()):
+        kind = row["kind"]
+        job = {"kind": kind, "req_id": row["req_id"], "payload": json.loads(row["payload"] or "{}"),
+               "due": datetime.datetime.fromtimestamp(row["due_at"], JST)}
+        runner, skip_if_overdue = JOB_KINDS.get(kind, (None, None))
+        try:
+            if runner is None:
+                print(f"[JOBS] unknown kind={kind} id={row['id']}")
+                _finish_job(row["id"], "failed")
+            elif skip_if_overdue and skip_if_overdue(job, now):
+                print(f"[JOBS] skip overdue {kind} {row['req_id']} due={job['due'].isoformat()}")
+                _finish_job(row["id"], "skipped")
+            else:
+                with trace_span(f"job.{kind}", row["req_id"]) as span:
+                    result = span["result"] = runner(job) or "done"
+                if isinstance(result, tuple) and result[0] == "defer":
+                    _defer_job(row["id"], now.timestamp() + result[1])  # 送信上限などで少し後ろへ（試行回数は数えない）
+                else:
+                    _finish_job(row["id"], result)
+        except Exception as e:
+            print(f"[JOBS] {kind} {row['req_id']} failed:", e)
+            _retry_job(row)
 
-    def _arm_timer():
-        req = REQUESTS.get(req_id)
-        if not req or req.get("closed"):
+
+def poll_jobs():
+    """ポーリングスレッドから1回分（仮想時計のときは advance() が回すので何もしない）"""
+    if not CLOCK.virtual:
+        run_due_jobs()
+
+
+def _job_runner_loop():
+    while True:
+        try:
+            poll_jobs()
+        except Exception as e:
+            print("[JOBS] poll failed:", e)
+        time.sleep(JOBS_POLL_SEC)
+
+
+def ensure_job_runner():
+    """このプロセスのポーリングスレッドを起動（fork 後の子でも1回だけ起動する）"""
+    global _JOBS_RUNNER_PID, _JOBS_WORKER_ID
+    if _JOBS_RUNNER_PID == os.getpid():
+        return
+    with _JOBS_RUNNER_LOCK:
+        if _JOBS_RUNNER_PID == os.getpid():
             return
-        delay = max(0, int((req["deadline"] - now_jst()).total_seconds()))
-        threading.Timer(delay, _notify).start()
+        _JOBS_WORKER_ID = f"{os.getpid()}-{os.urandom(3).hex()}"
+        _JOBS_HEARTBEAT["at"] = None
+        init_jobs_db()
+        pollers = SHARED.get("job_pollers")
+        if pollers is not None:
+            pollers[TENANT] = poll_jobs  # tenants.py の共有スレッドが全テナント分をまとめて回す
+        else:
+            threading.Thread(target=_job_runner_loop, name="job-runner", daemon=True).start()
+        _JOBS_RUNNER_PID = os.getpid()
+        print(f"[JOBS] runner started worker={_JOBS_WORKER_ID} db={JOBS_DB_PATH}")
+
+
+def schedule_timeout_notice(req_id: str):
+    """締切時点で候補0件ならユーザーへ『満席でした』を自動通知してクローズ"""
+    req = REQUESTS.get(req_id)
+    if not req or req.get("closed"):
+        return
+    deadline = req["deadline"]
+    enqueue_job("timeout", req_id, deadline, key=f"timeout:{req_id}:{deadline.isoformat()}",
+                payload={"user_id": req["user_id"]}, owned=True)
+
+
+def _run_timeout_job(job):
+    req = REQUESTS.get(job["req_id"])
+    if not req:
+        # owner のワーカーが落ちて中身（候補数）が失われた → 分からないので送らない
+        return "skipped"
+    if req.get("closed"):
+        return "done"
+    if now_jst() < req["deadline"]:
+        return "done"  # 締切が延長された（延長時に登録し直したジョブが担当）
+    if len(req.get("candidates", set())) == 0:
+        lang = SESS.get(req["user_id"], {}).get("lang", "jp")
+        safe_push(req["user_id"], TextSendMessage(tr("inquiry.timeout", lang)), path="timeout_notice")
+        log_event("timeout", job["req_id"], req["user_id"])
+    req["closed"] = True
+    end_booking_trace(job["req_id"], "timeout" if not req.get("candidates") else "not_booked")
+    return "done"
+
+
+# --- 15分前リマインド（ユーザー＆店舗）
+# 予約は :00/:30 に集まるので、15分前ちょうどに全員へ送ると一度に何十通も出てレート制限に当たる。
+#   - ユーザー向けは予約ごとに REMINDER_SPREAD_SEC 秒の範囲で前倒しにばらす（req_id から決まるので再登録しても同じ）
+#   - 送信は REMINDER_RATE_PER_SEC 通/秒（最大 REMINDER_BURST 通まで連続）に抑え、超えた分はジョブを少し後ろへずらす
+#   - 店舗向けは1件ずつ送らず、同じ時刻の予約をまとめた一覧（ダイジェスト）を1通だけ送る
+# 送信上限はワーカープロセスごと。
+REMINDER_SPREAD_SEC = float(_env("REMINDER_SPREAD_SEC", "120"))
+REMINDER_RATE_PER_SEC = float(_env("REMINDER_RATE_PER_SEC", "5"))
+REMINDER_BURST = int(_env("REMINDER_BURST", "10"))
+_REMINDER_BUCKET = [float(REMINDER_BURST), CLOCK.monotonic()]
+_REMINDER_LOCK = threading.Lock()
+
+
+def _reminder_due(wanted_dt):
+    return wanted_dt - timedelta(minutes=15)
+
+
+def _reminder_offset(req_id: str) -> float:
+    h = int(hashlib.sha1(req_id.encode("utf-8")).hexdigest()[:8], 16)
+    return REMINDER_SPREAD_SEC * (h / 0xFFFFFFFF)
+
+
+def take_reminder_send() -> float:
+    """1通分の送信枠を取れたら 0、取れなければ次の枠までの秒数"""
+    with _REMINDER_LOCK:
+        now = CLOCK.monotonic()
+        tokens = min(float(REMINDER_BURST), _REMINDER_BUCKET[0] + (now - _REMINDER_BUCKET[1]) * REMINDER_RATE_PER_SEC)
+        _REMINDER_BUCKET[1] = now
+        if tokens >= 1:
+            _REMINDER_BUCKET[0] = tokens - 1
+            return 0.0
+        _REMINDER_BUCKET[0] = tokens
+        return (1 - tokens) / REMINDER_RATE_PER_SEC
 
-    _arm_timer()
 
-# --- 15分前リマインド（ユーザー＆店舗） ← ここを置き換え
 def schedule_prearrival_reminder(req_id: str):
     """予約時刻の15分前に、ユーザーと店舗へ自動リマインド（多重実行防止つき）"""
     req = REQUESTS.get(req_id)
@@ -377,90 +1407,124 @@ def schedule_prearrival_reminder(req_id: str):
         return
     req["reminder_scheduled"] = True  # 予約確定時に一度だけ
 
-    def _send():
-        r = REQUESTS.get(req_id)
-        if not r or not r.get("confirmed"):
-            return
-
-        user_id = r["user_id"]
-        st = STORE_BY_ID.get(r.get("store_id"))
-        if not st:
-            return
+    # 再起動後・別ワーカーでも送れるよう、送信に要る内容をジョブに持たせる（店舗ダイジェストもここから読む）
+    payload = {k: req.get(k) for k in ("user_id", "store_id", "wanted_iso", "pax", "hotel", "pickup_point", "pickup", "name", "phone")}
+    payload["lang"] = SESS.get(req["user_id"], {}).get("lang", "jp")
+    wanted_dt = datetime.datetime.fromisoformat(req["wanted_iso"]).astimezone(JST)
+    due = _reminder_due(wanted_dt) - timedelta(seconds=_reminder_offset(req_id))
+    enqueue_job("reminder", req_id, due, key=f"reminder:{req_id}", payload=payload)
+    schedule_store_digest(req_id, payload)
+
+
+def schedule_store_digest(req_id: str, payload: dict, late_ok=True):
+    """店舗×予約時刻ごとに1件（送る時刻を過ぎてから確定した予約は、その1件だけの追いダイジェスト）"""
+    sid, wanted_iso = payload.get("store_id"), payload.get("wanted_iso")
+    wanted_dt = datetime.datetime.fromisoformat(wanted_iso).astimezone(JST)
+    due = _reminder_due(wanted_dt)
+    digest = {"store_id": sid, "wanted_iso": wanted_iso}
+    if now_jst() < due or not late_ok:
+        enqueue_job("store_digest", None, due, key=f"digest:{sid}:{wanted_iso}", payload=digest)
+    else:
+        enqueue_job("store_digest", req_id, now_jst(), key=f"digest:{sid}:{wanted_iso}:{req_id}",
+                    payload=dict(digest, only=req_id))
 
-        # 表示用
-        wanted_dt = datetime.datetime.fromisoformat(r["wanted_iso"]).astimezone(JST)
-        tstr  = wanted_dt.strftime("%H:%M")
-        pax   = r["pax"]
-        hotel = r.get("hotel") or "-"
-        lang  = SESS.get(user_id, {}).get("lang", "jp")
-        pickup = bool(r.get("pickup"))
-
-        # 強い警告（送迎あり/なし・日英で分岐）
-        jp_warn_pick = (
-            "⚠️ 必ず時間までに『集合場所』へお越しください。\n"
-            "⏰ 遅れる場合は “予約時間の15分前まで” に必ずお店へお電話を！\n"
-            "🚫 連絡なしの遅刻・不着は『予約キャンセル』になります。"
-        )
-        jp_warn_nopick = (
-            "⚠️ 必ず『予約時間までにご来店』ください。\n"
-            "⏰ 遅れる場合は “予約時間の15分前まで” に必ずお店へお電話を！\n"
-            "🚫 連絡なしの遅刻は『予約キャンセル』になります。"
-        )
-        en_warn_pick = (
-            "⚠️ Please be at the PICKUP POINT ON TIME.\n"
-            "⏰ If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
-            "🚫 No-show or late without notice will be CANCELLED."
-        )
-        en_warn_nopick = (
-            "⚠️ Please arrive at the RESTAURANT ON TIME.\n"
-            "⏰ If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
-            "🚫 No-show or late without notice will be CANCELLED."
-        )
 
-        # ユーザーへ（言語別・送迎明記・強調警告つき）
-        if lang == "jp":
-            user_msg = (
-                "【リマインド】このあと15分でご予約です。\n"
-                f"店舗：{st['name']}\n"
-                f"時間：{tstr}／{pax}名\n"
-                f"送迎：{'希望' if pickup else '不要'}（{hotel}）\n"
-                f"Googleマップ：{st['map_url']}\n\n" +
-                (jp_warn_pick if pickup else jp_warn_nopick)
-            )
-        else:
-            user_msg = (
-                "[Reminder] Your table is in 15 minutes.\n"
-                f"Restaurant: {st['name']}\n"
-                f"Time: {tstr} / {pax} people\n"
-                f"Pickup: {'Need' if pickup else 'No'} ({hotel})\n"
-                f"Google Maps: {st['map_url']}\n\n" +
-                (en_warn_pick if pickup else en_warn_nopick)
-            )
-        try:
-            line_bot_api.push_message(user_id, TextSendMessage(user_msg))
-        except Exception as e:
-            print("reminder user push failed:", e)
-
-        # 店舗へ（誰の予約か分かる詳細＋外国人フラグ）
-        store_msg = (
-            "【15分前リマインド】\n"
-            f"お名前：{r.get('name','-')}\n"
-            f"電話：{r.get('phone','-')}\n"
-            f"時間：{tstr}／{pax}名\n"
-            f"送迎：{'希望' if pickup else '不要'}（{hotel}）"
-        )
-        if lang == "en":
-            store_msg += "\n※外国人のお客様（英語）"
-        try:
-            line_bot_api.push_message(st["line_user_id"], TextSendMessage(store_msg))
-        except Exception as e:
-            print("reminder store push failed:", e)
+def _reminder_overdue(job, now) -> bool:
+    """予約時刻を過ぎたリマインドは送らない"""
+    wanted_iso = job["payload"].get("wanted_iso")
+    if not wanted_iso:
+        return True
+    return now >= datetime.datetime.fromisoformat(wanted_iso).astimezone(JST)
+
+
+def _run_reminder_job(job):
+    r = REQUESTS.get(job["req_id"])
+    if r is not None and not r.get("confirmed"):
+        return "skipped"
+    wait = take_reminder_send()
+    if wait:
+        return ("defer", wait)
+    r = r or job["payload"]
+    lang = SESS.get(r["user_id"], {}).get("lang") or job["payload"].get("lang", "jp")
+    send_prearrival_reminder(r, lang)
+    # 以前の形式のジョブ（店舗分もここで送っていた）向け。ダイジェストが登録済みなら何もしない
+    schedule_store_digest(job["req_id"], job["payload"], late_ok=False)
+    log_event("reminder", job["req_id"], r["user_id"], store=r.get("store_id"))
+    return "done"
+
+
+def send_prearrival_reminder(r, lang):
+    user_id = r["user_id"]
+    st = STORE_BY_ID.get(r.get("store_id"))
+    if not st:
+        return
 
-    # 予約時刻の15分前にタイマー
-    wanted_dt = datetime.datetime.fromisoformat(req["wanted_iso"]).astimezone(JST)
-    fire_at = wanted_dt - timedelta(minutes=15)
-    delay = max(0, int((fire_at - now_jst()).total_seconds()))
-    threading.Timer(delay, _send).start()
+    # 表示用
+    wanted_dt = datetime.datetime.fromisoformat(r["wanted_iso"]).astimezone(JST)
+    pickup = bool(r.get("pickup"))
+
+    # ユーザーへ（言語別・送迎明記・強調警告つき。警告文は送迎あり/なしで分岐）
+    user_msg = tr("reminder.body_pickup" if pickup else "reminder.body", lang,
+                  store=st["name"], time=wanted_dt.strftime("%H:%M"), pax=r["pax"], pickup=pickup_label(lang, pickup),
+                  hotel=r.get("hotel") or "-", map_url=st["map_url"])
+    safe_push(user_id, TextSendMessage(user_msg), path="reminder.user")
+
+
+def _slot_bookings(store_id: str, wanted_iso: str):
+    """その店・その時刻の確定予約（リマインドジョブに持たせた内容から。別ワーカーの確定分も含む）"""
+    wanted_ts = datetime.datetime.fromisoformat(wanted_iso).astimezone(JST).timestamp()
+    with _jobs_db() as conn:
+        # 送信上限で後ろへずれたジョブもあるので、期限は「予約時刻まで」で見る
+        rows = conn.execute(
+            "SELECT req_id, payload FROM jobs WHERE kind='reminder' AND due_at BETWEEN ? AND ? "
+            "AND json_extract(payload, '$.store_id') = ? AND json_extract(payload, '$.wanted_iso') = ? ORDER BY id",
+            (wanted_ts - 15 * 60 - REMINDER_SPREAD_SEC - 1, wanted_ts, store_id, wanted_iso)).fetchall()
+    bookings = []
+    for row in rows:
+        p = json.loads(row["payload"] or "{}")
+        req = REQUESTS.get(row["req_id"])
+        if req is not None and not req.get("confirmed"):
+            continue
+        bookings.append(dict(p, req_id=row["req_id"]))
+    return bookings
+
+
+def _run_store_digest_job(job):
+    p = job["payload"]
+    st = STORE_BY_ID.get(p.get("store_id"))
+    if not st:
+        return "skipped"
+    bookings = _slot_bookings(p["store_id"], p["wanted_iso"])
+    if p.get("only"):
+        bookings = [b for b in bookings if b["req_id"] == p["only"]]
+    if not bookings:
+        return "skipped"
+    wait = take_reminder_send()
+    if wait:
+        return ("defer", wait)
+    send_store_digest(st, p["wanted_iso"], bookings)
+    log_event("store_digest", store=st["store_id"], bookings=len(bookings), wanted=p["wanted_iso"])
+    return "done"
+
+
+def send_store_digest(st, wanted_iso, bookings):
+    """同じ時刻の予約を1通にまとめて店舗へ（誰の予約か分かる詳細＋外国人フラグ）"""
+    tstr = datetime.datetime.fromisoformat(wanted_iso).astimezone(JST).strftime("%H:%M")
+    lines = [tr("store.digest_head", time=tstr, count=len(bookings),
+                pax=sum(int(b.get("pax") or 0) for b in bookings))]
+    for b in bookings:
+        lines.append(tr("store.digest_line", name=b.get("name") or "-", phone=b.get("phone") or "-",
+                        pax=b.get("pax"), pickup=pickup_label("jp", b.get("pickup")), hotel=store_hotel_label(b),
+                        foreign=foreign_hint(b.get("lang"), short=True)))
+    safe_push(st["line_user_id"], TextSendMessage("\n".join(lines)), st["name"], path="reminder.store")
+
+
+# kind -> (実行関数, 期限切れなら True を返す判定)。判定が None のものは遅れても実行する
+JOB_KINDS = {
+    "timeout": (_run_timeout_job, None),
+    "reminder": (_run_reminder_job, _reminder_overdue),
+    "store_digest": (_run_store_digest_job, _reminder_overdue),
+}
 
 
 # ====== Webhook ======
@@ -484,123 +1548,691 @@ def webhook():
     # POST のみ LINE SDK で処理
     signature = request.headers.get("X-Line-Signature", "")
     body = request.get_data(as_text=True)
+    wait_stores_ready()
+    t0 = time.perf_counter()
     try:
-        handler.handle(body, signature)
+        handle_webhook_body(body, signature)
     except InvalidSignatureError:
         # 署名不一致でも 200 返し（Verify を通しやすくする）
         return "OK", 200
+    if WEBHOOK_RECORD_PATH:
+        record_webhook(body, (time.perf_counter() - t0) * 1000)
 
     return "OK"
 
 
-# Web サーバ時刻の確認用（JST とウィンドウ判定を可視化）
-@app.route("/admin/timecheck")
-def admin_timecheck():
-    t = now_jst()
-    return {
-        "now_jst": t.isoformat(),
-        "service_state": service_window_state(t),
-        "note": "JST基準。state=before16/inside/after22"
-    }
+# ====== プロファイラ（遅い webhook の内訳を調べる） ======
+# /admin/profiler?token=...&mode=sample&rate=0.05   … 指定割合の webhook を cProfile で計測
+# /admin/profiler?token=...&mode=slow&slow_ms=500   … 全 webhook をスタックサンプリングし、遅かったものだけ残す
+# /admin/profiler?token=...&mode=off                … 停止（既定。webhook ごとの追加処理は mode の確認1回だけ）
+# 直近 PROFILE_KEEP 件を /admin/profiler/<id>?token=... でダウンロード（sample は .prof、slow は folded 形式）。
+# &format=text で上位の関数を文字で見られる。
+PROFILE_KEEP = int(_env("PROFILE_KEEP", "20"))
+PROFILE_SAMPLE_INTERVAL = 0.005   # slow モードのスタック採取間隔（秒）
+PROFILER = {"mode": "off", "rate": 0.05, "slow_ms": 500.0}
+PROFILES = collections.deque(maxlen=PROFILE_KEEP)
+_PROFILE_LOCK = threading.Lock()      # cProfile は同時に1つだけ
+_SAMPLING = {}                        # thread id -> {"stacks": {folded: count}}
+_SAMPLER = {"thread": None}
 
 
-# ★ここから追加：起動ワードのゆらぎ吸収ユーティリティ
-def _norm(s: str) -> str:
-    # 全角/半角・大文字小文字・前後空白を吸収
-    return unicodedata.normalize("NFKC", (s or "")).strip().lower()
+def _webhook_kinds(body: str) -> str:
+    try:
+        return ",".join(ev.get("type", "?") for ev in json.loads(body).get("events") or [])
+    except ValueError:
+        return ""
 
-def is_start_trigger(text: str) -> bool:
-    s = _norm(text)
-    if s in {"予約をはじめる","予約する","予約をする","start reservation","reserve",
-             "予約/reserve","予約する/reserve","予約 / reserve","予約する / reserve"}:
-        return True
-    if "予約" in s and ("reserve" in s or "reservation" in s):
-        return True
-    return False
 
+def _keep_profile(fmt, ms, body, data):
+    PROFILES.append({"id": os.urandom(4).hex(), "at": now_jst().isoformat(), "format": fmt,
+                     "ms": round(ms, 1), "events": _webhook_kinds(body), "data": data})
 
-    
-    # 日英併記や区切り文字の違いを許容
-    if "予約" in s and ("reserve" in s or "reservation" in s):
-        return True
-    return False
-# ★追加ここまで
 
-@handler.add(MessageEvent, message=TextMessage)
-def on_text(event: MessageEvent):
-    user_id = event.source.user_id
-    text = (event.message.text or "").strip()
+def _folded_stack(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
 
-    # ★暫定：店舗登録
-    m = re.match(r"^店舗登録(?:\s+|　)(.+)$", text)
-    if m:
-        store_name = m.group(1).strip() or "未入力"
-        print(f"[STORE_REG] {store_name}: {user_id}")
-        reply_or_push(
-            user_id, event.reply_token,
-            TextSendMessage(f"店舗登録OK：{store_name}\nこのIDを運営に送ってください：\n{user_id}")
-        )
-        return
 
-    # 5+ の数値入力待ち
-    if SESS.get(user_id, {}).get("await") == "pax_number":
-        m = re.match(r"^\d{1,2}$", text)
-        if not m:
-            reply_or_push(user_id, event.reply_token, TextSendMessage("人数を数字で入力してください（例：6）"))
-            return
-        SESS[user_id]["pax"] = int(text)
-        SESS[user_id].pop("await", None)
-        ask_pickup(event.reply_token, SESS[user_id]["lang"], user_id)
+def _sampler_loop():
+    while PROFILER["mode"] == "slow":
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+        if not _SAMPLING:
+            continue
+        frames = sys._current_frames()
+        for tid, st in list(_SAMPLING.items()):
+            f = frames.get(tid)
+            if f is not None:
+                key = _folded_stack(f)
+                st["stacks"][key] = st["stacks"].get(key, 0) + 1
+    _SAMPLER["thread"] = None
+
+
+def handle_webhook_body(body: str, signature: str):
+    """署名検証とイベント処理（プロファイラが有効なら計測）"""
+    mode = PROFILER["mode"]
+    if mode == "off":
+        handler.handle(body, signature)
         return
 
-    # ホテル名入力待ち（任意）→ 入力後に照会前の確認へ
-    if SESS.get(user_id, {}).get("await") == "hotel_name":
-        SESS[user_id]["hotel"] = text
-        SESS[user_id].pop("await", None)
-                # ★編集モードなら解除して確認へ
-        if SESS.get(user_id, {}).get("edit_mode") == "hotel":
-            SESS[user_id].pop("edit_mode", None)
-            ask_confirm(event.reply_token, user_id)
+    if mode == "sample":
+        if random.random() >= PROFILER["rate"] or not _PROFILE_LOCK.acquire(blocking=False):
+            handler.handle(body, signature)
             return
-
-        ask_confirm(event.reply_token, user_id)
+        prof = cProfile.Profile()
+        t0 = time.perf_counter()
+        try:
+            prof.enable()
+            try:
+                handler.handle(body, signature)
+            finally:
+                prof.disable()
+        finally:
+            _PROFILE_LOCK.release()
+        prof.create_stats()
+        _keep_profile("pstats", (time.perf_counter() - t0) * 1000, body, marshal.dumps(prof.stats))
         return
 
-# 起動ワード（常に最初からやり直し）
-    if is_start_trigger(text):
-        SESS[user_id] = {}
-        PENDING_BOOK.pop(user_id, None)  # ★追加：途中までの予約入力も破棄
-        ask_lang(event.reply_token, user_id)
-        return
+    # slow: サンプラー用スレッドが採ったスタックを、遅かった場合だけ残す
+    tid = threading.get_ident()
+    st = _SAMPLING[tid] = {"stacks": {}}
+    t0 = time.perf_counter()
+    try:
+        handler.handle(body, signature)
+    finally:
+        _SAMPLING.pop(tid, None)
+        ms = (time.perf_counter() - t0) * 1000
+        if ms >= PROFILER["slow_ms"]:
+            folded = "\n".join(f"{k} {v}" for k, v in sorted(st["stacks"].items()))
+            _keep_profile("folded", ms, body, folded)
 
 
-    # 予約フロー：氏名→電話→編集
-    if user_id in PENDING_BOOK:
-        pb   = PENDING_BOOK[user_id]
-        lang = SESS.get(user_id, {}).get("lang", "jp")
+class _LoadedStats:
+    """保存済み（marshal）の統計を pstats.Stats に渡すための入れ物"""
+    def __init__(self, data: bytes):
+        self.stats = marshal.loads(data)
+
+    def create_stats(self):
+        pass
+
+
+def _profile_summary(p):
+    return {k: p[k] for k in ("id", "at", "format", "ms", "events")}
+
+
+@app.route("/admin/profiler")
+def admin_profiler():
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    mode = request.args.get("mode")
+    if mode:
+        if mode not in ("off", "sample", "slow"):
+            return {"error": "mode must be off / sample / slow"}, 400
+        try:
+            if "rate" in request.args:
+                PROFILER["rate"] = min(max(float(request.args["rate"]), 0.0), 1.0)
+            if "slow_ms" in request.args:
+                PROFILER["slow_ms"] = max(float(request.args["slow_ms"]), 0.0)
+        except ValueError:
+            return {"error": "rate / slow_ms must be numbers"}, 400
+        PROFILER["mode"] = mode
+        if mode == "slow" and _SAMPLER["thread"] is None:
+            _SAMPLER["thread"] = threading.Thread(target=_sampler_loop, name="profiler-sampler", daemon=True)
+            _SAMPLER["thread"].start()
+        print(f"[PROFILER] mode={mode} rate={PROFILER['rate']} slow_ms={PROFILER['slow_ms']}")
+    return {**PROFILER, "keep": PROFILE_KEEP, "profiles": [_profile_summary(p) for p in reversed(PROFILES)]}
+
+
+@app.route("/admin/profiler/<pid>")
+def admin_profiler_download(pid):
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    p = next((x for x in list(PROFILES) if x["id"] == pid), None)
+    if not p:
+        return abort(404)
+    if p["format"] == "folded":
+        return Response(p["data"], mimetype="text/plain",
+                        headers={"Content-Disposition": f"attachment; filename=profile-{pid}.folded"})
+    if request.args.get("format") == "text":
+        out = io.StringIO()
+        pstats.Stats(_LoadedStats(p["data"]), stream=out).sort_stats("cumulative").print_stats(40)
+        return Response(out.getvalue(), mimetype="text/plain")
+    return Response(p["data"], mimetype="application/octet-stream",
+                    headers={"Content-Disposition": f"attachment; filename=profile-{pid}.prof"})
+
+
+# ====== webhook の記録（replay.py で再生して回帰・性能を比べる） ======
+# WEBHOOK_RECORD_PATH を指定したときだけ、署名の通った webhook 本文を1行1件で追記する。
+# お客さまの userId は user_key() の仮名に置き換える（店舗のIDは再生で店舗として扱えるよう残す）。
+# メッセージ本文（氏名・電話など）はそのまま残るので、記録ファイルの扱いに注意。
+WEBHOOK_RECORD_PATH = _env("WEBHOOK_RECORD_PATH", "")
+_RECORD_LOCK = threading.Lock()
+
+
+def _pseudonymize_sources(data):
+    for ev in data.get("events") or []:
+        src = ev.get("source") or {}
+        for k in ("userId", "groupId", "roomId"):
+            v = src.get(k)
+            if v and v not in STORE_BY_UID:
+                src[k] = "U" + user_key(v)
+    return data
+
+
+def record_webhook(body: str, handled_ms: float):
+    try:
+        data = _pseudonymize_sources(json.loads(body))
+    except ValueError:
+        return
+    line = json.dumps({"t": round(now_jst().timestamp(), 3), "ms": round(handled_ms, 2), "body": data},
+                      ensure_ascii=False, separators=(",", ":"))
+    try:
+        with _RECORD_LOCK, open(WEBHOOK_RECORD_PATH, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print("[RECORD] write failed:", e)
+
+
+# ジョブ実行スレッドは各ワーカーで1本（gunicorn の preload で fork された後も起動する）
+@app.before_request
+def _ensure_job_runner():
+    ensure_job_runner()
+
+
+# 送信回数（reply / push）をコード経路ごとに確認
+@app.route("/admin/outbound_stats")
+def admin_outbound_stats():
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    with _OUTBOUND_LOCK:
+        paths = {k: dict(v) for k, v in OUTBOUND_STATS.items()}
+    totals = {k: sum(v[k] for v in paths.values()) for k in ("reply", "push", "fallback", "fail")}
+    return {"totals": totals, "paths": paths}
+
+
+# 混雑度と、優先度ごとの受付・後回し・強制送信の回数
+@app.route("/admin/load")
+def admin_load():
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    level = load_level()
+    with _LOAD_LOCK:
+        load = dict(LOAD, level=level, latency_ms=round(LOAD["latency_ms"], 1))
+        stats = {k: dict(v) for k, v in ADMISSION_STATS.items()}
+    limits = {"queue": [ADMIT_QUEUE_SOFT, ADMIT_QUEUE_HARD], "latency_ms": [ADMIT_LATENCY_SOFT_MS, ADMIT_LATENCY_HARD_MS],
+              "retry_sec": ADMIT_RETRY_SEC, "max_defer_sec": ADMIT_MAX_DEFER_SEC}
+    return {"load": load, "limits": limits, "admission": stats}
+
+
+# 店舗への配信の健全性（既定は隔離中の店だけ。all=1 で記録のある全店、release=<store_id> で隔離を解く）
+@app.route("/admin/delivery")
+def admin_delivery():
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    release = request.args.get("release", "").strip()
+    if release:
+        store = STORE_BY_ID.get(release)
+        if not store:
+            return {"error": f"unknown store: {release}"}, 404
+        released = release_delivery(store["line_user_id"])
+        print(f"[DELIVERY] {release} released by admin (was_quarantined={released})")
+        return {"store_id": release, "released": released}
+    show_all = request.args.get("all") == "1"
+    ts = lambda t: datetime.datetime.fromtimestamp(t, JST).isoformat() if t else None
+    with _DELIVERY_LOCK:
+        health = [(uid, dict(h, codes=dict(h["codes"]))) for uid, h in DELIVERY.items()]
+    stores = []
+    for uid, h in health:
+        if not show_all and h["quarantined"] is None:
+            continue
+        st = STORE_BY_UID.get(uid) or {}
+        stores.append({"store_id": st.get("store_id"), "name": st.get("name"), "fails": h["fails"],
+                       "permanent": h["permanent"], "codes": h["codes"], "last_ok": ts(h["last_ok"]),
+                       "last_fail": ts(h["last_fail"]), "quarantined": ts(h["quarantined"]),
+                       "next_probe": ts(h["next_probe"])})
+    return {"quarantined": sum(1 for _, h in health if h["quarantined"] is not None),
+            "quarantine_after": DELIVERY_QUARANTINE_AFTER, "probe_sec": DELIVERY_PROBE_SEC, "stores": stores}
+
+
+# ====== 照会・予約の NDJSON エクスポート（運用確認用） ======
+# /admin/requests?token=...&date=YYYY-MM-DD&status=open|closed|confirmed&store_id=ST1&limit=500&cursor=REQ-...
+# 1行1件で逐次書き出す（全件を組み立ててから返さない）。limit 件に達したら最後の行に
+# {"next_cursor": "..."} を付けるので、次は cursor にその値を渡す。
+# date は来店希望日（wanted_iso の日付）、store_id は照会・回答・確定のどれかに関わった店。
+EXPORT_LIMIT_DEFAULT = 500
+EXPORT_LIMIT_MAX = 5000
+
+
+def _request_status(req) -> str:
+    if req.get("confirmed"):
+        return "confirmed"
+    return "closed" if req.get("closed") else "open"
+
+
+def _request_stores(req) -> set:
+    ids = set(req.get("candidates") or ()) | set(req.get("pushed_at") or ()) | set(req.get("replied") or ())
+    if req.get("store_id"):
+        ids.add(req["store_id"])
+    return ids
+
+
+def _export_value(v):
+    if isinstance(v, datetime.datetime):
+        return v.isoformat()
+    if isinstance(v, (set, frozenset)):
+        return sorted(v)
+    if isinstance(v, dict):
+        return {k: _export_value(x) for k, x in v.items()}
+    return v
+
+
+def export_request(req_id, req) -> dict:
+    row = {"req_id": req_id, "status": _request_status(req)}
+    for k in ("user_id", "wanted_iso", "slots", "pax", "pickup", "hotel", "pickup_point", "deadline",
+              "candidates", "replied", "pushed_at", "store_id", "name", "phone"):
+        if k in req:
+            row[k] = _export_value(req[k])
+    return row
+
+
+def iter_requests(date=None, status=None, store_id=None, cursor=None):
+    """条件に合う (req_id, req) を作成順に返す。キーだけ先に写すので、走査中の追加・更新でも落ちない"""
+    for req_id in list(REQUESTS):
+        if cursor and req_id <= cursor:
+            continue
+        req = REQUESTS.get(req_id)
+        if req is None:
+            continue
+        if status and _request_status(req) != status:
+            continue
+        if date and not (req.get("wanted_iso") or "").startswith(date):
+            continue
+        if store_id and store_id not in _request_stores(req):
+            continue
+        yield req_id, req
+
+
+@app.route("/admin/requests")
+def admin_requests():
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    status = request.args.get("status") or None
+    if status and status not in ("open", "closed", "confirmed"):
+        return {"error": "status must be open / closed / confirmed"}, 400
+    date = request.args.get("date") or None
+    if date and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", date):
+        return {"error": "date must be YYYY-MM-DD"}, 400
+    try:
+        limit = min(int(request.args.get("limit", EXPORT_LIMIT_DEFAULT)), EXPORT_LIMIT_MAX)
+    except ValueError:
+        return {"error": "limit must be an integer"}, 400
+    rows = iter_requests(date=date, status=status,
+                         store_id=request.args.get("store_id") or None,
+                         cursor=request.args.get("cursor") or None)
+
+    def generate():
+        n, last = 0, None
+        for req_id, req in rows:
+            if n >= limit:
+                yield json.dumps({"next_cursor": last}) + "\n"
+                return
+            yield json.dumps(export_request(req_id, req), ensure_ascii=False) + "\n"
+            n, last = n + 1, req_id
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+# 照会1件のトレース（直近 TRACE_KEEP 件。開始からの経過 ms 順）
+@app.route("/admin/trace/<req_id>")
+def admin_trace(req_id):
+    token = request.args.get("token", "")
+    if not STORES_RELOAD_TOKEN or token != STORES_RELOAD_TOKEN:
+        return abort(403)
+    with _TRACE_LOCK:
+        spans = list(RECENT_TRACES.get(req_id, []))
+    if not spans:
+        return abort(404)
+    t0 = min(int(sp["startTimeUnixNano"]) for sp in spans)
+    rows = []
+    for sp in sorted(spans, key=lambda x: int(x["startTimeUnixNano"])):
+        start, end = int(sp["startTimeUnixNano"]), int(sp["endTimeUnixNano"])
+        rows.append({"name": sp["name"], "at_ms": round((start - t0) / 1e6, 1), "ms": round((end - start) / 1e6, 1),
+                     "ok": sp["status"]["code"] != 2,
+                     "attrs": {a["key"]: _plain_value(a["value"]) for a in sp["attributes"]}})
+    return {"req_id": req_id, "trace_id": _trace_id(req_id), "spans": rows}
+
+
+# Web サーバ時刻の確認用（JST とウィンドウ判定を可視化）
+@app.route("/admin/timecheck")
+def admin_timecheck():
+    t = now_jst()
+    return {
+        "now_jst": t.isoformat(),
+        "service_state": service_window_state(t),
+        "note": "JST基準。state=before16/inside/after22"
+    }
+
+
+# ★ここから追加：起動ワードのゆらぎ吸収ユーティリティ
+def _norm(s: str) -> str:
+    # 全角/半角・大文字小文字・前後空白を吸収
+    return unicodedata.normalize("NFKC", (s or "")).strip().lower()
+
+
+# ====== 自由入力のインテント判定（完全一致は辞書、部分一致は Aho–Corasick で1パス照合） ======
+# mode: "exact"    … 全文一致（dict で O(1)）
+#       "prefix"   … 先頭一致
+#       "contains" … 部分一致（かな・漢字・ハングルなど、誤爆しにくい語だけ）
+#       "word"     … 部分一致だが前後が英字でないこと（"help me" は当たり "helper" は外れ）
+# 照合は _norm 済みの文字列に対して行うので、キーワードも小文字・半角で書く。
+# "book" / "stop" のような一語の英単語は、氏名入力などを誤って奪うので入れない。
+INTENT_KEYWORDS = {
+    "register": [
+        ("店舗登録", "prefix"),
+        ("store registration", "prefix"), ("register store", "prefix"),
+        ("店铺注册", "prefix"), ("商家注册", "prefix"),
+        ("店鋪登錄", "prefix"), ("商家登錄", "prefix"),
+        ("매장등록", "prefix"), ("매장 등록", "prefix"), ("가게등록", "prefix"),
+    ],
+    "cancel": [
+        ("キャンセル", "contains"), ("取り消", "contains"), ("取消", "contains"), ("취소", "contains"),
+        ("cancel", "word"),
+        ("やめる", "exact"), ("やめます", "exact"), ("中止", "exact"), ("그만", "exact"),
+    ],
+    "help": [
+        ("ヘルプ", "contains"), ("使い方", "contains"), ("帮助", "contains"), ("幫助", "contains"),
+        ("도움말", "contains"), ("사용법", "contains"),
+        ("help", "word"), ("how to use", "word"),
+        ("助けて", "exact"), ("?", "exact"), ("说明", "exact"), ("說明", "exact"), ("도움", "exact"),
+    ],
+    "start": [
+        # 日本語
+        ("予約をはじめる", "exact"), ("予約する", "exact"), ("予約をする", "exact"),
+        ("予約", "exact"), ("予約したい", "exact"),
+        ("予約/reserve", "exact"), ("予約する/reserve", "exact"),
+        ("予約 / reserve", "exact"), ("予約する / reserve", "exact"),
+        # English
+        ("start reservation", "exact"), ("reserve", "exact"), ("reservation", "exact"),
+        ("book a table", "exact"), ("make a reservation", "exact"),
+        # 中文（簡体／繁体）
+        ("预约", "exact"), ("预订", "exact"), ("我要预约", "exact"), ("订位", "exact"),
+        ("預約", "exact"), ("預訂", "exact"), ("我要預約", "exact"), ("訂位", "exact"),
+        # 한국어
+        ("예약", "exact"), ("예약하기", "exact"), ("예약할게요", "exact"), ("예약하고 싶어요", "exact"),
+    ],
+    # 店舗向け：今夜の空き枠の申告（店舗LINE ID からのときだけ有効）
+    "availability": [
+        ("空き", "prefix"), ("空席", "prefix"), ("availability", "prefix"), ("open slots", "prefix"),
+        ("空位", "prefix"), ("빈자리", "prefix"),
+        ("満席", "exact"), ("full", "exact"), ("满座", "exact"), ("滿座", "exact"), ("만석", "exact"),
+    ],
+    # 店舗向け：未回答の照会の一覧（店舗LINE ID からのときだけ有効）
+    "inbox": [
+        ("照会一覧", "exact"), ("照会", "exact"), ("未回答", "exact"), ("一覧", "exact"), ("inbox", "exact"),
+    ],
+}
+
+# 日英併記（リッチメニュー「予約 / Reserve」など）は区切り文字が揺れるので、
+# 両方の語が含まれていれば起動ワードとみなす（従来の is_start_trigger と同じ条件）
+INTENT_COMBOS = [
+    ("start", ("予約",), ("reserve", "reservation")),
+]
+
+# 同時に当たったときの優先順位（小さいほど優先）。
+# 「予約をキャンセル」は cancel、「予約の使い方」は help になる
+INTENT_PRIORITY = {"register": 0, "cancel": 1, "help": 2, "start": 3, "availability": 4, "inbox": 5}
+
+
+def _build_intent_automaton(keywords, combos):
+    """
+    キーワード表から照合テーブルを作る（起動時に1回だけ）。
+    exact は dict、それ以外は fail 遷移を畳み込んだ Aho–Corasick の DFA にする。
+    """
+    exact = {}
+    goto = [{}]      # state -> {char: next_state}（トライ）
+    fail = [0]
+    out = [()]       # state -> ((phrase, intent, mode, priority), ...)
+
+    def _add(phrase, payload):
+        state = 0
+        for ch in phrase:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = len(goto)
+                goto[state][ch] = nxt
+                goto.append({})
+                fail.append(0)
+                out.append(())
+            state = nxt
+        out[state] += (payload,)
+
+    for intent, items in keywords.items():
+        prio = INTENT_PRIORITY.get(intent, 99)
+        for phrase, mode in items:
+            if mode == "exact":
+                exact.setdefault(phrase, (intent, phrase))
+            else:
+                _add(phrase, (phrase, intent, mode, prio))
+    for intent, left, right in combos:
+        for phrase in (*left, *right):
+            _add(phrase, (phrase, intent, "combo", INTENT_PRIORITY.get(intent, 99)))
+
+    # BFS で fail を求め、fail 先の遷移と出力を畳み込んで DFA にする
+    delta = [None] * len(goto)
+    delta[0] = dict(goto[0])
+    queue = list(goto[0].values())
+    head = 0
+    while head < len(queue):
+        state = queue[head]
+        head += 1
+        delta[state] = {**delta[fail[state]], **goto[state]}
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            out[nxt] = out[nxt] + out[fail[nxt]]
+    return exact, delta, out
+
+
+_INTENT_EXACT, _INTENT_DELTA, _INTENT_OUT = _build_intent_automaton(INTENT_KEYWORDS, INTENT_COMBOS)
+
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+def route_intent(text: str):
+    """
+    自由入力からインテントを判定する。
+    戻り値: (intent, hit) … intent は register/cancel/help/start/availability/None、
+            hit は (start, end, phrase) か None（日英併記の組み合わせ一致）
+    """
+    s = _norm(text)
+    if not s:
+        return None, None
+    found = _INTENT_EXACT.get(s)
+    if found:
+        return found[0], (0, len(s), found[1])
+
+    delta, out = _INTENT_DELTA, _INTENT_OUT
+    state = 0
+    best = None       # (priority, intent, hit)
+    combo_seen = None
+    for i, ch in enumerate(s):
+        state = delta[state].get(ch, 0)
+        if not out[state]:
+            continue
+        end = i + 1
+        for phrase, intent, mode, prio in out[state]:
+            if best is not None and prio >= best[0] and mode != "combo":
+                continue
+            start = end - len(phrase)
+            if mode == "prefix":
+                if start != 0:
+                    continue
+            elif mode == "word":
+                if (start and _is_word_char(s[start - 1])) or (end < len(s) and _is_word_char(s[end])):
+                    continue
+            elif mode == "combo":
+                combo_seen = combo_seen or set()
+                combo_seen.add(phrase)
+                continue
+            best = (prio, intent, (start, end, phrase))
+
+    if combo_seen:
+        for intent, left, right in INTENT_COMBOS:
+            prio = INTENT_PRIORITY.get(intent, 99)
+            if (best is None or prio < best[0]) and combo_seen.intersection(left) and combo_seen.intersection(right):
+                best = (prio, intent, None)
+
+    if best is None:
+        return None, None
+    return best[1], best[2]
+
+
+def is_start_trigger(text: str) -> bool:
+    return route_intent(text)[0] == "start"
+
+
+def _register_store_name(text: str, hit):
+    """店舗登録キーワードの後ろ（区切りの空白必須）を店舗名として取り出す"""
+    raw = unicodedata.normalize("NFKC", text or "").strip()
+    end = hit[1]
+    if not raw[end:end + 1].isspace():
+        return None
+    return raw[end:].strip() or "未入力"
+# ★追加ここまで
+
+def handle_text_intent(event, user_id, text, intent, hit) -> bool:
+    """
+    route_intent の結果を処理する（処理したら True）。
+    入力待ち（人数・ホテル名・氏名・電話）の途中でも効くよう、on_text の先頭で呼ぶ。
+    優先順位は INTENT_PRIORITY（店舗登録 > 取り消し > ヘルプ > 起動 > 空き枠 > 照会一覧）。
+    """
+    # ★暫定：店舗登録
+    if intent == "register":
+        store_name = _register_store_name(text, hit)
+        if store_name is None:
+            return False
+        print(f"[STORE_REG] {store_name}: {user_id}")
+        reply_or_push(
+            user_id, event.reply_token,
+            TextSendMessage(f"店舗登録OK：{store_name}\nこのIDを運営に送ってください：\n{user_id}")
+        )
+        return True
+
+    # 店舗からの空き枠申告（お客さまの入力なら通常処理へ）
+    if intent == "availability":
+        if user_id not in STORE_BY_UID:
+            return False
+        on_store_availability_text(event.reply_token, STORE_BY_UID[user_id], text, hit)
+        return True
+
+    # 店舗からの未回答一覧の呼び出し
+    if intent == "inbox":
+        if user_id not in STORE_BY_UID:
+            return False
+        send_store_inbox(STORE_BY_UID[user_id], reply_token=event.reply_token)
+        return True
+
+    # 取り消し：入力途中の内容と、未確定の照会を破棄
+    if intent == "cancel":
+        lang = SESS.get(user_id, {}).get("lang")
+        req_id = SESS.get(user_id, {}).get("req_id")
+        req = REQUESTS.get(req_id)
+        if req and not req.get("confirmed"):
+            req["closed"] = True
+            req["cancelled"] = True
+            release_availability_holds(req_id)
+            end_booking_trace(req_id, "cancelled")
+        log_event("cancel", req_id if req else None, user_id)
+        SESS[user_id] = {}
+        PENDING_BOOK.pop(user_id, None)
+        reply_or_push(user_id, event.reply_token,
+                      TextSendMessage(tr("guide.cancelled", lang) if lang else tr_bi("guide.cancelled")))
+        return True
+
+    # ヘルプ：入力待ちの状態はそのまま残す
+    if intent == "help":
+        lang = SESS.get(user_id, {}).get("lang")
+        key = "guide.help_in_step" if SESS.get(user_id, {}).get("await") or user_id in PENDING_BOOK else "guide.help"
+        reply_or_push(user_id, event.reply_token, TextSendMessage(tr(key, lang) if lang else tr_bi(key)))
+        return True
+
+    # 起動ワード（常に最初からやり直し）
+    if intent == "start":
+        SESS[user_id] = {}
+        PENDING_BOOK.pop(user_id, None)  # ★追加：途中までの予約入力も破棄
+        ask_lang(event.reply_token, user_id)
+        return True
+
+    return False
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def on_text(event: MessageEvent):
+    note_reply_token(event)
+    user_id = event.source.user_id
+    text = (event.message.text or "").strip()
+    # 自由入力のインテント（店舗登録・空き枠・取り消し・ヘルプ・起動）は入力待ちより先に処理
+    intent, hit = route_intent(text)
+    if intent and handle_text_intent(event, user_id, text, intent, hit):
+        return
+
+    # 5+ の数値入力待ち
+    if SESS.get(user_id, {}).get("await") == "pax_number":
+        m = _PAX_NUMBER_RE.match(text)
+        if not m:
+            reply_or_push(user_id, event.reply_token, TextSendMessage("人数を数字で入力してください（例：6）"))
+            return
+        SESS[user_id]["pax"] = int(text)
+        SESS[user_id].pop("await", None)
+        ask_pickup(event.reply_token, SESS[user_id]["lang"], user_id)
+        return
+
+    # ホテル名入力待ち（任意）→ 名簿で正式名に直して照会前の確認へ（近い名前があれば「もしかして」）
+    if SESS.get(user_id, {}).get("await") == "hotel_name":
+        sess = SESS[user_id]
+        sess.pop("await", None)
+        hotel = HOTEL_INDEX.lookup(text)
+        sess["hotel"] = hotel.name if hotel else text
+        sess["pickup_point"] = hotel.pickup_point if hotel else ""
+        if not hotel:
+            suggestions = HOTEL_INDEX.suggest(text, HOTEL_SUGGEST_MAX, HOTEL_SUGGEST_MIN_SCORE)
+            if suggestions:
+                ask_hotel_pick(event.reply_token, sess.get("lang", "jp"), user_id, text, [h for _, h in suggestions])
+                return
+        after_hotel(event.reply_token, user_id)
+        return
+
+    # 予約フロー：氏名→電話→編集
+    if user_id in PENDING_BOOK:
+        pb   = PENDING_BOOK[user_id]
+        lang = SESS.get(user_id, {}).get("lang", "jp")
 
         # --- 1) 氏名入力直後：電話を促す ---
         if pb["step"] == "name":
             PENDING_BOOK[user_id]["name"] = (text or "").strip()
             PENDING_BOOK[user_id]["step"] = "phone"
-            msg = (
-                "電話番号を入力してください（例：07012345678）"
-                if lang == "jp"
-                else "Please enter your phone number with country code (e.g., +81 7012345678)."
-            )
-            reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.ask_phone", lang)))
             return
 
         # --- 2) 電話番号の入力・検証 ---
         elif pb["step"] == "phone":
             t = (text or "").strip()
             if not _valid_phone(t, lang):
-                msg = (
-                    "電話番号の形式で入力してください（例：07012345678）"
-                    if lang == "jp"
-                    else "Please enter a valid number (e.g., +81 7012345678)."
-                )
-                reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+                reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.bad_phone", lang)))
                 return
             PENDING_BOOK[user_id]["phone"] = _clean_phone(t)
             PENDING_BOOK[user_id]["step"]  = "idle"
@@ -618,12 +2250,7 @@ def on_text(event: MessageEvent):
         elif pb["step"] == "edit_phone":
             t = (text or "").strip()
             if not _valid_phone(t, lang):
-                msg = (
-                    "電話番号の形式で入力してください（例：07012345678）"
-                    if lang == "jp"
-                    else "Please enter a valid number (e.g., +81 7012345678)."
-                )
-                reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+                reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.bad_phone", lang)))
                 return
             PENDING_BOOK[user_id]["phone"] = _clean_phone(t)
             PENDING_BOOK[user_id]["step"]  = "idle"
@@ -633,31 +2260,24 @@ def on_text(event: MessageEvent):
             
             t = (text or "").strip()
             if not _valid_phone(t, lang):
-                if lang == "en":
-                    reply_or_push(
-                        user_id, event.reply_token,
-                        TextSendMessage("Please enter a valid phone number with country code (e.g., +81 7012345678).")
-                    )
-                else:
-                    reply_or_push(
-                        user_id, event.reply_token,
-                        TextSendMessage("電話番号の形式で入力してください（例：07012345678）")
-                    )
+                reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.bad_phone", lang)))
                 return
             PENDING_BOOK[user_id]["phone"] = _clean_phone(t)
             # 氏名・電話まで揃ったので最終予約確認へ
             ask_booking_confirm(event.reply_token, user_id)
             return
 
-    # デフォルト応答
+    # デフォルト応答（言語未選択なら日英併記）
+    lang = SESS.get(user_id, {}).get("lang")
     reply_or_push(
         user_id, event.reply_token,
-        TextSendMessage("下のリッチメニュー「予約 / Reserve」を押して開始してください。")
+        TextSendMessage(tr("guide.start", lang) if lang else tr_bi("guide.start"))
     )
 
 # ====== 受付：ポストバック ======
 @handler.add(PostbackEvent)
 def on_postback(event: PostbackEvent):
+    note_reply_token(event)
     user_id = event.source.user_id
     try:
         data = json.loads(event.postback.data or "{}")
@@ -680,34 +2300,75 @@ def on_postback(event: PostbackEvent):
             # 店舗以外が押したら無視
             return
 
+        # 応答傾向を記録（1照会につき1回。締切後の返信も返信時間として学習する）
+        replied = req.setdefault("replied", {})
+        pushed_at = req.get("pushed_at", {}).get(store_id)
+        if store_id not in replied and pushed_at:
+            replied[store_id] = status
+            lat = (now_jst() - pushed_at).total_seconds()
+            record_store_reply(store_id, status == "ok", lat)
+            emit_span(req_id, "store_wait", req.get("pushed_ns", {}).get(store_id, time.time_ns()), time.time_ns(),
+                      parent_id=_root_span_id(req_id), attrs={"store": store_id, "status": status})
+            log_event("store_reply", req_id, store=store_id, status=status, lat=round(lat, 1),
+                      late=bool(now_jst() > req["deadline"] or req.get("closed")))
+
         # 受付終了 or クローズ
         if now_jst() > req["deadline"] or req.get("closed"):
-            safe_push(event.source.user_id, TextSendMessage("受付は終了しました（すでにマッチング済みです）。"))
+            reply_or_push(user_id, event.reply_token,
+                          TextSendMessage("受付は終了しました（すでにマッチング済みです）。"), path="store_reply.ack")
             return
 
         if status == "ok":
             # 同一店舗の重複は1回だけ
             if store_id in req["candidates"]:
-                safe_push(event.source.user_id, TextSendMessage("すでに送信済みです。ありがとうございます。"))
+                reply_or_push(user_id, event.reply_token,
+                              TextSendMessage("すでに送信済みです。ありがとうございます。"), path="store_reply.ack")
                 return
 
             req["candidates"].add(store_id)
-            # 店舗へ受領メッセージ
-            safe_push(event.source.user_id, TextSendMessage("ありがとうございます。お客様へご案内しました。"))
+            iso = data.get("iso")
+            req.setdefault("slot_by_store", {})[store_id] = iso if iso in wanted_slots(req) else req["wanted_iso"]
+            # 店舗へ受領メッセージ（押された reply トークンで返すので無料）
+            reply_or_push(user_id, event.reply_token,
+                          TextSendMessage("ありがとうございます。お客様へご案内しました。"), path="store_reply.ack")
 
-            # ユーザーへ候補カード
+            # ユーザーへ候補カード（短い窓内の OK はまとめて1枚のカルーセルに）
             if store:
-                lang = SESS.get(req["user_id"], {}).get("lang", "jp")
-                bubble = candidate_bubble(store, lang)
-                line_bot_api.push_message(
-                    req["user_id"],
-                    FlexSendMessage(alt_text="候補が届きました / New option available", contents=bubble)
-                )
+                queue_candidate_card(req_id, store)
 
             # 3件集まったらクローズ
-            if len(req["candidates"]) >= 3:
+            if len(req["candidates"]) >= FANOUT_TARGET_OK:
                 req["closed"] = True
-        # 「不可」は静かに無視
+        # 「不可」は静かに無視（ウェーブ全員が返信済みなら次へ）
+        maybe_advance_wave(req_id)
+        return
+
+    # --- 店舗側：未回答の照会の一覧（照会箱）
+    if data.get("type") == "store_inbox":
+        store = STORE_BY_ID.get(data.get("store_id"))
+        if not store or store.get("line_user_id") != user_id:
+            return
+        send_store_inbox(store, reply_token=event.reply_token)
+        return
+
+    # --- 店舗側：空き枠の申告（メニューから）
+    if data.get("type") == "store_avail":
+        store = STORE_BY_ID.get(data.get("store_id"))
+        if not store or store.get("line_user_id") != user_id:
+            return
+        if data.get("clear"):
+            clear_availability(store)
+            slots = []
+        else:
+            try:
+                a = _hhmm_to_min(*data["from"].split(":"))
+                b = _hhmm_to_min(*data["to"].split(":"))
+                pax = int(data["pax"]) if data.get("pax") is not None else None
+            except (KeyError, ValueError, TypeError):
+                return
+            slots = declare_availability(store, a, b, pax)
+        print(f"[AVAIL] {store['store_id']} {slots}")
+        reply_or_push(user_id, event.reply_token, TextSendMessage(_availability_summary(slots)))
         return
 
     # --- ユーザー：「この店に予約申請」→ 氏名入力へ
@@ -722,12 +2383,12 @@ def on_postback(event: PostbackEvent):
 
         store_id = data.get("store_id")
         PENDING_BOOK[user_id] = {"req_id": req_id, "store_id": store_id, "step": "name"}
+        log_event("book_draft", req_id, user_id, store=store_id)
+        emit_span(req_id, "book_draft", time.time_ns(), time.time_ns(), parent_id=_root_span_id(req_id),
+                  attrs={"store": store_id})
 
         lang = SESS.get(user_id, {}).get("lang", "jp")
-        msg = ("お名前を入力してください（フルネーム）"
-               if lang == "jp"
-               else "Please enter your full name (alphabet).")
-        reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+        reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.ask_name", lang)))
         return
 
     # --- 通常のステップ処理 ---
@@ -740,14 +2401,12 @@ def on_postback(event: PostbackEvent):
         # 受付時間チェック（日本語＋英語の両方を1通で案内）
         state = service_window_state()
         if state == "before16":
-            jp = "ただいま準備中のため、予約受付は16:00からです。16:00以降にお試しください。"
-            en = "We're preparing for service. Reservations open at 16:00. Please try again after 16:00."
-            reply_or_push(user_id, event.reply_token, TextSendMessage(bi(jp, en)))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(
+                tr_bi("window.before_open", v, open=f"{SERVICE_OPEN_HOUR}:00")))
             return
         if state == "after22":
-            jp = "本日の予約受付は終了しました。22:00以降は、明日以降の日時でご予約ください。"
-            en = "Today's reservation window has closed. After 22:00, please book for tomorrow or a later date."
-            reply_or_push(user_id, event.reply_token, TextSendMessage(bi(jp, en)))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(
+                tr_bi("window.closed", v, close=f"{SERVICE_CLOSE_HOUR}:00")))
             return
 
         # 受付中 → 時間選択へ（18:00〜22:00、かつ今から45分以降のみ）
@@ -756,20 +2415,27 @@ def on_postback(event: PostbackEvent):
 
     # === ここから追記：時間 → 人数 → 送迎（3引数版） ===
 
-    # ① 時間が選ばれた
+    # ① 時間が選ばれた（第1希望）→ ほかに来店できる時間も聞く
     if step == "time":
         iso = data.get("iso")
+        sess = SESS.setdefault(user_id, {})
         if iso:
-            SESS.setdefault(user_id, {})["time_iso"] = iso
-                    # ★編集モードなら連鎖質問せず、確認画面に戻す
-        if SESS.get(user_id, {}).get("edit_mode") == "time":
-            SESS[user_id].pop("edit_mode", None)
-            ask_confirm(event.reply_token, user_id)
-            return
+            sess["time_iso"] = iso
+            sess["alt_times"] = []
+        ask_more_times(event.reply_token, sess.get("lang", "jp"), user_id)
+        return
 
-        # 言語はセッションから（無ければJP）
-        lang = SESS.get(user_id, {}).get("lang", "jp")
-        ask_pax(event.reply_token, lang, user_id)
+    # ①' 第2・第3希望の時間（done で終わり）
+    if step == "time_more":
+        sess = SESS.setdefault(user_id, {})
+        alts = sess.setdefault("alt_times", [])
+        iso = data.get("iso")
+        if iso and iso != sess.get("time_iso") and iso not in alts and len(alts) < MAX_SLOTS - 1:
+            alts.append(iso)
+            if len(alts) < MAX_SLOTS - 1:
+                ask_more_times(event.reply_token, sess.get("lang", "jp"), user_id)
+                return
+        after_time(event.reply_token, user_id)
         return
 
     # ② 人数が選ばれた（1〜4名 or 5名以上）
@@ -782,11 +2448,7 @@ def on_postback(event: PostbackEvent):
             SESS.setdefault(user_id, {})["await"] = "pax_number"
             reply_or_push(
                 user_id, event.reply_token,
-                TextSendMessage(lang_text(
-                    lang,
-                    "人数を数字で入力してください（例：6）",
-                    "Please enter the number of people (e.g., 6)."
-                ))
+                TextSendMessage(tr("ask.pax_number", lang))
             )
             return
 
@@ -815,11 +2477,11 @@ def on_postback(event: PostbackEvent):
         if need:
             # ★送迎あり：通常どおりホテル名を聞く
             sess["await"] = "hotel_name"
-            msg = "ホテル名をご記入ください。" if lang == "jp" else "Please enter your hotel name."
-            reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(tr("ask.hotel", lang)))
         else:
             # 送迎なし：ホテル消去。編集モードなら即確認へ
             sess["hotel"] = ""
+            sess.pop("pickup_point", None)
             if sess.get("edit_mode") == "pickup":
                 sess.pop("edit_mode", None)
                 ask_confirm(event.reply_token, user_id)
@@ -848,6 +2510,16 @@ def on_postback(event: PostbackEvent):
         return
 
     # ★追記：どの項目を直すか
+    # 「もしかして」のホテル候補が選ばれた（name が空なら入力のまま）
+    if step == "hotel_pick":
+        sess = SESS.setdefault(user_id, {})
+        hotel = HOTEL_INDEX.lookup(data.get("name") or "")
+        if hotel:
+            sess["hotel"] = hotel.name
+            sess["pickup_point"] = hotel.pickup_point
+        after_hotel(event.reply_token, user_id)
+        return
+
     if step == "edit_request":
         target = data.get("target")
         lang = SESS.get(user_id, {}).get("lang", "jp")
@@ -869,7 +2541,7 @@ def on_postback(event: PostbackEvent):
             sess["edit_mode"] = "hotel"
             sess["await"] = "hotel_name"
             reply_or_push(user_id, event.reply_token,
-                          TextSendMessage(lang_text(lang, "ホテル名をご記入ください。", "Please enter your hotel name.")))
+                          TextSendMessage(tr("ask.hotel", lang)))
             return
         # back
         ask_confirm(event.reply_token, user_id)
@@ -885,10 +2557,7 @@ def on_postback(event: PostbackEvent):
             if req and req.get("confirmed"):
                 reply_or_push(
                     user_id, event.reply_token,
-                    TextSendMessage(
-                        lang_text(SESS.get(user_id,{}).get("lang","jp"),
-                                  "すでに予約は確定しています。", "Your booking is already confirmed.")
-                    )
+                    TextSendMessage(tr("book.already_confirmed", SESS.get(user_id, {}).get("lang", "jp")))
                 )
                 return
             finalize_booking(event.reply_token, user_id)
@@ -909,15 +2578,11 @@ def on_postback(event: PostbackEvent):
         lang = SESS.get(user_id, {}).get("lang", "jp")
         if target == "name":
             PENDING_BOOK.setdefault(user_id, {})["step"] = "edit_name"
-            msg = "正しいお名前を入力してください。" if lang == "jp" else "Please enter your full name."
-            reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.ask_name_again", lang)))
             return
         if target == "phone":
             PENDING_BOOK.setdefault(user_id, {})["step"] = "edit_phone"
-            msg = ("電話番号を入力してください（例：07012345678）"
-                   if lang == "jp"
-                   else "Please enter your phone number with country code (e.g., +81 7012345678).")
-            reply_or_push(user_id, event.reply_token, TextSendMessage(msg))
+            reply_or_push(user_id, event.reply_token, TextSendMessage(tr("book.ask_phone", lang)))
             return
         # 修正なし → 確認に戻す
         ask_booking_confirm(event.reply_token, user_id)
@@ -928,15 +2593,50 @@ def on_postback(event: PostbackEvent):
 
 
 # ====== 質問UI ======
-def ask_lang(reply_token, user_id):
-    actions = [
-        PostbackAction(label="日本語",  data=json.dumps({"step":"lang","v":"jp"})),
-        PostbackAction(label="English", data=json.dumps({"step":"lang","v":"en"})),
+# 固定の選択肢（言語・人数・送迎）はプロセス内で1回だけ組み立てて使い回す（ウォームアップで先に作る）
+_MENU_CACHE = {}
+
+def _menu_qreply(kind, lang=""):
+    key = (kind, lang)
+    q = _MENU_CACHE.get(key)
+    if q is None:
+        q = _MENU_CACHE[key] = qreply(_MENU_BUILDERS[kind](lang))
+    return q
+
+def _lang_actions(lang):
+    return [PostbackAction(label=catalog.LOCALE_NAMES[c], data=json.dumps({"step": "lang", "v": c}))
+            for c in LOCALES]
+
+def _pax_actions(lang):
+    # クイックリプライ（1〜4名 + 5名以上）
+    return [
+        PostbackAction(label=tr("label.pax", lang, n=1),
+                       data=json.dumps({"step": "pax", "v": 1})),
+        PostbackAction(label=tr("label.pax", lang, n=2),
+                       data=json.dumps({"step": "pax", "v": 2})),
+        PostbackAction(label=tr("label.pax", lang, n=3),
+                       data=json.dumps({"step": "pax", "v": 3})),
+        PostbackAction(label=tr("label.pax", lang, n=4),
+                       data=json.dumps({"step": "pax", "v": 4})),
+        PostbackAction(label=tr("label.pax_more", lang),
+                       data=json.dumps({"step": "pax", "v": "5plus"})),
     ]
+
+def _pickup_actions(lang):
+    return [
+        PostbackAction(label=tr("label.need", lang),
+                       data=json.dumps({"step": "pickup", "v": "yes"})),
+        PostbackAction(label=tr("label.no", lang),
+                       data=json.dumps({"step": "pickup", "v": "no"})),
+    ]
+
+_MENU_BUILDERS = {"lang": _lang_actions, "pax": _pax_actions, "pickup": _pickup_actions}
+
+def ask_lang(reply_token, user_id):
     reply_or_push(
         user_id, reply_token,
         TextSendMessage("言語を選んでください / Choose your language",
-                        quick_reply=qreply(actions))
+                        quick_reply=_menu_qreply("lang"))
     )
     
 # （ここは def ask_lang(...) の直後に置く）
@@ -949,15 +2649,13 @@ def ask_time(reply_token, lang, user_id):
     state = service_window_state()  # "before16" / "inside" / "after22"
 
     if state == "before16":
-        jp = "ただいま準備中のため、予約受付は16:00からです。16:00以降にお試しください。"
-        en = "We're preparing for service. Reservations open at 16:00. Please try again after 16:00."
-        reply_or_push(user_id, reply_token, TextSendMessage(lang_text(lang, jp, en)))
+        reply_or_push(user_id, reply_token, TextSendMessage(
+            tr("window.before_open", lang, open=f"{SERVICE_OPEN_HOUR}:00")))
         return
 
     if state == "after22":
-        jp = "本日の予約受付は終了しました。22:00以降は、明日以降の日時でご予約ください。"
-        en = "Today's booking window has closed. After 22:00, please book for tomorrow or a later date."
-        reply_or_push(user_id, reply_token, TextSendMessage(lang_text(lang, jp, en)))
+        reply_or_push(user_id, reply_token, TextSendMessage(
+            tr("window.closed", lang, close=f"{SERVICE_CLOSE_HOUR}:00")))
         return
 
     # ここに来たら "inside"（受付中）なので、時間スロットを提示
@@ -972,54 +2670,76 @@ def ask_time(reply_token, lang, user_id):
             label=label,
             data=json.dumps({"step": "time", "iso": s.isoformat()})
         ))
+    log_event("ask_time", user_id=user_id)
     reply_or_push(
         user_id, reply_token,
         TextSendMessage(
-            lang_text(lang, "ご希望の時間を選んでください", "Choose your time"),
+            tr("ask.time", lang),
             quick_reply=qreply(actions)
         )
     )
 
 
+def ask_more_times(reply_token, lang, user_id):
+    """第2・第3希望の時間（任意）。『これで決定』で次へ"""
+    sess = SESS.get(user_id, {})
+    chosen = wanted_slots(sess)
+    slots = [s for s in next_half_hour_slots(count=8, must_be_after=now_jst() + timedelta(minutes=45))
+             if s.isoformat() not in chosen]
+    if not slots:
+        after_time(reply_token, user_id)
+        return
+    actions = [PostbackAction(label=tr("label.time_done", lang), data=json.dumps({"step": "time_more", "v": "done"}))]
+    actions += [PostbackAction(label=s.strftime("%H:%M"), data=json.dumps({"step": "time_more", "iso": s.isoformat()}))
+                for s in slots]
+    reply_or_push(user_id, reply_token, TextSendMessage(
+        tr("ask.time_more", lang, chosen=slots_label(chosen), max=MAX_SLOTS), quick_reply=qreply(actions)))
+
+
+def after_time(reply_token, user_id):
+    """時間が決まった → 編集モードなら確認画面へ、そうでなければ人数へ"""
+    sess = SESS.setdefault(user_id, {})
+    if sess.get("edit_mode") == "time":
+        sess.pop("edit_mode", None)
+        ask_confirm(reply_token, user_id)
+        return
+    ask_pax(reply_token, sess.get("lang", "jp"), user_id)
+
+
 def ask_pax(reply_token, lang, user_id):
     """人数を聞く（1〜4はボタン、5名以上は手入力へ誘導）"""
-    # クイックリプライ（1〜4名 + 5名以上）
-    actions = [
-        PostbackAction(label=lang_text(lang, "1名", "1"),
-                       data=json.dumps({"step": "pax", "v": 1})),
-        PostbackAction(label=lang_text(lang, "2名", "2"),
-                       data=json.dumps({"step": "pax", "v": 2})),
-        PostbackAction(label=lang_text(lang, "3名", "3"),
-                       data=json.dumps({"step": "pax", "v": 3})),
-        PostbackAction(label=lang_text(lang, "4名", "4"),
-                       data=json.dumps({"step": "pax", "v": 4})),
-        PostbackAction(label=lang_text(lang, "5名以上", "5+"),
-                       data=json.dumps({"step": "pax", "v": "5plus"})),
-    ]
     reply_or_push(
         user_id, reply_token,
         TextSendMessage(
-            lang_text(lang, "人数を選んでください", "How many people?"),
-            quick_reply=qreply(actions)
+            tr("ask.pax", lang),
+            quick_reply=_menu_qreply("pax", lang)
         )
     )
 
 def ask_pickup(reply_token, lang, user_id):
     """送迎の要否を聞く（Yes/No）。このあとホテル名の任意入力へ"""
-    actions = [
-        PostbackAction(label=lang_text(lang, "希望", "Need"),
-                       data=json.dumps({"step": "pickup", "v": "yes"})),
-        PostbackAction(label=lang_text(lang, "不要", "No"),
-                       data=json.dumps({"step": "pickup", "v": "no"})),
-    ]
     reply_or_push(
         user_id, reply_token,
         TextSendMessage(
-            lang_text(lang, "送迎は必要ですか？", "Do you need pickup?"),
-            quick_reply=qreply(actions)
+            tr("ask.pickup", lang),
+            quick_reply=_menu_qreply("pickup", lang)
         )
     )
 
+def ask_hotel_pick(reply_token, lang, user_id, typed, hotels):
+    """入力に近いホテル名を quick reply で出す（最後に『入力のまま』）"""
+    items = [PostbackAction(label=h.name[:20], data=json.dumps({"step": "hotel_pick", "name": h.name}, ensure_ascii=False))
+             for h in hotels]
+    items.append(PostbackAction(label=tr("label.hotel_as_typed", lang), data=json.dumps({"step": "hotel_pick", "name": ""})))
+    reply_or_push(user_id, reply_token, TextSendMessage(tr("ask.hotel_pick", lang, typed=typed), quick_reply=qreply(items)))
+
+def after_hotel(reply_token, user_id):
+    """ホテル名が決まった → 編集モードなら解除して照会前の確認へ"""
+    sess = SESS.setdefault(user_id, {})
+    if sess.get("edit_mode") == "hotel":
+        sess.pop("edit_mode", None)
+    ask_confirm(reply_token, user_id)
+
 def ask_confirm(reply_token, user_id):
     """照会送信前の最終確認（時間・人数・送迎・ホテルを表示）
        → 送信 / 編集メニュー / 最初から
@@ -1028,49 +2748,40 @@ def ask_confirm(reply_token, user_id):
     lang = sess.get("lang", "jp")
     if not sess.get("time_iso") or not sess.get("pax"):
         reply_or_push(user_id, reply_token, TextSendMessage(
-            lang_text(lang, "情報が不足しています。最初からやり直してください。", "Session missing. Please start over.")
+            tr("session.missing", lang)
         ))
         return
 
-    t_str = datetime.datetime.fromisoformat(sess["time_iso"]).astimezone(JST).strftime("%H:%M")
-    pick  = "希望" if sess.get("pickup") else "不要"
-    hotel = sess.get("hotel") or "-"
-
-    jp = (f"この内容で照会します。\n"
-          f"時間：{t_str}\n人数：{sess['pax']}名\n送迎：{pick}（{hotel}）\n\n"
-          "よろしければ『照会を送る』を押してください。")
-    en = (f"We will inquire with:\n"
-          f"Time: {t_str}\nParty: {sess['pax']}\nPickup: {'Need' if sess.get('pickup') else 'No'} ({hotel})\n\n"
-          "If OK, tap “Send request”.")
+    text = tr("confirm.body", lang, time=slots_label(wanted_slots(sess)), pax=sess["pax"],
+              pickup=pickup_label(lang, sess.get("pickup")), hotel=sess.get("hotel") or "-")
 
     actions = [
-        PostbackAction(label=lang_text(lang, "照会を送る", "Send request"),
+        PostbackAction(label=tr("confirm.send", lang),
                        data=json.dumps({"step":"confirm","v":"yes"})),
-        PostbackAction(label=lang_text(lang, "内容を修正", "Edit details"),
+        PostbackAction(label=tr("confirm.edit", lang),
                        data=json.dumps({"step":"edit_request_menu"})),
-        PostbackAction(label=lang_text(lang, "最初から", "Start over"),
+        PostbackAction(label=tr("confirm.restart", lang),
                        data=json.dumps({"step":"confirm","v":"no"})),
     ]
-    reply_or_push(user_id, reply_token, TextSendMessage(lang_text(lang, jp, en), quick_reply=qreply(actions)))
+    log_event("ask_confirm", user_id=user_id)
+    reply_or_push(user_id, reply_token, TextSendMessage(text, quick_reply=qreply(actions)))
 # ★ここから追加：時間/人数/送迎/ホテルのどれを直すか
 def ask_edit_request_menu(reply_token, user_id):
     lang = SESS.get(user_id, {}).get("lang", "jp")
-    jp = "どこを修正しますか？"
-    en = "What would you like to edit?"
     actions = [
-        PostbackAction(label=lang_text(lang, "時間を修正", "Edit time"),
+        PostbackAction(label=tr("edit.time", lang),
                        data=json.dumps({"step":"edit_request","target":"time"})),
-        PostbackAction(label=lang_text(lang, "人数を修正", "Edit party"),
+        PostbackAction(label=tr("edit.pax", lang),
                        data=json.dumps({"step":"edit_request","target":"pax"})),
-        PostbackAction(label=lang_text(lang, "送迎を修正", "Edit pickup"),
+        PostbackAction(label=tr("edit.pickup", lang),
                        data=json.dumps({"step":"edit_request","target":"pickup"})),
-        PostbackAction(label=lang_text(lang, "ホテル名を修正", "Edit hotel"),
+        PostbackAction(label=tr("edit.hotel", lang),
                        data=json.dumps({"step":"edit_request","target":"hotel"})),
-        PostbackAction(label=lang_text(lang, "修正なし（戻る）", "No change (back)"),
+        PostbackAction(label=tr("edit.back", lang),
                        data=json.dumps({"step":"edit_request","target":"back"})),
     ]
     reply_or_push(user_id, reply_token,
-                  TextSendMessage(lang_text(lang, jp, en), quick_reply=qreply(actions)))
+                  TextSendMessage(tr("edit.which", lang), quick_reply=qreply(actions)))
 # ★ここまで追加
 
 
@@ -1086,137 +2797,937 @@ def ask_booking_confirm(reply_token, user_id):
 
     if not req or not st or not pb.get("name") or not pb.get("phone"):
         reply_or_push(user_id, reply_token, TextSendMessage(
-            lang_text(lang, "情報を取得できませんでした。最初からやり直してください。", "Session not found. Please start over.")
+            tr("session.not_found", lang)
         ))
         return
 
-    t_str = datetime.datetime.fromisoformat(req["wanted_iso"]).astimezone(JST).strftime("%H:%M")
-    pick  = "希望" if req["pickup"] else "不要"
-    hotel = req.get("hotel") or "-"
-
-    # 見やすく改行
-    jp = (
-        "【入力情報の確認】\n"
-        f"店舗：{st['name']}\n"
-        f"時間：{t_str}\n"
-        f"人数：{req['pax']}名\n"
-        f"送迎：{pick}（{hotel}）\n"
-        f"お名前：{pb['name']}\n"
-        f"電話：{pb['phone']}\n\n"
-        "この内容でよろしければ「予約確定」を押してください。"
-    )
-    en = (
-        "[Please review your details]\n"
-        f"Restaurant: {st['name']}\n"
-        f"Time: {t_str}\n"
-        f"Party: {req['pax']}\n"
-        f"Pickup: {'Need' if req['pickup'] else 'No'} ({hotel})\n"
-        f"Name: {pb['name']}\n"
-        f"Phone: {pb['phone']}\n\n"
-        "If everything looks good, tap “Confirm booking”."
-    )
+    t_str = slots_label([store_slot_iso(req, st["store_id"])])
+    text = tr("book.review", lang, store=st["name"], time=t_str, pax=req["pax"],
+              pickup=pickup_label(lang, req["pickup"]), hotel=req.get("hotel") or "-",
+              name=pb["name"], phone=pb["phone"])
 
     actions = [
         # 予約確定（従来のYes）
-        PostbackAction(label=lang_text(lang, "予約確定", "Confirm booking"),
+        PostbackAction(label=tr("book.confirm", lang),
                        data=json.dumps({"step":"book_confirm","v":"yes"})),
         # 氏名/電話の片方だけ直すメニューへ
-        PostbackAction(label=lang_text(lang, "氏名/電話を修正", "Edit name/phone"),
+        PostbackAction(label=tr("book.edit_personal", lang),
                        data=json.dumps({"step":"edit_personal_menu"})),
         # 取り消して最初から
-        PostbackAction(label=lang_text(lang, "やめる", "Cancel"),
+        PostbackAction(label=tr("book.cancel", lang),
                        data=json.dumps({"step":"book_confirm","v":"no"})),
     ]
+    log_event("book_confirm_shown", pb.get("req_id"), user_id, store=pb.get("store_id"))
     reply_or_push(user_id, reply_token,
-                  TextSendMessage(lang_text(lang, jp, en), quick_reply=qreply(actions)))
+                  TextSendMessage(text, quick_reply=qreply(actions)))
 # ★ここまで置換
 
 # ★ここから追加：氏名/電話のどちらを修正するか選ばせる
 def ask_edit_personal_menu(reply_token, user_id):
     lang = SESS.get(user_id, {}).get("lang", "jp")
-    jp = "どちらを修正しますか？"
-    en = "What would you like to edit?"
     actions = [
-        PostbackAction(label=lang_text(lang, "名前を修正", "Edit name"),
+        PostbackAction(label=tr("edit.name", lang),
                        data=json.dumps({"step":"edit_personal","target":"name"})),
-        PostbackAction(label=lang_text(lang, "電話を修正", "Edit phone"),
+        PostbackAction(label=tr("edit.phone", lang),
                        data=json.dumps({"step":"edit_personal","target":"phone"})),
-        PostbackAction(label=lang_text(lang, "修正なし（戻る）", "No change (back)"),
+        PostbackAction(label=tr("edit.back", lang),
                        data=json.dumps({"step":"edit_personal","target":"back"})),
     ]
     reply_or_push(user_id, reply_token,
-                  TextSendMessage(lang_text(lang, jp, en), quick_reply=qreply(actions)))
+                  TextSendMessage(tr("edit.which_personal", lang), quick_reply=qreply(actions)))
 # ★ここまで追加
 
 
-# ====== 照会スタート → 店舗一斉送信 ======
+# ====== 空き枠の事前申告（店舗） ======
+# 店舗が「今夜 19:00–20:30 / 6名まで」のように空き枠を先に出しておくと、
+# 条件に合う照会は店舗へ聞かずに即時で候補にする。
+# 申告元は 2 つ：LINE（「空き」メニュー／テキスト）と、シートの open_slots 列
+# （open_slots_date 列の日付の当日だけ有効）。同じ日に LINE で申告があればそちらを優先。
+# 枠の人数は「その枠の残り席数」。候補として出した時点で仮押さえ（hold）し、
+# 予約確定で確定分を差し引く。仮押さえは照会の締切で自然に失効する。
+AVAILABILITY = {}  # store_id -> {"date","source","spec","slots":[(start_min, end_min, pax|None)],"holds":{req_id:(minute,pax,expires)}}
+AVAIL_SKIP_BROADCAST_MIN = int(_env("AVAIL_SKIP_BROADCAST_MIN", "3"))  # 即時候補がこの件数以上なら一斉送信しない
+AVAIL_MAX_INSTANT = 10  # カルーセル1枚に載せる上限
+AVAIL_FULL_WORDS = {"満席", "full", "满座", "滿座", "만석"}
+
+_SLOT_RE = re.compile(r"(\d{1,2}):?(\d{2})\s*[-~〜–—]\s*(\d{1,2}):?(\d{2})(?:\D+?(\d{1,3}))?")
+
+# 「空き」メニューのプリセット（from, to, pax）
+AVAIL_PRESETS = [
+    ("18:00", "20:00", 4), ("18:00", "20:00", 6),
+    ("20:00", "22:00", 4), ("20:00", "22:00", 6),
+    ("18:00", "22:00", 4), ("18:00", "22:00", 8),
+]
+
+
+def _hhmm_to_min(hh, mm) -> int:
+    return int(hh) * 60 + int(mm)
+
+
+def _min_to_hhmm(m: int) -> str:
+    return f"{m // 60:02d}:{m % 60:02d}"
+
+
+def parse_open_slots(spec: str):
+    """'18:00-20:00/4; 19:00-21:00/2' → [(1080, 1140, 4), (1140, 1260, 2)]（重なった部分は後勝ち）"""
+    slots = []
+    for part in re.split(r"[;,、\n]", unicodedata.normalize("NFKC", spec or "")):
+        m = _SLOT_RE.search(part)
+        if not m:
+            continue
+        start = _hhmm_to_min(m.group(1), m.group(2))
+        end = _hhmm_to_min(m.group(3), m.group(4))
+        if end <= start:
+            continue
+        pax = int(m.group(5)) if m.group(5) else None
+        _merge_slot(slots, (start, end, pax))
+    return slots
+
+
+def _merge_slot(slots, slot):
+    """新しい枠を入れ、重なる既存枠は重ならない部分だけ残す（区間は常に非重複・開始順）"""
+    start, end, _ = slot
+    kept = []
+    for a, b, p in slots:
+        if b <= start or a >= end:
+            kept.append((a, b, p))
+            continue
+        if a < start:
+            kept.append((a, start, p))
+        if b > end:
+            kept.append((end, b, p))
+    kept.append(slot)
+    kept.sort(key=lambda s: s[0])
+    slots[:] = kept
+
+
+def _avail_entry(store, day: str):
+    """その日の申告エントリ。申告が無ければ None（＝従来どおり一斉送信の対象）"""
+    sid = store["store_id"]
+    entry = AVAILABILITY.get(sid)
+    spec = store.get("open_slots") or ""
+    if entry and entry["date"] == day:
+        if entry["source"] == "line" or entry["spec"] == spec:
+            return entry
+    # シートの申告は open_slots_date が当日のときだけ展開（古いセルは無視）
+    if not spec or store.get("open_slots_date") != day:
+        if entry and entry["date"] != day:
+            AVAILABILITY.pop(sid, None)
+        return None
+    holds = entry["holds"] if entry and entry["date"] == day else {}
+    entry = {"date": day, "source": "sheet", "spec": spec, "slots": parse_open_slots(spec), "holds": holds}
+    AVAILABILITY[sid] = entry
+    return entry
+
+
+def store_slots(store, day: str):
+    entry = _avail_entry(store, day)
+    return entry["slots"] if entry else None
+
+
+def _slot_index(slots, minute: int):
+    """minute を含む枠の位置を二分探索（無ければ None）"""
+    i = bisect.bisect_right(slots, minute, key=lambda s: s[0]) - 1
+    if i >= 0 and slots[i][0] <= minute < slots[i][1]:
+        return i
+    return None
+
+
+def _slot_fits(entry, minute: int, pax: int, exclude_req: str | None = None):
+    """仮押さえ分を差し引いても pax 名が入る枠の位置（入らなければ None）"""
+    slots = entry["slots"]
+    i = _slot_index(slots, minute)
+    if i is None:
+        return None
+    start, end, cap = slots[i]
+    if cap is None:
+        return i
+    now = now_jst()
+    held = sum(
+        p for rid, (m, p, exp) in entry["holds"].items()
+        if rid != exclude_req and exp > now and start <= m < end
+    )
+    return i if cap - held >= pax else None
+
+
+def match_available_stores(wanted_dt: datetime.datetime, pax: int, pickup: bool, exclude_uid: str = ""):
+    """
+    事前申告の空き枠で照会を即時マッチする。
+    戻り値: (fits, declared) … fits は条件に合う店舗リスト、
+            declared は本日申告済みの store_id 集合（合わない店は一斉送信からも外す）
+    """
+    day = wanted_dt.date().isoformat()
+    minute = wanted_dt.hour * 60 + wanted_dt.minute
+    fits, declared = [], set()
+    for s in STORES:
+        if pickup and not bool(s.get("pickup_ok", False)):
+            continue
+        if s["line_user_id"] == exclude_uid:
+            continue
+        entry = _avail_entry(s, day)
+        if entry is None:
+            continue
+        declared.add(s["store_id"])
+        if _slot_fits(entry, minute, pax or 1) is not None:
+            fits.append(s)
+    return fits, declared
+
+
+def hold_availability(store, req_id: str, wanted_dt: datetime.datetime, pax: int, expires: datetime.datetime):
+    """候補として出した店の枠を照会の締切まで仮押さえ"""
+    entry = _avail_entry(store, wanted_dt.date().isoformat())
+    if entry is None:
+        return
+    now = now_jst()
+    for rid in [rid for rid, h in entry["holds"].items() if h[2] <= now]:
+        del entry["holds"][rid]
+    entry["holds"][req_id] = (wanted_dt.hour * 60 + wanted_dt.minute, pax, expires)
+
+
+def release_availability_holds(req_id: str, store_id: str | None = None):
+    """照会の仮押さえを解放（store_id 指定時はその店だけ）"""
+    for sid, entry in AVAILABILITY.items():
+        if store_id is None or sid == store_id:
+            entry["holds"].pop(req_id, None)
+
+
+def declare_availability(store, start_min: int, end_min: int, pax):
+    """LINE からの申告を当日分に反映（重なる部分は置き換え）"""
+    day = now_jst().date().isoformat()
+    entry = AVAILABILITY.get(store["store_id"])
+    if not entry or entry["date"] != day or entry["source"] != "line":
+        base = _avail_entry(store, day)
+        entry = {"date": day, "source": "line", "spec": "",
+                 "slots": list(base["slots"]) if base else [],
+                 "holds": base["holds"] if base else {}}
+        AVAILABILITY[store["store_id"]] = entry
+    _merge_slot(entry["slots"], (start_min, end_min, pax))
+    return entry["slots"]
+
+
+def clear_availability(store):
+    """本日は満席（空き枠なし）として申告"""
+    day = now_jst().date().isoformat()
+    AVAILABILITY[store["store_id"]] = {"date": day, "source": "line", "spec": "", "slots": [], "holds": {}}
+
+
+def consume_availability(store, req_id: str, wanted_dt: datetime.datetime, pax: int) -> bool:
+    """
+    予約確定時に枠の残り席を差し引き、仮押さえを外す。
+    申告の無い店は True。申告はあるが枠が無い／足りないときは False（差し引かない）。
+    """
+    entry = _avail_entry(store, wanted_dt.date().isoformat())
+    if entry is None:
+        return True
+    i = _slot_fits(entry, wanted_dt.hour * 60 + wanted_dt.minute, pax, exclude_req=req_id)
+    if i is None:
+        return False
+    entry["holds"].pop(req_id, None)
+    start, end, cap = entry["slots"][i]
+    if cap is None:
+        return True
+    if cap - pax > 0:
+        entry["slots"][i] = (start, end, cap - pax)
+    else:
+        del entry["slots"][i]
+    return True
+
+
+def _availability_summary(slots) -> str:
+    if not slots:
+        return "本日の空き枠：なし（満席）"
+    lines = [
+        f"・{_min_to_hhmm(a)}–{_min_to_hhmm(b)}" + (f"（{p}名まで）" if p is not None else "")
+        for a, b, p in slots
+    ]
+    return "本日の空き枠：\n" + "\n".join(lines)
+
+
+def ask_store_availability(reply_token, store):
+    """店舗向け：空き枠の申告メニュー（プリセット＋テキスト入力の案内）"""
+    actions = [
+        PostbackAction(label=f"{a}-{b} {p}名", data=json.dumps(
+            {"type": "store_avail", "store_id": store["store_id"], "from": a, "to": b, "pax": p}))
+        for a, b, p in AVAIL_PRESETS
+    ]
+    actions.append(PostbackAction(label="本日満席", data=json.dumps(
+        {"type": "store_avail", "store_id": store["store_id"], "clear": True})))
+    slots = store_slots(store, now_jst().date().isoformat())
+    text = (
+        f"{_availability_summary(slots or [])}\n\n"
+        "空き枠を選んでください。\n"
+        "自由に指定する場合は「空き 19:00-20:30 6名」のように送ってください。\n"
+        "（重なる時間帯は新しい内容で上書きします）"
+    )
+    reply_or_push(store["line_user_id"], reply_token, TextSendMessage(text, quick_reply=qreply(actions)))
+
+
+def on_store_availability_text(reply_token, store, text: str, hit):
+    """「空き 19:00-20:30 6名」形式のテキスト申告。引数なしならメニューを出す"""
+    if hit and hit[2] in AVAIL_FULL_WORDS:
+        clear_availability(store)
+        reply_or_push(store["line_user_id"], reply_token, TextSendMessage(_availability_summary([])))
+        return
+    rest = unicodedata.normalize("NFKC", text or "").strip()[hit[1] if hit else 0:]
+    parsed = parse_open_slots(rest)
+    if not parsed:
+        ask_store_availability(reply_token, store)
+        return
+    for a, b, p in parsed:
+        slots = declare_availability(store, a, b, p)
+    print(f"[AVAIL] {store['store_id']} {slots}")
+    reply_or_push(store["line_user_id"], reply_token, TextSendMessage(_availability_summary(slots)))
+
+
+def candidate_card_label(req, store) -> str:
+    """希望時間が複数の照会だけ、カードにその店で入れる時間を出す"""
+    if not req or len(wanted_slots(req)) < 2:
+        return ""
+    return slots_label([store_slot_iso(req, store["store_id"])])
+
+
+def candidate_carousel(stores, lang="jp", req=None):
+    """候補カードのカルーセル（req があれば第1希望の時間で入れる店から並べる）"""
+    if req:
+        stores = sorted(stores, key=lambda s: slot_rank(req, s["store_id"]))
+    return CarouselContainer(contents=[candidate_bubble(s, lang, candidate_card_label(req, s))
+                                       for s in stores[:AVAIL_MAX_INSTANT]])
+
+
+# ====== 候補カードのまとめ送り ======
+# OK が数秒以内に重なったら、1件ずつ push せず1枚のカルーセルで送る。
+# 窓は最初の OK から CANDIDATE_COALESCE_SEC 秒。送ったあとに来た OK は新しい窓で送る。
+CANDIDATE_COALESCE_SEC = float(_env("CANDIDATE_COALESCE_SEC", "1.5"))
+PENDING_CARDS = {}  # req_id -> [store, ...]（窓が開いている間だけ）
+_CARDS_LOCK = threading.Lock()
+
+
+def queue_candidate_card(req_id: str, store):
+    with _CARDS_LOCK:
+        pending = PENDING_CARDS.get(req_id)
+        if pending is not None:
+            pending.append(store)
+            return
+        PENDING_CARDS[req_id] = [store]
+    if CANDIDATE_COALESCE_SEC <= 0:
+        flush_candidate_cards(req_id)
+        return
+    CLOCK.call_later(CANDIDATE_COALESCE_SEC, flush_candidate_cards, req_id)
+
+
+def flush_candidate_cards(req_id: str):
+    with _CARDS_LOCK:
+        stores = PENDING_CARDS.pop(req_id, None)
+    req = REQUESTS.get(req_id)
+    if not stores or not req:
+        return
+    lang = SESS.get(req["user_id"], {}).get("lang", "jp")
+    contents = (candidate_bubble(stores[0], lang, candidate_card_label(req, stores[0])) if len(stores) == 1
+                else candidate_carousel(stores, lang, req))
+    log_event("candidate_shown", req_id, req["user_id"], stores=[st["store_id"] for st in stores])
+    with trace_span("candidate_push", req_id, stores=[st["store_id"] for st in stores]):
+        safe_push(
+            req["user_id"],
+            FlexSendMessage(alt_text="候補が届きました / New option available", contents=contents),
+            path="store_reply.candidate"
+        )
+
+
+# ====== 店舗の応答傾向と段階送信（ウェーブ） ======
+# 店舗ごとに OK 率と返信までの時間を覚えておき、照会は OK しそうな店から順に
+# 少しずつ送る。窓（wave window）内に OK が FANOUT_TARGET_OK 件に届かなければ次の店へ広げる。
+STORE_STATS = {}  # store_id -> {"sent","ok","no","lat"}（lat は返信秒数の指数移動平均）
+FANOUT_TARGET_OK = 3             # 候補がこの件数集まったら締め切る（従来の3件）
+FANOUT_WAVE_MIN = int(_env("FANOUT_WAVE_MIN", "3"))      # 1ウェーブの最少店舗数
+FANOUT_WAVE_MARGIN = 1.2         # 期待OK数 = 不足件数 × この倍率 になるまで1ウェーブに積む
+FANOUT_WINDOW_MIN_SEC = 45
+FANOUT_WINDOW_MAX_SEC = 180
+FANOUT_DEADLINE_MIN = timedelta(minutes=4)
+FANOUT_DEADLINE_MAX = timedelta(minutes=10)  # 従来の最大待ち時間
+STATS_PRIOR_N = 2                # 実績が少ない店は OK率 0.5・返信120秒 に寄せる
+STATS_PRIOR_OK = 0.5
+STATS_PRIOR_LAT = 120.0
+STATS_LAT_ALPHA = 0.3
+
+
+def store_ok_prob(store_id: str) -> float:
+    st = STORE_STATS.get(store_id) or {}
+    return (st.get("ok", 0) + STATS_PRIOR_OK * STATS_PRIOR_N) / (st.get("sent", 0) + STATS_PRIOR_N)
+
+
+def store_expected_latency(store_id: str) -> float:
+    st = STORE_STATS.get(store_id) or {}
+    return st.get("lat", STATS_PRIOR_LAT)
+
+
+def record_store_push(store_id: str):
+    st = STORE_STATS.setdefault(store_id, {"sent": 0, "ok": 0, "no": 0})
+    st["sent"] += 1
+
+
+def record_store_reply(store_id: str, ok: bool, latency_sec: float):
+    st = STORE_STATS.setdefault(store_id, {"sent": 0, "ok": 0, "no": 0})
+    st["ok" if ok else "no"] += 1
+    prev = st.get("lat")
+    st["lat"] = latency_sec if prev is None else prev + STATS_LAT_ALPHA * (latency_sec - prev)
+
+
+def rank_stores(stores):
+    """OK率の高い順（同率なら返信の速い順）"""
+    return sorted(stores, key=lambda s: (-store_ok_prob(s["store_id"]), store_expected_latency(s["store_id"])))
+
+
+def _take_wave(queue, need: int):
+    """期待OK数が need × 余裕分に届くまで、先頭から店を取り出す"""
+    wave, expected = [], 0.0
+    while queue and (len(wave) < FANOUT_WAVE_MIN or expected < need * FANOUT_WAVE_MARGIN):
+        s = queue.pop(0)
+        wave.append(s)
+        expected += store_ok_prob(s["store_id"])
+    return wave
+
+
+def _wave_window(wave) -> float:
+    """そのウェーブの店が返信しそうな時間（秒）。遅い店に合わせて上下限で丸める"""
+    lat = max((store_expected_latency(s["store_id"]) for s in wave), default=STATS_PRIOR_LAT)
+    return min(FANOUT_WINDOW_MAX_SEC, max(FANOUT_WINDOW_MIN_SEC, lat * 1.5))
+
+
+def plan_fanout_deadline(stores, need: int) -> datetime.datetime:
+    """全ウェーブを送り切って返信を待つまでの見込みから締切を決める（4〜10分）"""
+    queue = list(stores)
+    total = 0.0
+    while queue:
+        wave = _take_wave(queue, need)
+        total += _wave_window(wave)
+    if not stores:
+        total = FANOUT_DEADLINE_MIN.total_seconds()
+    span = min(FANOUT_DEADLINE_MAX, max(FANOUT_DEADLINE_MIN, timedelta(seconds=total)))
+    return now_jst() + span
+
+
+def start_fanout(req_id: str, stores, admitted: bool = True):
+    """ランク済みの店リストを段階送信する（最初のウェーブはすぐ送る。admitted=False なら混雑で後回し）"""
+    req = REQUESTS[req_id]
+    req["fanout"] = {"queue": list(stores), "wave": [], "n": 0, "deferred": 0.0, "retry": False}
+    if admitted or not _defer_wave(req_id, req["fanout"]):
+        send_next_wave(req_id, admitted=True)
+
+
+def _defer_wave(req_id: str, fo) -> bool:
+    """混雑で送れないウェーブを ADMIT_RETRY_SEC 秒後に回す。後回しの合計が上限なら回さない（False → 送る）"""
+    if fo["deferred"] + ADMIT_RETRY_SEC > ADMIT_MAX_DEFER_SEC:
+        _count_admission(PRIO_NORMAL, "forced")
+        return False
+    fo["deferred"] += ADMIT_RETRY_SEC
+    fo["retry"] = True
+    if fo["n"] == 0:  # まだどの店にも送っていない → 店が答えられる時間が削られないよう締切も後ろへ
+        REQUESTS[req_id]["deadline"] += timedelta(seconds=ADMIT_RETRY_SEC)
+        schedule_timeout_notice(req_id)
+    print(f"[FANOUT] {req_id} deferred (busy) total={fo['deferred']:.0f}s")
+    CLOCK.call_later(ADMIT_RETRY_SEC, _on_wave_retry, req_id)
+    return True
+
+
+def _on_wave_retry(req_id: str):
+    fo = (REQUESTS.get(req_id) or {}).get("fanout")
+    if fo:
+        fo["retry"] = False
+        send_next_wave(req_id)
+
+
+def send_next_wave(req_id: str, admitted: bool = False):
+    req = REQUESTS.get(req_id)
+    if not req or req.get("closed") or now_jst() >= req["deadline"]:
+        return
+    fo = req.get("fanout")
+    need = FANOUT_TARGET_OK - len(req["candidates"])
+    if not fo or not fo["queue"] or need <= 0 or fo["retry"]:  # 後回し中は再試行のタイマーに任せる
+        return
+    if not admitted and not admit(PRIO_NORMAL) and _defer_wave(req_id, fo):
+        return
+    wave = []
+    while fo["queue"] and not wave:  # 照会を作ったあとに隔離された店は送らずに飛ばす
+        wave = [s for s in _take_wave(fo["queue"], need) if not delivery_skip(s["line_user_id"])]
+    fo["wave"] = [s["store_id"] for s in wave]
+    fo["n"] += 1
+    print(f"[FANOUT] {req_id} wave={fo['n']} stores={fo['wave']} left={len(fo['queue'])}")
+    for s in wave:
+        push_inquiry_to_store(req_id, s)
+    if fo["queue"]:
+        n = fo["n"]
+        CLOCK.call_later(_wave_window(wave), _on_wave_window_end, req_id, n)
+
+
+def _on_wave_window_end(req_id: str, n: int):
+    fo = (REQUESTS.get(req_id) or {}).get("fanout")
+    if fo and fo["n"] == n:  # 全員返信で前倒し済みなら何もしない
+        send_next_wave(req_id)
+
+
+def maybe_advance_wave(req_id: str):
+    """今のウェーブの店が全員返信したのに足りなければ、窓を待たずに次へ"""
+    req = REQUESTS.get(req_id)
+    fo = (req or {}).get("fanout")
+    if not fo or not fo["queue"]:
+        return
+    replied = req.get("replied", {})
+    if all(sid in replied for sid in fo["wave"]):
+        send_next_wave(req_id)
+
+
+# ====== ホテル名簿（入力されたホテル名 → 正式名・座標・集合場所） ======
+# 名簿はシート（HOTELS_SHEET_CSV_URL）か手元のファイル（HOTELS_PATH）の CSV。列は geo.py 参照。
+# 入力は _norm（NFKC・小文字）したうえで空白・記号を除いて照合する。名前・別名に一致すれば正式名に置き換え、
+# 一致しなければ 3-gram のあいまい一致で「もしかして」の候補を quick reply で出す（選ばなければ入力のまま）。
+# 店舗には正式名と集合場所を送るので、表記ゆれ・他言語表記のまま届かない。
+HOTELS_SHEET_CSV_URL = _env("HOTELS_SHEET_CSV_URL")
+HOTELS_PATH = _env("HOTELS_PATH", "hotels.csv")
+HOTEL_SUGGEST_MAX = 3
+HOTEL_SUGGEST_MIN_SCORE = float(_env("HOTEL_SUGGEST_MIN_SCORE", "0.3"))
+_PLACE_DROP = re.compile(r"[\s\-‐―ー・,.'\"()（）「」、。&＆]+")
+
+
+def _hotel_key(name: str) -> str:
+    return _PLACE_DROP.sub("", _norm(name))
+
+
+HOTEL_INDEX = geo.HotelIndex([], _hotel_key)
+
+
+def load_hotels():
+    global HOTEL_INDEX
+    try:
+        if HOTELS_SHEET_CSV_URL:
+            hotels, bad = _load_csv_url(HOTELS_SHEET_CSV_URL, geo.load_gazetteer)
+        else:
+            with open(HOTELS_PATH, encoding="utf-8-sig", newline="") as f:
+                hotels, bad = geo.load_gazetteer(f)
+    except FileNotFoundError:
+        print(f"[HOTELS] {HOTELS_PATH} not found; hotel names are kept as typed")
+        return
+    except Exception as e:
+        print("[HOTELS] Failed to load:", e)
+        return
+    HOTEL_INDEX = geo.HotelIndex(hotels, _hotel_key)
+    print(f"[HOTELS] loaded={HOTEL_INDEX.size} names={len(HOTEL_INDEX.terms)} bad_coords={bad}")
+
+
+def hotel_location(hotel: str):
+    """ホテル名 → geo.Hotel（名前・別名の完全一致）。名簿に無ければ None"""
+    return HOTEL_INDEX.lookup(hotel) if hotel else None
+
+
+def store_hotel_label(r) -> str:
+    """店舗向けのホテル表記（正式名／集合場所）。r は SESS・REQUESTS・ジョブの payload のどれでもよい"""
+    hotel = r.get("hotel") or "-"
+    return f"{hotel}／{r['pickup_point']}" if r.get("pickup_point") else hotel
+
+
+# ====== 位置による照会先の絞り込み（ホテル名簿 + 店舗の k-d 木） ======
+# お客さまのホテルが名簿で分かり座標があれば、照会は近い店にだけ送る：
+#   半径 GEO_RADIUS_KM_PICKUP（送迎あり）/ GEO_RADIUS_KM_NO_PICKUP（送迎なし）以内の条件に合う店。
+#   半径内が GEO_K 店に満たなければ、半径の外からも近い順に GEO_K 店まで足す（照会先が0にならないように）。
+# 位置の無い店（シートの lat/lon が空）は距離が分からないので、これまでどおり照会する。
+# ホテルが辞書に無い・ホテルを聞いていない（送迎なし）ときは絞り込まない。
+GEO_K = int(_env("GEO_K", "8"))
+GEO_RADIUS_KM_PICKUP = float(_env("GEO_RADIUS_KM_PICKUP", "10"))
+GEO_RADIUS_KM_NO_PICKUP = float(_env("GEO_RADIUS_KM_NO_PICKUP", "3"))
+_GEO_INDEX = {"stores": None, "tree": None}  # STORES が入れ替わったら作り直す
+
+
+def store_geo_index():
+    stores = STORES
+    if _GEO_INDEX["stores"] is not stores:
+        _GEO_INDEX["tree"] = geo.KDTree([(s["lat"], s["lon"], s) for s in stores])
+        _GEO_INDEX["stores"] = stores
+    return _GEO_INDEX["tree"]
+
+
+def nearby_stores(targets, loc, pickup: bool):
+    """照会先の候補 targets を loc（座標のある geo.Hotel）からの距離で絞る → (店のリスト, 半径km)"""
+    radius = GEO_RADIUS_KM_PICKUP if pickup else GEO_RADIUS_KM_NO_PICKUP
+    eligible = {s["store_id"] for s in targets}
+    accept = lambda s: s["store_id"] in eligible
+    tree = store_geo_index()
+    near = tree.nearest(loc.lat, loc.lon, max_km=radius, accept=accept)
+    if len(near) < GEO_K:
+        near = tree.nearest(loc.lat, loc.lon, k=GEO_K, accept=accept)
+    unlocated = [s for s in targets if not geo.valid_coord(s["lat"], s["lon"])]
+    return [s for _, s in near] + unlocated, radius
+
+
+# ====== 照会スタート → 店舗へ段階送信 ======
+# ====== 照会の連打・重複対策 ======
+# 「予約」を何度も押す・やり直して同じ内容で送り直すたびに全店へ一斉照会が飛ばないように、
+#   - 同じユーザーの同じ内容（時刻・人数・送迎・ホテルと送迎場所）の照会が進行中なら、それを使い回して候補を出し直す
+#   - 新しい照会はユーザーごとのトークンバケット（INQUIRY_BURST 回まで連続、以後 INQUIRY_REFILL_SEC ごとに1回）
+INQUIRY_BURST = int(_env("INQUIRY_BURST", "3"))
+INQUIRY_REFILL_SEC = float(_env("INQUIRY_REFILL_SEC", "600"))
+INQUIRY_BUCKETS = {}   # user_id -> [tokens, 最後に補充した CLOCK.monotonic()]
+LAST_INQUIRY = {}      # user_id -> (照会内容のキー, req_id)
+_INQUIRY_LOCK = threading.Lock()
+
+
+def inquiry_key(sess) -> tuple:
+    return (tuple(wanted_slots(sess)), sess.get("pax"), bool(sess.get("pickup")),
+            sess.get("hotel") or "", sess.get("pickup_point") or "")
+
+
+def take_inquiry_token(user_id) -> float:
+    """1回分を取れたら 0、取れなければ次の1回までの秒数（_INQUIRY_LOCK の中で呼ぶ）"""
+    now = CLOCK.monotonic()
+    bucket = INQUIRY_BUCKETS.setdefault(user_id, [float(INQUIRY_BURST), now])
+    bucket[0] = min(float(INQUIRY_BURST), bucket[0] + (now - bucket[1]) / INQUIRY_REFILL_SEC)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return (1 - bucket[0]) * INQUIRY_REFILL_SEC
+
+
+def _reusable_inquiry(user_id, key):
+    """同じ内容で進行中の照会の req_id（作成中で REQUESTS にまだ無いものも含む）"""
+    last = LAST_INQUIRY.get(user_id)
+    if not last or last[0] != key:
+        return None
+    req = REQUESTS.get(last[1])
+    if req is None:
+        return last[1]
+    if req.get("confirmed") or req.get("cancelled") or now_jst() >= req["deadline"]:
+        return None
+    return last[1]
+
+
+def reshow_inquiry(reply_token, user_id, req_id):
+    """一斉照会はせず、いまの候補を出し直す"""
+    SESS.setdefault(user_id, {})["req_id"] = req_id
+    lang = SESS[user_id].get("lang", "jp")
+    req = REQUESTS.get(req_id) or {}
+    stores = [STORE_BY_ID[sid] for sid in req.get("candidates", ()) if sid in STORE_BY_ID]
+    log_event("inquiry_reused", req_id, user_id, candidates=len(stores))
+    print(f"[INQUIRY] reuse {req_id} user={user_id} candidates={len(stores)}")
+    if stores:
+        reply_or_push(user_id, reply_token, TextSendMessage(tr("inquiry.reused", lang)),
+                      FlexSendMessage(alt_text="候補が届きました / New option available",
+                                      contents=candidate_carousel(stores, lang, req)),
+                      path="start_inquiry.reuse")
+        log_event("candidate_shown", req_id, user_id, stores=[st["store_id"] for st in stores], reused=True)
+        return
+    wait_min = max(1, math.ceil((req["deadline"] - now_jst()).total_seconds() / 60)) if req else 10
+    reply_or_push(user_id, reply_token, TextSendMessage(tr("inquiry.reused_wait", lang, wait_min=wait_min)),
+                  path="start_inquiry.reuse")
+
+
 def start_inquiry(reply_token, user_id):
+    key = inquiry_key(SESS.get(user_id, {}))
+    with _INQUIRY_LOCK:
+        reuse_id = _reusable_inquiry(user_id, key)
+        wait = 0.0 if reuse_id else take_inquiry_token(user_id)
+        if not reuse_id and not wait:
+            req_id = make_req_id()
+            LAST_INQUIRY[user_id] = (key, req_id)
+    if reuse_id:
+        reshow_inquiry(reply_token, user_id, reuse_id)
+        return
+    if wait:
+        lang = SESS.get(user_id, {}).get("lang", "jp")
+        wait_min = math.ceil(wait / 60)
+        log_event("inquiry_throttled", None, user_id, wait=round(wait))
+        print(f"[INQUIRY] throttled user={user_id} wait={wait:.0f}s")
+        reply_or_push(user_id, reply_token, TextSendMessage(tr("inquiry.throttled", lang, wait_min=wait_min)),
+                      path="start_inquiry.throttled")
+        return
+    try:
+        with trace_span("start_inquiry", req_id):
+            _start_inquiry(reply_token, user_id, req_id)
+    except Exception:
+        with _INQUIRY_LOCK:
+            if req_id not in REQUESTS and LAST_INQUIRY.get(user_id, (None, None))[1] == req_id:
+                LAST_INQUIRY.pop(user_id)  # 作りかけを使い回さない
+        raise
+
+
+def _start_inquiry(reply_token, user_id, req_id):
     sess = SESS.get(user_id, {})
     lang = sess.get("lang", "jp")
-    req_id = make_req_id()
-    deadline = now_jst() + timedelta(minutes=10)  # 最大待ち時間 10分
+
+    # 事前申告の空き枠に合う店は即時候補（店舗への照会は不要）。希望順に見て、店ごとに一番早い希望の時間で出す
+    slots = wanted_slots(sess)
+    fits, declared, slot_by_store = [], set(), {}
+    for iso in slots:
+        found, declared = match_available_stores(datetime.datetime.fromisoformat(iso).astimezone(JST),
+                                                 sess.get("pax"), bool(sess.get("pickup")), user_id)
+        for s in found:
+            if s["store_id"] not in slot_by_store:
+                slot_by_store[s["store_id"]] = iso
+                fits.append(s)
+    fits = fits[:AVAIL_MAX_INSTANT]
+    skip_broadcast = bool(fits) and len(fits) >= AVAIL_SKIP_BROADCAST_MIN
+
+    # 照会する店（OKしそうな順）と、それに合わせた締切
+    targets = []
+    if not skip_broadcast:
+        for s in STORES:
+            # 送迎が必要な依頼 かつ 店舗が送迎不可なら除外
+            if bool(sess.get("pickup")) and not bool(s.get("pickup_ok", False)):
+                continue
+            # 誤送信防止（万一店舗LINE＝お客さまのIDだった場合）
+            if s["line_user_id"] == user_id:
+                continue
+            # 届かない（ブロック・ID 間違い）店は隔離中なら外す（probe を使うのは実際に送るとき）
+            if delivery_skip(s["line_user_id"], probe=False):
+                continue
+            # 本日の空き枠を申告済みの店は、合えば即時候補済み・合わなければ満席扱い
+            if s["store_id"] in declared:
+                continue
+            targets.append(s)
+        loc = hotel_location(sess.get("hotel", ""))
+        if loc and geo.valid_coord(loc.lat, loc.lon) and targets:
+            n_all = len(targets)
+            targets, radius = nearby_stores(targets, loc, bool(sess.get("pickup")))
+            print(f"[GEO] {req_id} hotel={loc.name} radius={radius:g}km stores {n_all}→{len(targets)}")
+        targets = rank_stores(targets)
+    deadline = plan_fanout_deadline(targets, FANOUT_TARGET_OK - len(fits))  # 最大待ち時間 10分
 
     REQUESTS[req_id] = {
         "user_id": user_id,
         "deadline": deadline,
         "wanted_iso": sess.get("time_iso"),
+        "slots": slots,
+        "slot_by_store": {s["store_id"]: slot_by_store[s["store_id"]] for s in fits},
         "pax": sess.get("pax"),
         "pickup": sess.get("pickup"),
         "hotel": sess.get("hotel", ""),
-        "candidates": set(),
+        "pickup_point": sess.get("pickup_point", ""),
+        "candidates": {s["store_id"] for s in fits},
+        "instant": {s["store_id"] for s in fits},
         "closed": False,
+        "trace_start_ns": time.time_ns(),
     }
     SESS[user_id]["req_id"] = req_id
+    log_event("inquiry", req_id, user_id, pax=sess.get("pax"), pickup=bool(sess.get("pickup")),
+              wanted=sess.get("time_iso"), slots=len(slots), instant=len(fits), targets=len(targets))
+    # 即時候補の枠は締切まで仮押さえ
+    for s in fits:
+        hold_availability(s, req_id, datetime.datetime.fromisoformat(slot_by_store[s["store_id"]]).astimezone(JST),
+                          sess.get("pax") or 1, deadline)
+    if fits:
+        print(f"[AVAIL] {req_id} instant={[s['store_id'] for s in fits]} broadcast={not skip_broadcast}")
+
+    # ユーザーへ受付メッセージ（即時候補があれば同じ reply でカードも返す。混雑中は照会を後回しにする旨）
+    admitted = skip_broadcast or admit(PRIO_NORMAL)
+    if skip_broadcast:
+        ack = tr("inquiry.ack_instant", lang)
+    else:
+        wait_sec = (deadline - now_jst()).total_seconds() + (0 if admitted else ADMIT_MAX_DEFER_SEC)
+        ack = tr("inquiry.ack_wait" if admitted else "inquiry.busy", lang, wait_min=math.ceil(wait_sec / 60))
+    messages = [TextSendMessage(ack)]
+    if fits:
+        messages.append(FlexSendMessage(alt_text="候補が届きました / New option available",
+                                        contents=candidate_carousel(fits, lang, REQUESTS[req_id])))
+        log_event("candidate_shown", req_id, user_id, stores=[s["store_id"] for s in fits], instant=True)
+    reply_or_push(user_id, reply_token, *messages, path="start_inquiry")
+
+    if skip_broadcast:
+        REQUESTS[req_id]["closed"] = True  # 候補が揃っているので店舗からの回答は待たない
+        return
 
-    # ユーザーへ受付メッセージ
-    line_bot_api.reply_message(
-        reply_token,
-        TextSendMessage(lang_text(lang,
-            "照会中です。最大10分、候補が届き次第表示します。",
-            "Request sent. We’ll show options as they reply (up to 10 min)."))
-    )
+    # 店舗へ段階送信（OKしそうな店から。足りなければ次のウェーブへ広げる）
+    start_fanout(req_id, targets, admitted)
 
-    # 店舗へ一斉送信
-    wanted = datetime.datetime.fromisoformat(sess["time_iso"]).astimezone(JST).strftime("%H:%M")
-    pax = sess["pax"]
-    pickup_label = "希望" if sess["pickup"] else "不要"
-    hotel = sess.get("hotel") or "-"
-    deadline_str = deadline.strftime("%H:%M")
-    remain = int((deadline - now_jst()).total_seconds() // 60)
-    foreign_hint = " ※外国人（英語）" if lang == "en" else ""
+    # 締切で候補0件なら自動通知
+    schedule_timeout_notice(req_id)
 
-    for s in STORES:
-        # 送迎が必要な依頼 かつ 店舗が送迎不可なら除外
-        if bool(sess.get("pickup")) and not bool(s.get("pickup_ok", False)):
-            continue
 
-        # 誤送信防止（万一店舗LINE＝お客さまのIDだった場合）
-        if s["line_user_id"] == user_id:
-            continue
+def store_reply_actions(req_id: str, req, store_id: str):
+    """照会への返信ボタン。希望時間が複数なら時間ごとの OK（1通で時間ごとに答えられる）＋不可"""
+    slots = wanted_slots(req)
+    if len(slots) == 1:
+        actions = [PostbackAction(label="OK", data=json.dumps(
+            {"type":"store_reply","req_id":req_id,"store_id":store_id,"status":"ok"}))]
+    else:
+        actions = [PostbackAction(label=f"{slots_label([iso])} OK", data=json.dumps(
+            {"type":"store_reply","req_id":req_id,"store_id":store_id,"status":"ok","iso":iso}))
+                   for iso in slots]
+    actions.append(PostbackAction(label="不可", data=json.dumps(
+        {"type":"store_reply","req_id":req_id,"store_id":store_id,"status":"no"})))
+    return actions
 
-        text = (
-            f"【照会】{wanted}／{pax}名／送迎：{pickup_label}（{hotel}）{foreign_hint}\n"
-            f"⏰ 締切：{deadline_str}（あと{remain}分）\n"
-            f"押すだけで返信👇"
-        )
-        actions = [
-            PostbackAction(label="OK",  data=json.dumps(
-                {"type":"store_reply","req_id":req_id,"store_id":s["store_id"],"status":"ok"})),
-            PostbackAction(label="不可", data=json.dumps(
-                {"type":"store_reply","req_id":req_id,"store_id":s["store_id"],"status":"no"})),
-        ]
-        safe_push(
+
+def _note_inquiry_pushed(req_id: str, store_id: str):
+    req = REQUESTS[req_id]
+    req.setdefault("pushed_at", {})[store_id] = now_jst()
+    req.setdefault("pushed_ns", {})[store_id] = time.time_ns()  # トレース用（実時間）
+    record_store_push(store_id)
+
+
+def push_inquiry_to_store(req_id: str, s) -> bool:
+    """1店舗へ【照会】を送る。照会箱の窓が開いている店には、窓の終わりにまとめて送る"""
+    if queue_store_inquiry(req_id, s):
+        return True
+    return _push_inquiry_text(req_id, s)
+
+
+def _push_inquiry_text(req_id: str, s) -> bool:
+    """【照会】（OK/不可のクイックリプライ付き）を1通。ほかにも未回答があれば『一覧』ボタンも付ける"""
+    req = REQUESTS[req_id]
+    lang = SESS.get(req["user_id"], {}).get("lang", "jp")
+    slots = wanted_slots(req)
+    remain = int((req["deadline"] - now_jst()).total_seconds() // 60)
+    text = tr("store.inquiry" if len(slots) == 1 else "store.inquiry_multi", time=slots_label(slots, " ＞ "),
+              pax=req["pax"], pickup=pickup_label("jp", req.get("pickup")),
+              hotel=store_hotel_label(req), foreign=foreign_hint(lang, short=True),
+              deadline=req["deadline"].strftime("%H:%M"), remain=remain)
+    actions = store_reply_actions(req_id, req, s["store_id"])
+    if any(rid != req_id for rid in open_inquiries(s["store_id"])):
+        actions.append(PostbackAction(label="未回答の一覧", data=json.dumps(
+            {"type":"store_inbox","store_id":s["store_id"]})))
+    _note_inquiry_pushed(req_id, s["store_id"])
+    with trace_span("store_push", req_id, store=s["store_id"]) as span:
+        ok = safe_push(
             s["line_user_id"],
             TextSendMessage(text=text, quick_reply=qreply(actions)),
-            s["name"]
+            s["name"], path="push_inquiry_to_store", push_log=[(req_id, {"store": s["store_id"]})]
         )
+        if ok is PUSH_QUEUED:
+            span["queued"] = True  # 成否は送信側の line.push 区間に出る
+        else:
+            span["ok"] = ok
+    return ok
+
+
+# ====== 店舗の照会箱（未回答の照会を1枚のカルーセルでまとめて返信） ======
+# 混む時間帯は1店に照会が続けて届き、1件ずつクイックリプライで答えているうちに締切が来てしまう。
+#   - 店へ照会を送ったら STORE_INBOX_BATCH_SEC 秒の窓を開き、窓の間に来た照会はすぐには送らずためる。
+#     窓の終わりに、その店の未回答の照会をすべて載せたカルーセル（カードごとに OK／不可）を1通で送り、次の窓を開く
+#     （ためた照会が1件だけで、ほかに未回答が無ければ従来の【照会】テキスト）。
+#   - 店が「照会一覧」と送る・【照会】の『未回答の一覧』を押すと、いまの未回答をその場で返す（reply なので無料）。
+# 未回答 = クローズ前・締切前で、その店に送ってまだ OK／不可を押していない照会。
+STORE_INBOX_BATCH_SEC = float(_env("STORE_INBOX_BATCH_SEC", "20"))
+STORE_INBOX_MAX = 12   # カルーセル1枚の上限（締切の近い順。あふれた新着は次の窓へ）
+INBOX_WINDOWS = {}     # store_id -> [ためている req_id, ...]（窓が開いている間だけ）
+_INBOX_LOCK = threading.Lock()
+
+
+def _inquiry_open(req_id: str, store_id: str) -> bool:
+    req = REQUESTS.get(req_id)
+    return (bool(req) and not req.get("closed") and now_jst() < req["deadline"]
+            and store_id not in req.get("replied", {}))
+
+
+def open_inquiries(store_id: str):
+    """その店に送って未回答の照会（req_id のリスト）"""
+    return [rid for rid, r in list(REQUESTS.items())
+            if store_id in r.get("pushed_at", ()) and _inquiry_open(rid, store_id)]
+
+
+def queue_store_inquiry(req_id: str, store) -> bool:
+    """窓が開いていれば照会をためて True。開いていなければ窓を開いて False（呼び出し側がすぐ送る）"""
+    if STORE_INBOX_BATCH_SEC <= 0:
+        return False
+    sid = store["store_id"]
+    with _INBOX_LOCK:
+        pending = INBOX_WINDOWS.get(sid)
+        if pending is not None:
+            pending.append(req_id)
+            return True
+        INBOX_WINDOWS[sid] = []
+    CLOCK.call_later(STORE_INBOX_BATCH_SEC, flush_store_inbox, sid)
+    return False
+
+
+def flush_store_inbox(store_id: str):
+    with _INBOX_LOCK:
+        pending = INBOX_WINDOWS.pop(store_id, None)
+    store = STORE_BY_ID.get(store_id)
+    pending = [rid for rid in pending or () if _inquiry_open(rid, store_id)]
+    if not store or not pending:
+        return
+    with _INBOX_LOCK:
+        INBOX_WINDOWS.setdefault(store_id, [])
+    CLOCK.call_later(STORE_INBOX_BATCH_SEC, flush_store_inbox, store_id)
+    if len(pending) == 1 and not open_inquiries(store_id):
+        _push_inquiry_text(pending[0], store)
+        return
+    send_store_inbox(store, new=pending)
 
-    # 10分経って候補0件なら自動通知
+
+def _inbox_bubble(req_id: str, req, store_id: str):
+    lang = SESS.get(req["user_id"], {}).get("lang", "jp")
+    remain = max(0, int((req["deadline"] - now_jst()).total_seconds() // 60))
+    actions = store_reply_actions(req_id, req, store_id)
+    buttons = [ButtonComponent(style="primary" if i < len(actions) - 1 else "secondary", height="sm", action=a)
+               for i, a in enumerate(actions)]
+    return BubbleContainer(
+        body=BoxComponent(
+            layout="vertical",
+            contents=[
+                TextComponent(text=tr("store.inbox_card", time=slots_label(wanted_slots(req), " ＞ "), pax=req["pax"]),
+                              weight="bold", size="lg", wrap=True),
+                TextComponent(text=tr("store.inbox_card_detail", pickup=pickup_label("jp", req.get("pickup")),
+                                      hotel=store_hotel_label(req), foreign=foreign_hint(lang, short=True)),
+                              size="sm", wrap=True, margin="md"),
+                TextComponent(text=tr("store.inbox_card_deadline", deadline=req["deadline"].strftime("%H:%M"),
+                                      remain=remain),
+                              size="sm", color="#D0021B", margin="md"),
+            ],
+        ),
+        footer=BoxComponent(layout="vertical", spacing="sm", contents=buttons)
+    )
+
+
+def send_store_inbox(store, new=(), reply_token=None):
+    """店の未回答の照会を1枚のカルーセルで送る（new はためていた新着）。reply_token があれば reply で返す"""
+    sid = store["store_id"]
+    rids = sorted({*open_inquiries(sid), *new}, key=lambda rid: REQUESTS[rid]["deadline"])
+    shown = rids[:STORE_INBOX_MAX]
+    overflow = [rid for rid in new if rid not in shown]
+    if overflow:
+        with _INBOX_LOCK:
+            INBOX_WINDOWS.setdefault(sid, []).extend(overflow)
+    if not shown:
+        reply_or_push(store["line_user_id"], reply_token, TextSendMessage(tr("store.inbox_empty")), path="store_inbox")
+        return
+    message = FlexSendMessage(alt_text=tr("store.inbox_alt", count=len(shown)),
+                              contents=CarouselContainer(contents=[_inbox_bubble(rid, REQUESTS[rid], sid) for rid in shown]))
+    fresh = [rid for rid in shown if rid in new]
+    for rid in fresh:
+        _note_inquiry_pushed(rid, sid)
+    print(f"[INBOX] {sid} open={len(shown)} new={len(fresh)}")
+    if reply_token:
+        reply_or_push(store["line_user_id"], reply_token, message, path="store_inbox")
+        return
+    safe_push(store["line_user_id"], message, store["name"], path="store_inbox",
+              push_log=[(rid, {"store": sid, "inbox": len(shown)}) for rid in fresh])
+
+
+def reinquire_after_slot_gone(reply_token, user_id, req_id: str, store):
+    """即時候補の枠が確定前に埋まった → その店へ直接照会し、回答を待つ"""
+    req = REQUESTS[req_id]
+    sid = store["store_id"]
+    req.setdefault("instant", set()).discard(sid)
+    req["candidates"].discard(sid)
+    req.get("slot_by_store", {}).pop(sid, None)
+    release_availability_holds(req_id, sid)
+    req["closed"] = False
+    req["deadline"] = now_jst() + timedelta(minutes=10)
+    PENDING_BOOK.pop(user_id, None)
+    print(f"[AVAIL] {req_id} slot gone at {sid}; asking store")
+
+    lang = SESS.get(user_id, {}).get("lang", "jp")
+    reply_or_push(user_id, reply_token, TextSendMessage(tr("inquiry.slot_gone", lang, store=store["name"])))
+    push_inquiry_to_store(req_id, store)
     schedule_timeout_notice(req_id)
 
 
 # ====== 予約確定 ======
 def finalize_booking(reply_token, user_id):
+    with trace_span("finalize_booking", PENDING_BOOK.get(user_id, {}).get("req_id")):
+        _finalize_booking(reply_token, user_id)
+
+
+def _finalize_booking(reply_token, user_id):
     pb = PENDING_BOOK.get(user_id)
 
     # --- 再送/連打で PENDING_BOOK が消えた後に同じポストバックが来た場合の救済 ---
@@ -1229,128 +3740,67 @@ def finalize_booking(reply_token, user_id):
                 break
         if latest_confirmed:
             lang = SESS.get(user_id, {}).get("lang", "jp")
-            msg_jp = "すでに予約は確定しています。"
-            msg_en = "Your booking is already confirmed."
-            reply_or_push(user_id, reply_token, TextSendMessage(lang_text(lang, msg_jp, msg_en)))
+            reply_or_push(user_id, reply_token, TextSendMessage(tr("book.already_confirmed", lang)), path="finalize_booking")
             return
 
         # 確定情報もない → これだけ再送されてきたケースなので通常のエラーメッセージ
         reply_or_push(user_id, reply_token, TextSendMessage(
-            "セッションが見つかりませんでした。最初からやり直してください。"
-        ))
+            tr("book.session_lost", SESS.get(user_id, {}).get("lang", "jp"))
+        ), path="finalize_booking")
         return
 
 
     req = REQUESTS.get(pb["req_id"])
     store = STORE_BY_ID.get(pb["store_id"])
     if not req or not store:
-        line_bot_api.reply_message(reply_token, TextSendMessage("予約情報を取得できませんでした。最初からやり直してください。"))
+        reply_or_push(user_id, reply_token,
+                      TextSendMessage(tr("book.info_lost", SESS.get(user_id, {}).get("lang", "jp"))),
+                      path="finalize_booking")
         return
 
     # ★重要：多重確定のガード（LINEの再送・連打対策）
     if req.get("confirmed"):
-        try:
-            line_bot_api.reply_message(
-                reply_token,
-                TextSendMessage(lang_text(SESS.get(user_id,{}).get("lang","jp"),
-                    "すでに予約は確定しています。", "Your booking is already confirmed."))
-            )
-        except Exception:
-            pass
+        reply_or_push(
+            user_id, reply_token,
+            TextSendMessage(tr("book.already_confirmed", SESS.get(user_id, {}).get("lang", "jp"))),
+            path="finalize_booking", fallback=False
+        )
+        return
+
+    # 空き枠からの即時候補は、確定前に枠が残っているか確認（埋まっていたら店舗へ照会）
+    wanted_dt = datetime.datetime.fromisoformat(store_slot_iso(req, pb["store_id"])).astimezone(JST)
+    fits_slot = consume_availability(store, pb["req_id"], wanted_dt, req["pax"] or 1)
+    if not fits_slot and store["store_id"] in req.get("instant", set()):
+        reinquire_after_slot_gone(reply_token, user_id, pb["req_id"], store)
         return
+    release_availability_holds(pb["req_id"])
 
     # まず確定印をつけて以降の重複を遮断
     req["confirmed"] = True
     req["store_id"]  = pb["store_id"]
+    req["wanted_iso"] = wanted_dt.isoformat()  # 複数の希望時間のうち、この店で入れる時間で確定
     req["name"]      = pb["name"]
     req["phone"]     = pb["phone"]
     req["closed"]    = True  # 以降の店舗OKは無視
+    log_event("confirmed", pb["req_id"], user_id, store=pb["store_id"])
+    end_booking_trace(pb["req_id"], "confirmed")
 
-    wanted_dt = datetime.datetime.fromisoformat(req["wanted_iso"]).astimezone(JST)
     tstr = wanted_dt.strftime("%H:%M")
-    pickup_label = "希望" if req.get("pickup") else "不要"
     hotel = req.get("hotel") or "-"
     lang_code = SESS.get(user_id, {}).get("lang", "jp")
-    foreign_hint = "\n※外国人のお客様（英語）" if lang_code == "en" else ""
 
     # --- 店舗へ確定連絡（REQなど不要情報は出さない） ---
-    store_msg = (
-        f"【予約確定】\n"
-        f"お名前：{pb['name']}\n"
-        f"電話：{pb['phone']}\n"
-        f"時間：{tstr}／{req['pax']}名\n"
-        f"送迎：{pickup_label}（{hotel}）"
-        f"{foreign_hint}"
-    )
-    try:
-        line_bot_api.push_message(store["line_user_id"], TextSendMessage(store_msg))
-    except Exception as e:
-        print("push confirm to store failed:", e)
-
-    # --- ユーザーへ確定案内（JP/EN・送迎で警告文を分岐） ---
-    if lang_code == "jp":
-        if req.get("pickup"):
-            warning = (
-                "⚠️【重要なお知らせ（ドタキャン防止）】\n"
-                "・予約時間までに必ず『集合場所』へお越しください。\n"
-                "・遅れる場合は“予約時刻の15分前まで”に必ずお店へお電話ください。\n"
-                "・連絡なしの遅刻・不着は、予約を自動キャンセルします。\n"
-                "・キャンセル／変更はお電話のみで承ります。"
-            )
-        else:
-            warning = (
-                "⚠️【重要なお知らせ（ドタキャン防止）】\n"
-                "・予約時間までに必ずご来店ください。\n"
-                "・遅れる場合は“予約時刻の15分前まで”に必ずお店へお電話ください。\n"
-                "・連絡なしの遅刻・不着は、予約を自動キャンセルします。\n"
-                "・キャンセル／変更はお電話のみで承ります。"
-            )
-
-        user_msg = (
-            "【予約確定】\n"
-            f"\n店舗：{store['name']}\n"
-            f"時間：{tstr}／{req['pax']}名\n"
-            f"送迎：{pickup_label}（{hotel}）\n"
-            f"Googleマップ：{store['map_url']}\n"
-            f"\n{warning}"
-        )
-
-    else:
-        if req.get("pickup"):
-            warning = (
-                "⚠️ IMPORTANT (No-show prevention)\n"
-                "• Be at the meeting point by your reservation time.\n"
-                "• If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
-                "• Without notice, your booking will be automatically cancelled.\n"
-                "• Any change/cancellation by phone only."
-            )
-        else:
-            warning = (
-                "⚠️ IMPORTANT (No-show prevention)\n"
-                "• Arrive at the restaurant by your reservation time.\n"
-                "• If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
-                "• Without notice, your booking will be automatically cancelled.\n"
-                "• Any change/cancellation by phone only."
-            )
+    store_msg = tr("store.booked", name=pb["name"], phone=pb["phone"], time=tstr, pax=req["pax"],
+                   pickup=pickup_label("jp", req.get("pickup")), hotel=store_hotel_label(req), foreign=foreign_hint(lang_code))
+    safe_push(store["line_user_id"], TextSendMessage(store_msg), store["name"], path="finalize.store")
 
-        user_msg = (
-            "[Booking Confirmed]\n"
-            f"\nRestaurant: {store['name']}\n"
-            f"Time: {tstr} / {req['pax']} people\n"
-            f"Pickup: {'Need' if req.get('pickup') else 'No'} ({hotel})\n"
-            f"Google Maps: {store['map_url']}\n"
-            f"\n{warning}"
-        )
+    # --- ユーザーへ確定案内（言語別・送迎ありなら集合場所の警告文） ---
+    user_msg = tr("booked.body_pickup" if req.get("pickup") else "booked.body", lang_code,
+                  store=store["name"], time=tstr, pax=req["pax"], pickup=pickup_label(lang_code, req.get("pickup")),
+                  hotel=hotel, map_url=store["map_url"])
 
     # まず reply、失敗時のみ push（重複送信を避ける）
-    try:
-        line_bot_api.reply_message(reply_token, TextSendMessage(user_msg))
-    except Exception as e:
-        try:
-            line_bot_api.push_message(user_id, TextSendMessage(user_msg))
-            print("[FALLBACK] confirm reply→push:", e)
-        except Exception as e2:
-            print("[FALLBACK] confirm both failed:", e, e2)
+    reply_or_push(user_id, reply_token, TextSendMessage(user_msg), path="finalize.user")
 
     # --- 15分前リマインドをセット（多重防止つき） ---
     schedule_prearrival_reminder(pb["req_id"])
@@ -1359,3 +3809,80 @@ def finalize_booking(reply_token, user_id):
     PENDING_BOOK.pop(user_id, None)
 
 
+
+# ====== ウォームアップ（コールドスタート対策） ======
+# COLD_START_MODE=1 のときは、シート読込・ジョブDB・テンプレート生成を裏スレッドで行い、
+# import はすぐ返す（Render のスリープ明けで最初の webhook を待たせない）。
+# 0（既定）なら従来どおり import 中に同じ処理を済ませる。
+# webhook は店舗一覧の読込完了（STORES_READY）だけを最大 STORES_READY_TIMEOUT 秒待つ
+# （読込前の仮ストアで、店舗の返信をお客さま扱いしないため）。
+COLD_START_MODE = _env("COLD_START_MODE", "0") == "1"
+STORES_READY_TIMEOUT = float(_env("STORES_READY_TIMEOUT", "10"))
+STORES_READY = threading.Event()
+WARMUP = {"started_at": None, "done": False, "steps": {}, "error": None}
+
+
+def _warm_templates():
+    """固定メニューと、先頭 BUBBLE_WARM_STORES 店の候補カードを先に組み立ててキャッシュへ載せる"""
+    _menu_qreply("lang")
+    stores = STORES[:max(0, min(BUBBLE_WARM_STORES, BUBBLE_CACHE_MAX // max(len(LOCALES), 1)))]
+    for lang in LOCALES:
+        for kind in ("pax", "pickup"):
+            _menu_qreply(kind, lang)
+        for s in stores:
+            candidate_bubble(s, lang).as_json_dict()
+
+
+def warm_up():
+    WARMUP["started_at"] = now_jst().isoformat()
+    steps = (
+        ("stores", refresh_stores),
+        ("hotels", load_hotels),
+        ("jobs", ensure_job_runner),
+        ("templates", _warm_templates),
+    )
+    try:
+        for name, fn in steps:
+            t = time.perf_counter()
+            try:
+                fn()
+            finally:
+                if name == "stores":
+                    STORES_READY.set()  # 読込失敗でも、仮ストア/前回の一覧で受付は続ける
+            WARMUP["steps"][name] = round((time.perf_counter() - t) * 1000, 1)
+    except Exception as e:
+        WARMUP["error"] = repr(e)
+        print("[WARMUP] failed:", e)
+    WARMUP["done"] = True
+    print(f"[WARMUP] done steps(ms)={WARMUP['steps']} since boot={(time.perf_counter() - _BOOT_T0) * 1000:.0f}ms")
+
+
+def wait_stores_ready() -> bool:
+    if STORES_READY.is_set():
+        return True
+    ok = STORES_READY.wait(STORES_READY_TIMEOUT)
+    if not ok:
+        print(f"[WARMUP] stores not ready after {STORES_READY_TIMEOUT}s; handling with current list")
+    return ok
+
+
+# 起動確認（ロードバランサ/Render のヘルスチェック用）。ウォームアップ完了までは 503
+@app.route("/readyz")
+def readyz():
+    body = {
+        "ready": WARMUP["done"],
+        "stores_ready": STORES_READY.is_set(),
+        "stores": len(STORES),
+        "cold_start_mode": COLD_START_MODE,
+        "import_ms": IMPORT_TIMES,
+        "import_budget_ms": IMPORT_BUDGET_MS,
+        "warmup": WARMUP,
+    }
+    return body, (200 if WARMUP["done"] else 503)
+
+
+# 起動時：店舗一覧の読込とジョブ実行スレッドの開始（止まっている間に期限の来たジョブは、種類ごとの規則で実行 or スキップ）
+if COLD_START_MODE:
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+else:
+    warm_up()
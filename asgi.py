@@ -0,0 +1,230 @@
+"""
+ASGI エントリ（非同期版）。
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+/webhook は app.py と同じハンドラ（on_text / on_postback → start_inquiry / finalize_booking …）を
+そのまま使う。ハンドラ内の reply / push は app.OUTBOX に溜まり、ここで line-bot-sdk の
+AsyncLineBotApi（共有 aiohttp セッション）から asyncio.gather で送る。
+店舗への一斉送信も同時実行数を ASYNC_PUSH_CONCURRENCY に絞って並列に送るので、
+LINE API が遅いときでもワーカーのスレッドを塞がない。
+それ以外のパス（/admin/...）は Flask アプリをスレッドで呼び出す。
+"""
+import asyncio, io, os, sys, time
+
+import aiohttp
+from linebot import AsyncLineBotApi
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+
+import app as bot
+
+ASYNC_PUSH_CONCURRENCY = int(os.getenv("ASYNC_PUSH_CONCURRENCY", "10"))
+
+_state = {"session": None, "api": None, "sem": None}
+_background = set()  # 送信タスクの参照を保持（GC 防止）
+
+
+# ====== 送信（OUTBOX を async クライアントで流す） ======
+def _open_client():
+    """共有 aiohttp セッションと async クライアント（lifespan 非対応サーバでは初回送信時に作る）"""
+    if _state["api"] is None:
+        session = aiohttp.ClientSession()
+        _state["session"] = session
+        _state["api"] = AsyncLineBotApi(bot.LINE_CHANNEL_ACCESS_TOKEN, AiohttpAsyncHttpClient(session))
+        _state["sem"] = asyncio.Semaphore(ASYNC_PUSH_CONCURRENCY)
+
+
+async def _send_reply_item(api, item):
+    _, user_id, reply_token, msgs, path, fallback, trace = item
+    rest = msgs
+    if reply_token:
+        head = msgs[:bot.REPLY_MAX_MESSAGES]
+        try:
+            with bot.outbound_load(), bot.trace_span("line.reply", parent=trace, path=path):
+                await api.reply_message(reply_token, head[0] if len(head) == 1 else head)
+            bot._count_outbound(path, "reply")
+            rest = msgs[bot.REPLY_MAX_MESSAGES:]
+        except Exception as e:
+            print(f"[FALLBACK] {path} reply→push", e)
+            bot._count_outbound(path, "fallback")
+    if not rest or not fallback:
+        return
+    if not user_id:
+        print(f"[FALLBACK] {path} reply unavailable (no user_id)")
+        bot._count_outbound(path, "fail")
+        return
+    for chunk in bot._chunks(rest):
+        await _push(api, user_id, chunk, path, trace=trace)
+
+
+async def _push(api, uid, message, path, store_name="", trace=None):
+    # 混雑度には同時実行数の空き待ちも含める（送信が詰まっていることを app 側の受付制御に伝える）
+    with bot.outbound_load():
+        async with _state["sem"]:
+            try:
+                with bot.trace_span("line.push", parent=trace, path=path) as span:
+                    await api.push_message(uid, message)
+                    span["ok"] = True
+                print(f"[PUSH OK] {store_name} {uid}")
+                bot._count_outbound(path, "push")
+                bot.record_delivery(uid, True)
+                return True
+            except LineBotApiError as e:
+                detail = getattr(e, "error", None)
+                print(f"[PUSH NG] {store_name} {uid} status={getattr(e,'status_code',None)} detail={detail}")
+                bot.record_delivery(uid, False, getattr(e, "status_code", None))
+            except Exception as e:
+                print(f"[PUSH NG] {store_name} {uid} err={e}")
+                bot.record_delivery(uid, False)
+            bot._count_outbound(path, "fail")
+            return False
+
+
+async def _send_to_one(api, items):
+    """同じ宛先への送信は順番を保つ"""
+    for item in items:
+        if item[0] == "reply":
+            await _send_reply_item(api, item)
+        else:
+            _, uid, msgs, path, store_name, trace, push_log = item
+            ok = True
+            for chunk in bot._chunks(msgs):
+                ok = await _push(api, uid, chunk, path, store_name, trace) and ok
+            if push_log:  # safe_push が PUSH_QUEUED を返して記録を任せた分
+                await asyncio.to_thread(bot.log_push_results, push_log, ok)
+
+
+async def flush_outbox(items):
+    _open_client()
+    by_dest = {}
+    for item in items:
+        by_dest.setdefault(item[1], []).append(item)
+    await asyncio.gather(*(_send_to_one(_state["api"], group) for group in by_dest.values()))
+
+
+# ====== /webhook ======
+def _handle_sync(text: str, signature: str, box: list):
+    """署名検証とハンドラ実行。SQLite（ジョブ登録）やログ書き込みがあるのでスレッドで動かす"""
+    token = bot.OUTBOX.set(box)
+    t0 = time.perf_counter()
+    try:
+        bot.handle_webhook_body(text, signature)
+        if bot.WEBHOOK_RECORD_PATH:
+            bot.record_webhook(text, (time.perf_counter() - t0) * 1000)
+    except InvalidSignatureError:
+        pass  # Flask 版と同じく 200 を返す
+    finally:
+        bot.OUTBOX.reset(token)
+
+
+async def handle_webhook(body: bytes, signature: str):
+    """ハンドラはスレッドで実行し（イベントループを止めない）、送信だけを非同期で後から流す"""
+    if not bot.STORES_READY.is_set():
+        await asyncio.to_thread(bot.wait_stores_ready)
+    box = []
+    # to_thread は呼び出し時のコンテキストをコピーして渡す → OUTBOX の set/reset はそのコピーの中で閉じる
+    await asyncio.to_thread(_handle_sync, body.decode("utf-8"), signature, box)
+    if box:
+        task = asyncio.create_task(flush_outbox(box))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+
+# ====== Flask へのブリッジ（/admin など） ======
+def _wsgi_environ(scope, body: bytes):
+    headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_TYPE": headers.pop("content-type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    headers.pop("content-length", None)
+    for k, v in headers.items():
+        environ["HTTP_" + k.upper().replace("-", "_")] = v
+    return environ
+
+
+def _call_flask(scope, body: bytes):
+    result = {}
+
+    def start_response(status, headers, exc_info=None):
+        result["status"] = int(status.split(" ", 1)[0])
+        result["headers"] = headers
+
+    chunks = bot.app.wsgi_app(_wsgi_environ(scope, body), start_response)
+    try:
+        payload = b"".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return result["status"], result["headers"], payload
+
+
+# ====== ASGI アプリ ======
+async def _read_body(receive) -> bytes:
+    parts = []
+    while True:
+        msg = await receive()
+        parts.append(msg.get("body", b""))
+        if not msg.get("more_body"):
+            return b"".join(parts)
+
+
+async def _respond(send, status: int, body: bytes, headers=None):
+    hdrs = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in (headers or [("content-type", "text/plain; charset=utf-8")])]
+    await send({"type": "http.response.start", "status": status, "headers": hdrs})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            _open_client()
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            if _background:
+                await asyncio.gather(*_background, return_exceptions=True)
+            if _state["session"]:
+                await _state["session"].close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = await _read_body(receive)
+    bot.ensure_job_runner()
+    if scope["path"].rstrip("/") == "/webhook":
+        print("[WEBHOOK] method=", scope["method"], "path=", scope["path"], "(async)")
+        if scope["method"] == "POST":
+            signature = ""
+            for k, v in scope.get("headers", []):
+                if k.lower() == b"x-line-signature":
+                    signature = v.decode("latin-1")
+            await handle_webhook(body, signature)
+        await _respond(send, 200, b"OK")
+        return
+
+    status, headers, payload = await asyncio.to_thread(_call_flask, scope, body)
+    await _respond(send, status, payload, headers)
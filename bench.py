@@ -0,0 +1,164 @@
+"""
+簡易ベンチマーク（本番には影響しない）。
+
+    python bench.py            # すべて実行
+    python bench.py intent     # 名前を指定して個別に実行
+"""
+import csv, io, os, re, sys, time, timeit, tracemalloc, unicodedata
+
+# app を import するためのダミー値（LINE API は呼ばない）
+os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+os.environ.setdefault("LINE_CHANNEL_SECRET", "bench")
+
+import app  # noqa: E402
+
+
+def _report(name, n, seconds):
+    print(f"{name:<40} {seconds / n * 1e6:8.2f} µs/op  ({n} ops)")
+
+
+# ====== インテント判定：従来の if/re チェーン vs Aho–Corasick ======
+INTENT_SAMPLES = [
+    "予約 / Reserve", "予約する", "reserve", "店舗登録 島料理 A", "店舗登録　居酒屋 B",
+    "6", "ホテル日航八重山", "Hotel Nikko Yaeyama", "山田 太郎", "cancel", "help",
+    "预约", "예약", "キャンセル", "予約をキャンセル", "help me",
+    "Please tell me more about pickup", "07012345678",
+]
+
+
+def _legacy_chain(text):
+    text = (text or "").strip()
+    if re.match(r"^店舗登録(?:\s+|　)(.+)$", text):
+        return "register"
+    re.match(r"^\d{1,2}$", text)
+    s = unicodedata.normalize("NFKC", (text or "")).strip().lower()
+    if s in {"予約をはじめる", "予約する", "予約をする", "start reservation", "reserve",
+             "予約/reserve", "予約する/reserve", "予約 / reserve", "予約する / reserve"}:
+        return "start"
+    if "予約" in s and ("reserve" in s or "reservation" in s):
+        return "start"
+    return None
+
+
+def bench_intent(n=20000):
+    samples = INTENT_SAMPLES
+    t = timeit.timeit(lambda: [_legacy_chain(x) for x in samples], number=n // len(samples))
+    _report("intent: legacy chain (ja/en only)", n, t)
+    t = timeit.timeit(lambda: [app.route_intent(x) for x in samples], number=n // len(samples))
+    _report("intent: route_intent (ja/en/zh/ko)", n, t)
+
+
+# ====== 店舗シート読込：従来の dict 行 vs Store（__slots__・intern） ======
+def _store_sheet(rows=20000):
+    out = io.StringIO()
+    w = csv.writer(out)
+    w.writerow(["store_id", "name", "profile", "map_url", "pickup_ok", "pickup_point",
+                "instagram_url", "line_user_id", "open_slots", "open_slots_date"])
+    for i in range(rows):
+        w.writerow([f"ST{i}", f"店舗 {i}", "港から車5分。石垣牛と島野菜。", f"https://maps.app.goo.gl/{i:08d}",
+                    "可" if i % 3 else "不可", "離島ターミナル前" if i % 2 else "", "",
+                    f"U{i:032x}", "19:00-21:00/6" if i % 5 == 0 else "", "2026-10-19" if i % 5 == 0 else ""])
+    return out.getvalue()
+
+
+def _legacy_store_rows(body):
+    stores = []
+    for row in csv.DictReader(io.StringIO(body.decode("utf-8"))):  # 従来: resp.text → StringIO
+        sid = (row.get("store_id") or "").strip()
+        if not sid:
+            continue
+        stores.append({
+            "store_id": sid, "name": (row.get("name") or "").strip(), "profile": (row.get("profile") or "").strip(),
+            "map_url": (row.get("map_url") or "").strip(), "pickup_ok": app._parse_bool(row.get("pickup_ok")),
+            "pickup_point": (row.get("pickup_point") or "").strip(),
+            "instagram_url": (row.get("instagram_url") or "").strip(),
+            "line_user_id": (row.get("line_user_id") or "").strip(),
+            "open_slots": (row.get("open_slots") or "").strip(),
+            "open_slots_date": app._parse_sheet_date(row.get("open_slots_date")),
+        })
+    return stores
+
+
+def bench_stores(rows=20000):
+    body = _store_sheet(rows).encode("utf-8")  # 受信したレスポンス本文に相当
+    streamed = lambda b: app.parse_store_rows(io.TextIOWrapper(io.BytesIO(b), encoding="utf-8-sig", newline=""))[0]
+    for label, parse in (("stores: dict rows (legacy)", _legacy_store_rows),
+                         ("stores: streamed Store slots", streamed)):
+        t0 = time.perf_counter()
+        result = parse(body)
+        _report(label, rows, time.perf_counter() - t0)
+        del result
+        tracemalloc.start()
+        result = parse(body)
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{'':<40} {kept / 2**20:8.2f} MB kept / {peak / 2**20:.2f} MB peak for {len(result)} stores")
+        del result
+
+
+# ====== 文面：従来のインライン f-string vs カタログ（起動時にコンパイル） ======
+def _legacy_booked(lang, store, tstr, pax, pickup, hotel):
+    if lang == "jp":
+        warning = (
+            "⚠️【重要なお知らせ（ドタキャン防止）】\n"
+            + ("・予約時間までに必ず『集合場所』へお越しください。\n" if pickup else "・予約時間までに必ずご来店ください。\n")
+            + "・遅れる場合は“予約時刻の15分前まで”に必ずお店へお電話ください。\n"
+            "・連絡なしの遅刻・不着は、予約を自動キャンセルします。\n"
+            "・キャンセル／変更はお電話のみで承ります。"
+        )
+        return ("【予約確定】\n"
+                f"\n店舗：{store['name']}\n"
+                f"時間：{tstr}／{pax}名\n"
+                f"送迎：{'希望' if pickup else '不要'}（{hotel}）\n"
+                f"Googleマップ：{store['map_url']}\n"
+                f"\n{warning}")
+    warning = (
+        "⚠️ IMPORTANT (No-show prevention)\n"
+        + ("• Be at the meeting point by your reservation time.\n" if pickup
+           else "• Arrive at the restaurant by your reservation time.\n")
+        + "• If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
+        "• Without notice, your booking will be automatically cancelled.\n"
+        "• Any change/cancellation by phone only."
+    )
+    return ("[Booking Confirmed]\n"
+            f"\nRestaurant: {store['name']}\n"
+            f"Time: {tstr} / {pax} people\n"
+            f"Pickup: {'Need' if pickup else 'No'} ({hotel})\n"
+            f"Google Maps: {store['map_url']}\n"
+            f"\n{warning}")
+
+
+def _catalog_booked(lang, store, tstr, pax, pickup, hotel):
+    return app.tr("booked.body_pickup" if pickup else "booked.body", lang, store=store["name"], time=tstr, pax=pax,
+                  pickup=app.pickup_label(lang, pickup), hotel=hotel, map_url=store["map_url"])
+
+
+def bench_messages(n=50000):
+    import catalog
+    t0 = time.perf_counter()
+    catalog.compile_catalog()
+    print(f"{'messages: compile catalog':<40} {(time.perf_counter() - t0) * 1000:8.2f} ms  "
+          f"({sum(len(t) for t in catalog.COMPILED.values())} templates)")
+    store = app.STORES[0]
+    cases = [(lang, store, "19:00", 2, pickup, "Hotel X") for lang in ("jp", "en") for pickup in (False, True)]
+    for c in cases:
+        assert _legacy_booked(*c) == _catalog_booked(*c), c
+    for label, fn in (("messages: booked inline f-string (legacy)", _legacy_booked),
+                      ("messages: booked via catalog", _catalog_booked)):
+        t = timeit.timeit(lambda: [fn(*c) for c in cases], number=n // len(cases))
+        _report(label, n, t)
+    t = timeit.timeit(lambda: app.tr("ask.time", "ko"), number=n)
+    _report("messages: static message (ko)", n, t)
+
+
+BENCHES = {
+    "intent": bench_intent,
+    "stores": bench_stores,
+    "messages": bench_messages,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        BENCHES[name]()
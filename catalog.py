@@ -0,0 +1,560 @@
+"""
+メッセージカタログ（お客さま・店舗に送る文面）。
+
+    from catalog import render
+    render("confirm.body", "en", time="19:00", pax=2, pickup="No", hotel="-")
+
+- 文面は言語ごとの辞書 CATALOG[locale][key] に置く。言語を増やすときは辞書を1つ足すだけで、
+  ハンドラ側は触らない（足りないキーは FALLBACK の言語の文面を使う）。
+- {name} は呼び出し側が渡す値、{@key} は同じ言語の別の文面をそのまま埋め込む（警告文の共通化用）。
+- 起動時に compile_catalog() で {@key} を展開して1本の %-書式テンプレート（%(name)s）にしておくので、
+  呼び出しごとの組み立ては % 1回だけ（str.format_map より速い）。値を取らない文面は文字列そのものを返す。
+  書式指定（{n:02d} など）は使えない。
+- 店舗向け（store.*）は日本語だけ。
+"""
+import string
+
+LOCALE_NAMES = {"jp": "日本語", "en": "English", "zh-Hant": "繁體中文", "ko": "한국어"}
+# 店舗向けの「外国人のお客様（…）」表記
+LOCALE_NAMES_JP = {"jp": "日本語", "en": "英語", "zh-Hant": "繁体字中国語", "ko": "韓国語"}
+FALLBACK = {"en": "jp", "zh-Hant": "en", "ko": "en"}
+
+_WARN_CONFIRM_JP = (
+    "⚠️【重要なお知らせ（ドタキャン防止）】\n"
+    "・{@warn.confirm_where}\n"
+    "・遅れる場合は“予約時刻の15分前まで”に必ずお店へお電話ください。\n"
+    "・連絡なしの遅刻・不着は、予約を自動キャンセルします。\n"
+    "・キャンセル／変更はお電話のみで承ります。"
+)
+_WARN_CONFIRM_EN = (
+    "⚠️ IMPORTANT (No-show prevention)\n"
+    "• {@warn.confirm_where}\n"
+    "• If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
+    "• Without notice, your booking will be automatically cancelled.\n"
+    "• Any change/cancellation by phone only."
+)
+
+CATALOG = {
+    "jp": {
+        # 受付時間
+        "window.before_open": "ただいま準備中のため、予約受付は{open}からです。{open}以降にお試しください。",
+        "window.closed": "本日の予約受付は終了しました。{close}以降は、明日以降の日時でご予約ください。",
+        # 質問
+        "ask.time": "ご希望の時間を選んでください",
+        "ask.time_more": ("ほかに来店できる時間があれば選んでください（{chosen}・最大{max}つまで）。\n"
+                          "まとめてお店に聞くので、空きが見つかりやすくなります。"),
+        "label.time_done": "これで決定",
+        "ask.pax": "人数を選んでください",
+        "ask.pax_number": "人数を数字で入力してください（例：6）",
+        "ask.pickup": "送迎は必要ですか？",
+        "ask.hotel": "ホテル名をご記入ください。",
+        "ask.hotel_pick": "「{typed}」は、こちらのホテルですか？（違う場合は『入力のまま』を押してください）",
+        "label.pax": "{n}名",
+        "label.pax_more": "5名以上",
+        "label.need": "希望",
+        "label.no": "不要",
+        "label.hotel_as_typed": "入力のまま",
+        # 照会前の確認・修正
+        "confirm.body": ("この内容で照会します。\n"
+                         "時間：{time}\n人数：{pax}名\n送迎：{pickup}（{hotel}）\n\n"
+                         "よろしければ『照会を送る』を押してください。"),
+        "confirm.send": "照会を送る",
+        "confirm.edit": "内容を修正",
+        "confirm.restart": "最初から",
+        "edit.which": "どこを修正しますか？",
+        "edit.which_personal": "どちらを修正しますか？",
+        "edit.time": "時間を修正",
+        "edit.pax": "人数を修正",
+        "edit.pickup": "送迎を修正",
+        "edit.hotel": "ホテル名を修正",
+        "edit.name": "名前を修正",
+        "edit.phone": "電話を修正",
+        "edit.back": "修正なし（戻る）",
+        "session.missing": "情報が不足しています。最初からやり直してください。",
+        "session.not_found": "情報を取得できませんでした。最初からやり直してください。",
+        # 照会
+        "inquiry.ack_wait": "照会中です。最大{wait_min}分、候補が届き次第表示します。",
+        "inquiry.busy": "ただいま混み合っているため、お店への照会を少し遅らせて自動で送ります。候補は届き次第表示します（最大{wait_min}分）。",
+        "inquiry.ack_instant": "空き枠のあるお店が見つかりました。気になるお店の『この店に予約申請』を押してください。",
+        "inquiry.reused": "同じ内容で照会中です。届いている候補はこちらです。",
+        "inquiry.reused_wait": "同じ内容で照会中です。候補が届き次第表示します（最大{wait_min}分）。",
+        "inquiry.throttled": "短い間に照会が続いたため、受付を一時停止しています。約{wait_min}分後にもう一度お試しください。",
+        "inquiry.timeout": "現在、すべての登録店舗が満席でした。時間や人数を変えて再度お試しください。",
+        "inquiry.slot_gone": "申し訳ありません、{store} の空き枠が埋まってしまいました。お店に直接確認しています（最大10分）。",
+        "card.map": "Googleマップ",
+        "card.book": "この店に予約申請",
+        "card.time": "🕒 {time} からご案内できます",
+        # 予約（氏名・電話 → 確認 → 確定）
+        "book.ask_name": "お名前を入力してください（フルネーム）",
+        "book.ask_name_again": "正しいお名前を入力してください。",
+        "book.ask_phone": "電話番号を入力してください（例：07012345678）",
+        "book.bad_phone": "電話番号の形式で入力してください（例：07012345678）",
+        "book.review": ("【入力情報の確認】\n"
+                        "店舗：{store}\n"
+                        "時間：{time}\n"
+                        "人数：{pax}名\n"
+                        "送迎：{pickup}（{hotel}）\n"
+                        "お名前：{name}\n"
+                        "電話：{phone}\n\n"
+                        "この内容でよろしければ「予約確定」を押してください。"),
+        "book.confirm": "予約確定",
+        "book.edit_personal": "氏名/電話を修正",
+        "book.cancel": "やめる",
+        "book.already_confirmed": "すでに予約は確定しています。",
+        "book.session_lost": "セッションが見つかりませんでした。最初からやり直してください。",
+        "book.info_lost": "予約情報を取得できませんでした。最初からやり直してください。",
+        "warn.confirm_where": "予約時間までに必ずご来店ください。",
+        "warn.confirm_where_pickup": "予約時間までに必ず『集合場所』へお越しください。",
+        "warn.confirm": _WARN_CONFIRM_JP,
+        "warn.confirm_pickup": _WARN_CONFIRM_JP.replace("{@warn.confirm_where}", "{@warn.confirm_where_pickup}"),
+        "booked.body": ("【予約確定】\n"
+                        "\n店舗：{store}\n"
+                        "時間：{time}／{pax}名\n"
+                        "送迎：{pickup}（{hotel}）\n"
+                        "Googleマップ：{map_url}\n"
+                        "\n{@warn.confirm}"),
+        "booked.body_pickup": ("【予約確定】\n"
+                               "\n店舗：{store}\n"
+                               "時間：{time}／{pax}名\n"
+                               "送迎：{pickup}（{hotel}）\n"
+                               "Googleマップ：{map_url}\n"
+                               "\n{@warn.confirm_pickup}"),
+        # 15分前リマインド
+        "warn.reminder": ("⚠️ 必ず『予約時間までにご来店』ください。\n"
+                          "⏰ 遅れる場合は “予約時間の15分前まで” に必ずお店へお電話を！\n"
+                          "🚫 連絡なしの遅刻は『予約キャンセル』になります。"),
+        "warn.reminder_pickup": ("⚠️ 必ず時間までに『集合場所』へお越しください。\n"
+                                 "⏰ 遅れる場合は “予約時間の15分前まで” に必ずお店へお電話を！\n"
+                                 "🚫 連絡なしの遅刻・不着は『予約キャンセル』になります。"),
+        "reminder.body": ("【リマインド】このあと15分でご予約です。\n"
+                          "店舗：{store}\n"
+                          "時間：{time}／{pax}名\n"
+                          "送迎：{pickup}（{hotel}）\n"
+                          "Googleマップ：{map_url}\n\n"
+                          "{@warn.reminder}"),
+        "reminder.body_pickup": ("【リマインド】このあと15分でご予約です。\n"
+                                 "店舗：{store}\n"
+                                 "時間：{time}／{pax}名\n"
+                                 "送迎：{pickup}（{hotel}）\n"
+                                 "Googleマップ：{map_url}\n\n"
+                                 "{@warn.reminder_pickup}"),
+        # 案内
+        "guide.start": "下のリッチメニュー「予約 / Reserve」を押して開始してください。",
+        "guide.help": ("リッチメニューの「予約 / Reserve」を押すか「予約」と送ると予約を始められます。\n"
+                       "途中でやめるときは「キャンセル」と送ってください。"),
+        "guide.help_in_step": "{@guide.help}\n入力の途中です。続けて入力してください。",
+        "guide.cancelled": "予約の手続きを取り消しました。確定済みのご予約の変更・キャンセルはお店へお電話ください。",
+        # 店舗向け
+        "store.inquiry": ("【照会】{time}／{pax}名／送迎：{pickup}（{hotel}）{foreign}\n"
+                          "⏰ 締切：{deadline}（あと{remain}分）\n"
+                          "押すだけで返信👇"),
+        "store.inquiry_multi": ("【照会】{time}（左ほどご希望順）／{pax}名／送迎：{pickup}（{hotel}）{foreign}\n"
+                                "⏰ 締切：{deadline}（あと{remain}分）\n"
+                                "入れる時間を1つ押してください（どれも無理なら『不可』）👇"),
+        "store.inbox_alt": "【照会】未回答 {count}件（まとめて返信できます）",
+        "store.inbox_card": "【照会】{time}／{pax}名",
+        "store.inbox_card_detail": "送迎：{pickup}（{hotel}）{foreign}",
+        "store.inbox_card_deadline": "⏰ 締切：{deadline}（あと{remain}分）",
+        "store.inbox_empty": "未回答の照会はありません。",
+        "store.booked": ("【予約確定】\n"
+                         "お名前：{name}\n"
+                         "電話：{phone}\n"
+                         "時間：{time}／{pax}名\n"
+                         "送迎：{pickup}（{hotel}）"
+                         "{foreign}"),
+        "store.digest_head": "【15分前リマインド】{time} のご予約：{count}組／計{pax}名",
+        "store.digest_line": "・{name} 様／{pax}名／電話：{phone}／送迎：{pickup}（{hotel}）{foreign}",
+        "store.foreign_short": " ※外国人（{lang_name}）",
+        "store.foreign": "\n※外国人のお客様（{lang_name}）",
+    },
+    "en": {
+        "window.before_open": "We're preparing for service. Reservations open at {open}. Please try again after {open}.",
+        "window.closed": "Today's booking window has closed. After {close}, please book for tomorrow or a later date.",
+        "ask.time": "Choose your time",
+        "ask.time_more": ("Any other times that work for you? ({chosen}, up to {max})\n"
+                          "We ask restaurants about all of them at once, so a table is easier to find."),
+        "label.time_done": "That's all",
+        "ask.pax": "How many people?",
+        "ask.pax_number": "Please enter the number of people (e.g., 6).",
+        "ask.pickup": "Do you need pickup?",
+        "ask.hotel": "Please enter your hotel name.",
+        "ask.hotel_pick": "Did you mean one of these for “{typed}”? (If not, tap “Keep as typed”.)",
+        "label.pax": "{n}",
+        "label.pax_more": "5+",
+        "label.need": "Need",
+        "label.no": "No",
+        "label.hotel_as_typed": "Keep as typed",
+        "confirm.body": ("We will inquire with:\n"
+                         "Time: {time}\nParty: {pax}\nPickup: {pickup} ({hotel})\n\n"
+                         "If OK, tap “Send request”."),
+        "confirm.send": "Send request",
+        "confirm.edit": "Edit details",
+        "confirm.restart": "Start over",
+        "edit.which": "What would you like to edit?",
+        "edit.which_personal": "What would you like to edit?",
+        "edit.time": "Edit time",
+        "edit.pax": "Edit party",
+        "edit.pickup": "Edit pickup",
+        "edit.hotel": "Edit hotel",
+        "edit.name": "Edit name",
+        "edit.phone": "Edit phone",
+        "edit.back": "No change (back)",
+        "session.missing": "Session missing. Please start over.",
+        "session.not_found": "Session not found. Please start over.",
+        "inquiry.ack_wait": "Request sent. We’ll show options as they reply (up to {wait_min} min).",
+        "inquiry.busy": "We’re busy right now, so your request will be sent to restaurants automatically in a moment. We’ll show options as they reply (up to {wait_min} min).",
+        "inquiry.ack_instant": "We found restaurants with open tables. Tap “Book this place” on the one you like.",
+        "inquiry.reused": "This request is already in progress. Here are the options so far.",
+        "inquiry.reused_wait": "This request is already in progress. We’ll show options as they reply (up to {wait_min} min).",
+        "inquiry.throttled": "Too many requests in a short time. Please try again in about {wait_min} min.",
+        "inquiry.timeout": "All registered restaurants were full for your request. Please try another time or party size.",
+        "inquiry.slot_gone": "Sorry, the open table at {store} was just taken. We're asking the restaurant directly (up to 10 min).",
+        "card.map": "Google Maps",
+        "card.book": "Book this place",
+        "card.time": "🕒 Table available at {time}",
+        "book.ask_name": "Please enter your full name (alphabet).",
+        "book.ask_name_again": "Please enter your full name.",
+        "book.ask_phone": "Please enter your phone number with country code (e.g., +81 7012345678).",
+        "book.bad_phone": "Please enter a valid number (e.g., +81 7012345678).",
+        "book.review": ("[Please review your details]\n"
+                        "Restaurant: {store}\n"
+                        "Time: {time}\n"
+                        "Party: {pax}\n"
+                        "Pickup: {pickup} ({hotel})\n"
+                        "Name: {name}\n"
+                        "Phone: {phone}\n\n"
+                        "If everything looks good, tap “Confirm booking”."),
+        "book.confirm": "Confirm booking",
+        "book.edit_personal": "Edit name/phone",
+        "book.cancel": "Cancel",
+        "book.already_confirmed": "Your booking is already confirmed.",
+        "book.session_lost": "Session not found. Please start over.",
+        "book.info_lost": "Booking details not found. Please start over.",
+        "warn.confirm_where": "Arrive at the restaurant by your reservation time.",
+        "warn.confirm_where_pickup": "Be at the meeting point by your reservation time.",
+        "warn.confirm": _WARN_CONFIRM_EN,
+        "warn.confirm_pickup": _WARN_CONFIRM_EN.replace("{@warn.confirm_where}", "{@warn.confirm_where_pickup}"),
+        "booked.body": ("[Booking Confirmed]\n"
+                        "\nRestaurant: {store}\n"
+                        "Time: {time} / {pax} people\n"
+                        "Pickup: {pickup} ({hotel})\n"
+                        "Google Maps: {map_url}\n"
+                        "\n{@warn.confirm}"),
+        "booked.body_pickup": ("[Booking Confirmed]\n"
+                               "\nRestaurant: {store}\n"
+                               "Time: {time} / {pax} people\n"
+                               "Pickup: {pickup} ({hotel})\n"
+                               "Google Maps: {map_url}\n"
+                               "\n{@warn.confirm_pickup}"),
+        "warn.reminder": ("⚠️ Please arrive at the RESTAURANT ON TIME.\n"
+                          "⏰ If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
+                          "🚫 No-show or late without notice will be CANCELLED."),
+        "warn.reminder_pickup": ("⚠️ Please be at the PICKUP POINT ON TIME.\n"
+                                 "⏰ If you will be late, CALL the restaurant at least 15 minutes before your time.\n"
+                                 "🚫 No-show or late without notice will be CANCELLED."),
+        "reminder.body": ("[Reminder] Your table is in 15 minutes.\n"
+                          "Restaurant: {store}\n"
+                          "Time: {time} / {pax} people\n"
+                          "Pickup: {pickup} ({hotel})\n"
+                          "Google Maps: {map_url}\n\n"
+                          "{@warn.reminder}"),
+        "reminder.body_pickup": ("[Reminder] Your table is in 15 minutes.\n"
+                                 "Restaurant: {store}\n"
+                                 "Time: {time} / {pax} people\n"
+                                 "Pickup: {pickup} ({hotel})\n"
+                                 "Google Maps: {map_url}\n\n"
+                                 "{@warn.reminder_pickup}"),
+        "guide.start": "Please tap “予約 / Reserve” in the menu below to start.",
+        "guide.help": ("Tap “予約 / Reserve” in the menu or send “reserve” to start.\n"
+                       "Send “cancel” to stop at any time."),
+        "guide.help_in_step": "{@guide.help}\nYou are in the middle of a step. Please continue.",
+        "guide.cancelled": "Your reservation request was cancelled. To change a confirmed booking, please call the restaurant.",
+    },
+    "zh-Hant": {
+        "window.before_open": "目前準備中，預約將於 {open} 開始受理。請於 {open} 以後再試。",
+        "window.closed": "今日預約受理已結束。{close} 以後請預約明天或之後的日期。",
+        "ask.time": "請選擇希望的時間",
+        "ask.time_more": ("還有其他可以到店的時間嗎？（{chosen}，最多 {max} 個）\n"
+                          "我們會一次向店家詢問所有時間，更容易找到空位。"),
+        "label.time_done": "就這樣",
+        "ask.pax": "請選擇人數",
+        "ask.pax_number": "請以數字輸入人數（例：6）",
+        "ask.pickup": "需要接送嗎？",
+        "ask.hotel": "請輸入飯店名稱。",
+        "ask.hotel_pick": "「{typed}」是以下哪一家飯店嗎？（若都不是，請按「維持輸入內容」）",
+        "label.pax": "{n}位",
+        "label.pax_more": "5位以上",
+        "label.need": "需要",
+        "label.no": "不需要",
+        "label.hotel_as_typed": "維持輸入內容",
+        "confirm.body": ("將以下列內容詢問店家：\n"
+                         "時間：{time}\n人數：{pax}位\n接送：{pickup}（{hotel}）\n\n"
+                         "確認無誤請按「送出詢問」。"),
+        "confirm.send": "送出詢問",
+        "confirm.edit": "修改內容",
+        "confirm.restart": "重新開始",
+        "edit.which": "要修改哪一項？",
+        "edit.which_personal": "要修改哪一項？",
+        "edit.time": "修改時間",
+        "edit.pax": "修改人數",
+        "edit.pickup": "修改接送",
+        "edit.hotel": "修改飯店",
+        "edit.name": "修改姓名",
+        "edit.phone": "修改電話",
+        "edit.back": "不修改（返回）",
+        "session.missing": "資料不足，請重新開始。",
+        "session.not_found": "找不到資料，請重新開始。",
+        "inquiry.ack_wait": "詢問中。店家回覆後會立即顯示（最多 {wait_min} 分鐘）。",
+        "inquiry.busy": "目前較為繁忙，將稍後自動向店家送出詢問。店家回覆後會立即顯示（最多 {wait_min} 分鐘）。",
+        "inquiry.ack_instant": "找到有空位的餐廳了。請在喜歡的餐廳按「向這家店申請預約」。",
+        "inquiry.reused": "相同內容的詢問正在進行中。以下是目前收到的選項。",
+        "inquiry.reused_wait": "相同內容的詢問正在進行中。店家回覆後會立即顯示（最多 {wait_min} 分鐘）。",
+        "inquiry.throttled": "短時間內詢問次數過多，已暫停受理。請約 {wait_min} 分鐘後再試。",
+        "inquiry.timeout": "目前所有登錄的餐廳皆已客滿。請更改時間或人數後再試。",
+        "inquiry.slot_gone": "很抱歉，{store} 的空位剛剛已滿。我們正在直接向店家確認（最多 10 分鐘）。",
+        "card.map": "Google 地圖",
+        "card.book": "向這家店申請預約",
+        "card.time": "🕒 {time} 可入座",
+        "book.ask_name": "請輸入姓名（英文字母全名）",
+        "book.ask_name_again": "請輸入正確的姓名。",
+        "book.ask_phone": "請輸入含國碼的電話號碼（例：+886 912345678）",
+        "book.bad_phone": "請輸入正確的電話號碼（例：+886 912345678）",
+        "book.review": ("【請確認輸入內容】\n"
+                        "餐廳：{store}\n"
+                        "時間：{time}\n"
+                        "人數：{pax}位\n"
+                        "接送：{pickup}（{hotel}）\n"
+                        "姓名：{name}\n"
+                        "電話：{phone}\n\n"
+                        "確認無誤請按「確定預約」。"),
+        "book.confirm": "確定預約",
+        "book.edit_personal": "修改姓名/電話",
+        "book.cancel": "取消",
+        "book.already_confirmed": "您的預約已經確定。",
+        "book.session_lost": "找不到資料，請重新開始。",
+        "book.info_lost": "找不到預約資料，請重新開始。",
+        "warn.confirm_where": "請務必在預約時間前抵達餐廳。",
+        "warn.confirm_where_pickup": "請務必在預約時間前抵達「集合地點」。",
+        "warn.confirm": ("⚠️【重要通知（防止未到）】\n"
+                         "・{@warn.confirm_where}\n"
+                         "・若會遲到，請務必在預約時間 15 分鐘前致電餐廳。\n"
+                         "・未聯絡而遲到或未到，預約將自動取消。\n"
+                         "・取消／變更僅受理電話聯絡。"),
+        "warn.confirm_pickup": ("⚠️【重要通知（防止未到）】\n"
+                                "・{@warn.confirm_where_pickup}\n"
+                                "・若會遲到，請務必在預約時間 15 分鐘前致電餐廳。\n"
+                                "・未聯絡而遲到或未到，預約將自動取消。\n"
+                                "・取消／變更僅受理電話聯絡。"),
+        "booked.body": ("【預約確定】\n"
+                        "\n餐廳：{store}\n"
+                        "時間：{time}／{pax}位\n"
+                        "接送：{pickup}（{hotel}）\n"
+                        "Google 地圖：{map_url}\n"
+                        "\n{@warn.confirm}"),
+        "booked.body_pickup": ("【預約確定】\n"
+                               "\n餐廳：{store}\n"
+                               "時間：{time}／{pax}位\n"
+                               "接送：{pickup}（{hotel}）\n"
+                               "Google 地圖：{map_url}\n"
+                               "\n{@warn.confirm_pickup}"),
+        "warn.reminder": ("⚠️ 請務必準時抵達餐廳。\n"
+                          "⏰ 若會遲到，請務必在預約時間 15 分鐘前致電餐廳！\n"
+                          "🚫 未聯絡而遲到，預約將被取消。"),
+        "warn.reminder_pickup": ("⚠️ 請務必準時抵達「集合地點」。\n"
+                                 "⏰ 若會遲到，請務必在預約時間 15 分鐘前致電餐廳！\n"
+                                 "🚫 未聯絡而遲到或未到，預約將被取消。"),
+        "reminder.body": ("【提醒】您的預約將在 15 分鐘後開始。\n"
+                          "餐廳：{store}\n"
+                          "時間：{time}／{pax}位\n"
+                          "接送：{pickup}（{hotel}）\n"
+                          "Google 地圖：{map_url}\n\n"
+                          "{@warn.reminder}"),
+        "reminder.body_pickup": ("【提醒】您的預約將在 15 分鐘後開始。\n"
+                                 "餐廳：{store}\n"
+                                 "時間：{time}／{pax}位\n"
+                                 "接送：{pickup}（{hotel}）\n"
+                                 "Google 地圖：{map_url}\n\n"
+                                 "{@warn.reminder_pickup}"),
+        "guide.start": "請按下方選單的「予約 / Reserve」開始。",
+        "guide.help": ("按選單的「予約 / Reserve」或傳送「reserve」即可開始預約。\n"
+                       "中途想停止時請傳送「cancel」。"),
+        "guide.help_in_step": "{@guide.help}\n目前正在輸入中，請繼續輸入。",
+        "guide.cancelled": "已取消預約手續。已確定預約的變更或取消，請致電餐廳。",
+    },
+    "ko": {
+        "window.before_open": "현재 준비 중입니다. 예약은 {open}부터 받습니다. {open} 이후에 다시 시도해 주세요.",
+        "window.closed": "오늘 예약 접수가 종료되었습니다. {close} 이후에는 내일 이후 날짜로 예약해 주세요.",
+        "ask.time": "희망 시간을 선택해 주세요",
+        "ask.time_more": ("방문 가능한 다른 시간이 있으면 선택해 주세요 ({chosen}, 최대 {max}개)\n"
+                          "모든 시간을 한 번에 가게에 문의하므로 빈자리를 찾기 쉬워집니다."),
+        "label.time_done": "이대로",
+        "ask.pax": "인원을 선택해 주세요",
+        "ask.pax_number": "인원을 숫자로 입력해 주세요 (예: 6)",
+        "ask.pickup": "픽업이 필요하신가요?",
+        "ask.hotel": "호텔 이름을 입력해 주세요.",
+        "ask.hotel_pick": "'{typed}'은(는) 아래 호텔 중 하나인가요? (아니면 '입력한 대로'를 눌러 주세요.)",
+        "label.pax": "{n}명",
+        "label.pax_more": "5명 이상",
+        "label.need": "필요",
+        "label.no": "불필요",
+        "label.hotel_as_typed": "입력한 대로",
+        "confirm.body": ("다음 내용으로 문의합니다.\n"
+                         "시간: {time}\n인원: {pax}명\n픽업: {pickup} ({hotel})\n\n"
+                         "괜찮으시면 '문의 보내기'를 눌러 주세요."),
+        "confirm.send": "문의 보내기",
+        "confirm.edit": "내용 수정",
+        "confirm.restart": "처음부터",
+        "edit.which": "어떤 항목을 수정하시겠어요?",
+        "edit.which_personal": "어떤 항목을 수정하시겠어요?",
+        "edit.time": "시간 수정",
+        "edit.pax": "인원 수정",
+        "edit.pickup": "픽업 수정",
+        "edit.hotel": "호텔 수정",
+        "edit.name": "이름 수정",
+        "edit.phone": "전화 수정",
+        "edit.back": "수정 안 함 (돌아가기)",
+        "session.missing": "정보가 부족합니다. 처음부터 다시 해 주세요.",
+        "session.not_found": "정보를 찾을 수 없습니다. 처음부터 다시 해 주세요.",
+        "inquiry.ack_wait": "문의 중입니다. 가게의 답변이 오는 대로 보여 드립니다 (최대 {wait_min}분).",
+        "inquiry.busy": "지금은 혼잡하여 잠시 후 자동으로 가게에 문의를 보냅니다. 가게의 답변이 오는 대로 보여 드립니다 (최대 {wait_min}분).",
+        "inquiry.ack_instant": "빈자리가 있는 가게를 찾았습니다. 마음에 드는 가게의 '이 가게에 예약 신청'을 눌러 주세요.",
+        "inquiry.reused": "같은 내용으로 문의 중입니다. 지금까지 받은 후보입니다.",
+        "inquiry.reused_wait": "같은 내용으로 문의 중입니다. 가게의 답변이 오는 대로 보여 드립니다 (최대 {wait_min}분).",
+        "inquiry.throttled": "짧은 시간에 문의가 많아 접수를 잠시 멈췄습니다. 약 {wait_min}분 후에 다시 시도해 주세요.",
+        "inquiry.timeout": "현재 등록된 모든 가게가 만석입니다. 시간이나 인원을 바꿔 다시 시도해 주세요.",
+        "inquiry.slot_gone": "죄송합니다. {store}의 빈자리가 방금 찼습니다. 가게에 직접 확인하고 있습니다 (최대 10분).",
+        "card.map": "Google 지도",
+        "card.book": "이 가게에 예약 신청",
+        "card.time": "🕒 {time}에 안내 가능",
+        "book.ask_name": "성함을 입력해 주세요 (영문 풀네임)",
+        "book.ask_name_again": "올바른 성함을 입력해 주세요.",
+        "book.ask_phone": "국가번호를 포함한 전화번호를 입력해 주세요 (예: +82 1012345678)",
+        "book.bad_phone": "올바른 전화번호를 입력해 주세요 (예: +82 1012345678)",
+        "book.review": ("[입력 내용 확인]\n"
+                        "가게: {store}\n"
+                        "시간: {time}\n"
+                        "인원: {pax}명\n"
+                        "픽업: {pickup} ({hotel})\n"
+                        "성함: {name}\n"
+                        "전화: {phone}\n\n"
+                        "이 내용이 맞으면 '예약 확정'을 눌러 주세요."),
+        "book.confirm": "예약 확정",
+        "book.edit_personal": "이름/전화 수정",
+        "book.cancel": "그만두기",
+        "book.already_confirmed": "이미 예약이 확정되었습니다.",
+        "book.session_lost": "정보를 찾을 수 없습니다. 처음부터 다시 해 주세요.",
+        "book.info_lost": "예약 정보를 찾을 수 없습니다. 처음부터 다시 해 주세요.",
+        "warn.confirm_where": "예약 시간까지 반드시 가게에 도착해 주세요.",
+        "warn.confirm_where_pickup": "예약 시간까지 반드시 '집합 장소'에 와 주세요.",
+        "warn.confirm": ("⚠️ [중요 안내 (노쇼 방지)]\n"
+                         "• {@warn.confirm_where}\n"
+                         "• 늦을 경우 예약 시간 15분 전까지 반드시 가게에 전화해 주세요.\n"
+                         "• 연락 없는 지각·노쇼는 예약이 자동 취소됩니다.\n"
+                         "• 취소/변경은 전화로만 가능합니다."),
+        "warn.confirm_pickup": ("⚠️ [중요 안내 (노쇼 방지)]\n"
+                                "• {@warn.confirm_where_pickup}\n"
+                                "• 늦을 경우 예약 시간 15분 전까지 반드시 가게에 전화해 주세요.\n"
+                                "• 연락 없는 지각·노쇼는 예약이 자동 취소됩니다.\n"
+                                "• 취소/변경은 전화로만 가능합니다."),
+        "booked.body": ("[예약 확정]\n"
+                        "\n가게: {store}\n"
+                        "시간: {time} / {pax}명\n"
+                        "픽업: {pickup} ({hotel})\n"
+                        "Google 지도: {map_url}\n"
+                        "\n{@warn.confirm}"),
+        "booked.body_pickup": ("[예약 확정]\n"
+                               "\n가게: {store}\n"
+                               "시간: {time} / {pax}명\n"
+                               "픽업: {pickup} ({hotel})\n"
+                               "Google 지도: {map_url}\n"
+                               "\n{@warn.confirm_pickup}"),
+        "warn.reminder": ("⚠️ 반드시 시간에 맞춰 가게에 도착해 주세요.\n"
+                          "⏰ 늦을 경우 예약 시간 15분 전까지 반드시 가게에 전화해 주세요!\n"
+                          "🚫 연락 없는 지각은 예약이 취소됩니다."),
+        "warn.reminder_pickup": ("⚠️ 반드시 시간에 맞춰 '집합 장소'에 와 주세요.\n"
+                                 "⏰ 늦을 경우 예약 시간 15분 전까지 반드시 가게에 전화해 주세요!\n"
+                                 "🚫 연락 없는 지각·노쇼는 예약이 취소됩니다."),
+        "reminder.body": ("[리마인드] 15분 후 예약입니다.\n"
+                          "가게: {store}\n"
+                          "시간: {time} / {pax}명\n"
+                          "픽업: {pickup} ({hotel})\n"
+                          "Google 지도: {map_url}\n\n"
+                          "{@warn.reminder}"),
+        "reminder.body_pickup": ("[리마인드] 15분 후 예약입니다.\n"
+                                 "가게: {store}\n"
+                                 "시간: {time} / {pax}명\n"
+                                 "픽업: {pickup} ({hotel})\n"
+                                 "Google 지도: {map_url}\n\n"
+                                 "{@warn.reminder_pickup}"),
+        "guide.start": "아래 메뉴의 '予約 / Reserve'를 눌러 시작해 주세요.",
+        "guide.help": ("메뉴의 '予約 / Reserve'를 누르거나 'reserve'를 보내면 예약을 시작할 수 있습니다.\n"
+                       "중간에 그만두려면 'cancel'을 보내 주세요."),
+        "guide.help_in_step": "{@guide.help}\n입력 중입니다. 계속 입력해 주세요.",
+        "guide.cancelled": "예약 절차를 취소했습니다. 확정된 예약의 변경·취소는 가게에 전화해 주세요.",
+    },
+}
+
+
+# ====== コンパイル ======
+_FORMATTER = string.Formatter()
+COMPILED = {}   # locale -> key -> (値なしなら完成した文字列 / 値ありなら None, %-書式テンプレート)
+
+
+def _lookup(locale, key):
+    """locale → FALLBACK の順に探した生の文面"""
+    loc = locale
+    while loc:
+        table = CATALOG.get(loc, {})
+        if key in table:
+            return table[key]
+        loc = FALLBACK.get(loc)
+    raise KeyError(f"message not found: {key} ({locale})")
+
+
+def _expand(locale, key, names, stack=()):
+    """{@key} を展開し、{name} を %(name)s にしたテンプレート（使った name は names に足す）"""
+    if key in stack:
+        raise ValueError(f"message include loop: {' → '.join(stack + (key,))}")
+    out = []
+    for literal, field, spec, conv in _FORMATTER.parse(_lookup(locale, key)):
+        out.append(literal.replace("%", "%%"))
+        if field is None:
+            continue
+        if spec or conv:
+            raise ValueError(f"format spec is not supported: {locale}:{key} {{{field}}}")
+        if field.startswith("@"):
+            out.append(_expand(locale, field[1:], names, stack + (key,)))
+        else:
+            names.add(field)
+            out.append(f"%({field})s")
+    return "".join(out)
+
+
+def compile_catalog():
+    """全言語・全キーを展開しておく。訳で値の名前が日本語版と食い違っていれば警告"""
+    keys = set().union(*(t.keys() for t in CATALOG.values()))
+    base = {}
+    for locale in CATALOG:
+        table = {}
+        for key in keys:
+            names = set()
+            try:
+                fmt = _expand(locale, key, names)
+            except KeyError:
+                continue  # 店舗向け（日本語だけ）のキーなど
+            table[key] = (None if names else fmt.replace("%%", "%"), fmt)
+            if locale == "jp":
+                base[key] = names
+            elif key in base and names != base[key]:
+                print(f"[I18N] {locale}:{key} placeholders {sorted(names)} != jp {sorted(base[key])}")
+        COMPILED[locale] = table
+    return COMPILED
+
+
+def render(key, lang="jp", **values) -> str:
+    """key の文面を lang で（None は日本語）。未知の言語は英語、言語に無いキーは FALLBACK をたどる"""
+    static, fmt = (COMPILED.get(lang or "jp") or COMPILED["en"])[key]
+    return static if static is not None else fmt % values
+
+
+compile_catalog()
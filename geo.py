@@ -0,0 +1,158 @@
+"""
+位置（緯度・経度）まわり：ホテル名簿（地名辞書）と、店舗の空間インデックス。
+
+    import geo
+    hotels, bad = geo.load_gazetteer(open("hotels.csv", encoding="utf-8-sig", newline=""))
+    index = geo.HotelIndex(hotels, key=正規化関数)
+    index.lookup("ANA インターコンチネンタル")      # 名前・別名の完全一致 → Hotel / None
+    index.suggest("intercontinetal", n=3)          # あいまい一致 → [(類似度, Hotel), ...]
+    tree = geo.KDTree([(s.lat, s.lon, s) for s in stores])
+    tree.nearest(lat, lon, k=8, max_km=10, accept=lambda s: s.pickup_ok)   # → [(距離km, 店), ...]
+
+- ホテル名簿は外部の API を使わず、シートの CSV か手元のファイルから読む。列は
+  name（必須）, lat, lon, aliases（「|」区切りの別名・他言語表記）, pickup_point（送迎の集合場所）。
+- あいまい一致は正規化した名前・別名の文字 3-gram（前後に空白を補う）の Jaccard 係数。
+  多くの名前に出る 3-gram（"hot" "tel" など）は候補集めに使わず、まれな 3-gram で候補を
+  数十件に絞ってから係数を計算するので、数千件の名簿でも 1 件 1ms 未満で引ける。
+- 距離は島の中心付近の緯度で経度を縮めた平面（正距円筒）上の直線距離。島の中（数十 km）なら
+  大円距離との差は数 m なので、k-d 木の枝刈りとそのまま同じ物差しで使える。
+"""
+import collections, csv, heapq, itertools, math, unicodedata
+
+KM_PER_DEG_LAT = 110.574
+KM_PER_DEG_LON_EQUATOR = 111.320
+
+
+def valid_coord(lat, lon) -> bool:
+    return lat is not None and lon is not None and -90 <= lat <= 90 and -180 <= lon <= 180
+
+
+def parse_coord(v: str):
+    """'24.3448' → 24.3448（空欄・読めない値は None）"""
+    s = unicodedata.normalize("NFKC", v or "").strip()
+    if not s:
+        return None
+    try:
+        x = float(s)
+    except ValueError:
+        return None
+    return x if math.isfinite(x) else None
+
+
+# ====== ホテル名簿（名前 → 正式名・座標・集合場所） ======
+Hotel = collections.namedtuple("Hotel", "name lat lon pickup_point")
+
+
+def load_gazetteer(lines):
+    """CSV の行 → ([(Hotel, [名前, 別名, ...]), ...], 座標が読めなかった行数)。座標の無いホテルも名前の照合には使う"""
+    hotels, bad = [], 0
+    for row in csv.DictReader(lines):
+        name = (row.get("name") or "").strip()
+        if not name:
+            continue
+        lat, lon = parse_coord(row.get("lat")), parse_coord(row.get("lon"))
+        if not valid_coord(lat, lon):
+            if (row.get("lat") or "").strip() or (row.get("lon") or "").strip():
+                bad += 1
+            lat = lon = None
+        aliases = [a.strip() for a in (row.get("aliases") or "").split("|") if a.strip()]
+        hotels.append((Hotel(name, lat, lon, (row.get("pickup_point") or "").strip()), [name] + aliases))
+    return hotels, bad
+
+
+def trigrams(key: str) -> frozenset:
+    s = f"  {key} "
+    return frozenset(s[i:i + 3] for i in range(len(s) - 2))
+
+
+class HotelIndex:
+    """ホテル名・別名の索引。完全一致は dict、あいまい一致は 3-gram の転置索引（作ったあとは読み取り専用）"""
+
+    def __init__(self, hotels, key):
+        self.key = key
+        self.exact = {}       # 正規化名 -> Hotel
+        self.terms = []       # (3-gram の集合, Hotel)
+        self.postings = {}    # 3-gram -> [terms の添字]
+        for hotel, names in hotels:
+            for name in names:
+                k = key(name)
+                if not k or k in self.exact:
+                    continue
+                self.exact[k] = hotel
+                grams = trigrams(k)
+                for g in grams:
+                    self.postings.setdefault(g, []).append(len(self.terms))
+                self.terms.append((grams, hotel))
+        self.size = len(hotels)
+        self._common = max(50, len(self.terms) // 20)  # これより多くの名前に出る 3-gram は候補集めに使わない
+
+    def lookup(self, text: str):
+        return self.exact.get(self.key(text))
+
+    def suggest(self, text: str, n: int = 3, min_score: float = 0.3):
+        """似ている順に [(類似度, Hotel), ...]（同じホテルは別名のうち一番似ているもので1件）"""
+        k = self.key(text)
+        if not k or not self.terms:
+            return []
+        grams = trigrams(k)
+        lists = sorted((self.postings[g] for g in grams if g in self.postings), key=len)
+        hits = collections.Counter()
+        for ids in [ids for ids in lists if len(ids) <= self._common] or lists[:3]:
+            hits.update(ids)
+        best = {}
+        for i, _ in hits.most_common(n * 10):
+            tg, hotel = self.terms[i]
+            common = len(grams & tg)
+            score = common / (len(grams) + len(tg) - common)
+            if score >= min_score and score > best.get(hotel.name, (0.0,))[0]:
+                best[hotel.name] = (score, hotel)
+        return sorted(best.values(), key=lambda b: -b[0])[:n]
+
+
+# ====== 空間インデックス（k-d 木） ======
+class KDTree:
+    """(lat, lon, payload) の k-d 木。作ったあとは読み取り専用（店舗一覧を入れ替えたら作り直す）"""
+    __slots__ = ("_root", "_kx", "size")
+
+    def __init__(self, items):
+        items = [(lat, lon, p) for lat, lon, p in items if valid_coord(lat, lon)]
+        lat0 = sum(i[0] for i in items) / len(items) if items else 0.0
+        self._kx = KM_PER_DEG_LON_EQUATOR * math.cos(math.radians(lat0))
+        self.size = len(items)
+        self._root = self._build([(lon * self._kx, lat * KM_PER_DEG_LAT, p) for lat, lon, p in items], 0)
+
+    def _build(self, pts, axis):
+        if not pts:
+            return None
+        pts.sort(key=lambda pt: pt[axis])
+        m = len(pts) // 2
+        return (pts[m], axis, self._build(pts[:m], 1 - axis), self._build(pts[m + 1:], 1 - axis))
+
+    def nearest(self, lat, lon, k=None, max_km=None, accept=None):
+        """近い順に [(距離km, payload), ...]。k 件まで（None なら制限なし）・max_km 以内・accept(payload) が真のものだけ"""
+        qx, qy = lon * self._kx, lat * KM_PER_DEG_LAT
+        limit = math.inf if max_km is None else max_km
+        k = math.inf if k is None else k
+        best = []             # (-距離, 通し番号, payload) … 最も遠いものが先頭
+        seq = itertools.count()
+
+        def bound():
+            return limit if len(best) < k else min(limit, -best[0][0])
+
+        def visit(node):
+            if node is None:
+                return
+            pt, axis, left, right = node
+            d = math.hypot(pt[0] - qx, pt[1] - qy)
+            if d <= bound() and (accept is None or accept(pt[2])):
+                heapq.heappush(best, (-d, next(seq), pt[2]))
+                if len(best) > k:
+                    heapq.heappop(best)
+            diff = (qx, qy)[axis] - pt[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            visit(near)
+            if abs(diff) <= bound():
+                visit(far)
+
+        visit(self._root)
+        return [(-nd, p) for nd, _, p in sorted(best, key=lambda b: (-b[0], b[1]))]
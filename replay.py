@@ -0,0 +1,178 @@
+"""
+記録した webhook（WEBHOOK_RECORD_PATH）の再生。LINE API は呼ばずに送信内容を記録する。
+
+    python replay.py rec.ndjson --out a.json                   # 記録どおりの間隔（1倍速）
+    python replay.py rec.ndjson --speed 10 --out b.json        # 10倍速
+    python replay.py rec.ndjson --speed max --compare a.json   # 待たずに流し、前回の結果と比較
+
+- 1件ずつ /webhook へ POST（署名はここで付け直す）し、処理時間と、その間の reply / push を記録する。
+- 時計は仮想時計（app.VirtualClock）にして記録時刻まで進めるので、受付時間帯の判定や REQ-ID は記録時と同じになる。
+  店舗への段階送信などタイマーで動く送信やジョブも、記録の時刻の間隔どおりに（実時間は待たずに）動く。
+- --compare には別ビルドで出力した --out を渡す（新旧ビルドそれぞれの replay.py で実行）。
+  送信内容が変わったイベントと、処理時間の p50 / p90 / p99 の差を表示する。
+- 最後に時計を --drain 秒だけ進めてから集計する（待つのは仮想時間）。
+"""
+import argparse, base64, datetime, hashlib, hmac, json, os, sys, tempfile, threading, time
+
+# app を import する前に、本番の送信・記録・ログを無効にする
+os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "replay"
+os.environ["LINE_CHANNEL_SECRET"] = "replay"
+os.environ["WEBHOOK_RECORD_PATH"] = ""
+os.environ.setdefault("EVENT_LOG_PATH", "")
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="replay-"), "jobs.sqlite3"))
+
+import app  # noqa: E402
+
+
+# ====== LINE API の代わり ======
+class StubLineApi:
+    """送信内容を current イベントの番号付きで溜める（--stub-latency-ms で API の遅さを再現）"""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.sent = []
+        self.current = -1
+        self.lock = threading.Lock()
+
+    def _record(self, kind, dest, messages):
+        if self.latency:
+            time.sleep(self.latency)
+        msgs = messages if isinstance(messages, list) else [messages]
+        with self.lock:
+            self.sent.append((self.current, kind, dest, [m.as_json_dict() for m in msgs]))
+
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        self._record("reply", reply_token, messages)
+
+    def push_message(self, to, messages, *args, **kwargs):
+        self._record("push", to, messages)
+
+
+def _sign(body: str) -> str:
+    mac = hmac.new(os.environ["LINE_CHANNEL_SECRET"].encode("utf-8"), body.encode("utf-8"), hashlib.sha256)
+    return base64.b64encode(mac.digest()).decode("ascii")
+
+
+def _load(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    v = sorted(values)
+    pick = lambda q: round(v[min(len(v) - 1, int(q * len(v)))], 2)
+    return {"n": len(v), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(v[-1], 2)}
+
+
+def _event_kind(body):
+    kinds = []
+    for ev in body.get("events") or []:
+        k = ev.get("type", "?")
+        if k == "postback":
+            try:
+                data = json.loads(ev["postback"]["data"])
+                k += ":" + str(data.get("type") or data.get("step"))
+            except Exception:
+                pass
+        kinds.append(k)
+    return ",".join(kinds)
+
+
+# ====== 再生 ======
+def replay(path, speed=None, drain=2.0, latency_ms=0.0):
+    stub = StubLineApi(latency_ms)
+    app.line_bot_api = stub
+    clock = None
+    client = app.app.test_client()
+
+    results = []
+    t_first = wall_first = None
+    for i, rec in enumerate(_load(path)):
+        if t_first is None:
+            t_first, wall_first = rec["t"], time.perf_counter()
+        elif speed:
+            wait = (rec["t"] - t_first) / speed - (time.perf_counter() - wall_first)
+            if wait > 0:
+                time.sleep(wait)
+        at = datetime.datetime.fromtimestamp(rec["t"], app.JST)
+        if clock is None:
+            clock = app.VirtualClock(at)
+            app.use_clock(clock)
+        clock.advance_to(at)  # 前のイベントからの間に期限の来たタイマー・ジョブ（送信は前のイベントの分として記録）
+        stub.current = i
+        body = json.dumps(rec["body"], ensure_ascii=False)
+        t0 = time.perf_counter()
+        client.post("/webhook", data=body.encode("utf-8"),
+                    headers={"X-Line-Signature": _sign(body), "Content-Type": "application/json"})
+        ms = (time.perf_counter() - t0) * 1000
+        results.append({"i": i, "kind": _event_kind(rec["body"]), "ms": round(ms, 3),
+                        "recorded_ms": rec.get("ms")})
+    if clock is not None:
+        clock.advance(drain)
+
+    out = {i: [] for i in range(len(results))}
+    with stub.lock:
+        for i, kind, dest, msgs in stub.sent:
+            out.setdefault(i, []).append({"kind": kind, "to": dest, "messages": msgs})
+    for r in results:
+        r["out"] = out.get(r["i"], [])
+    return {
+        "source": os.path.abspath(path),
+        "speed": speed or "max",
+        "latency_ms": _percentiles([r["ms"] for r in results]),
+        "outbound": {"reply": sum(1 for s in stub.sent if s[1] == "reply"),
+                     "push": sum(1 for s in stub.sent if s[1] == "push")},
+        "events": results,
+    }
+
+
+def compare(base, new, show=5):
+    """送信内容が変わったイベントと、処理時間の差"""
+    diffs = []
+    for a, b in zip(base["events"], new["events"]):
+        if a["out"] != b["out"]:
+            diffs.append((a, b))
+    print(f"events: base={len(base['events'])} new={len(new['events'])}  outbound diffs: {len(diffs)}")
+    for a, b in diffs[:show]:
+        print(f"  #{a['i']} {a['kind']}")
+        print(f"    base: {json.dumps(a['out'], ensure_ascii=False)[:300]}")
+        print(f"    new : {json.dumps(b['out'], ensure_ascii=False)[:300]}")
+    lb, ln = base["latency_ms"], new["latency_ms"]
+    for k in ("p50", "p90", "p99", "max"):
+        if k in lb and k in ln:
+            print(f"  latency {k}: {lb[k]:8.2f} ms → {ln[k]:8.2f} ms")
+    return diffs
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="記録した webhook を再生して送信内容と処理時間を比べる")
+    ap.add_argument("record", help="WEBHOOK_RECORD_PATH で記録したファイル")
+    ap.add_argument("--speed", default="1", help="再生速度（1, 10 など。max で待たずに流す）")
+    ap.add_argument("--drain", type=float, default=2.0, help="最後に時計を進める秒数（タイマー送信の分）")
+    ap.add_argument("--stub-latency-ms", type=float, default=0.0, help="LINE API 1回あたりの疑似遅延")
+    ap.add_argument("--out", help="結果を JSON で保存")
+    ap.add_argument("--compare", help="比較する前回の結果（--out のファイル）")
+    args = ap.parse_args(argv)
+
+    speed = None if args.speed == "max" else float(args.speed)
+    result = replay(args.record, speed=speed, drain=args.drain, latency_ms=args.stub_latency_ms)
+    lat = result["latency_ms"]
+    print(f"[REPLAY] {len(result['events'])} events speed={result['speed']} "
+          f"reply={result['outbound']['reply']} push={result['outbound']['push']} latency(ms)={lat}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+    sys.stdout.flush()
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
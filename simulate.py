@@ -0,0 +1,354 @@
+"""
+一晩分の予約の流れを仮想時計（app.VirtualClock）で数秒のうちに流すシミュレーション。LINE API は呼ばない。
+
+    python simulate.py                                   # 客 200 人・店 30 店・15:30〜23:30
+    python simulate.py --guests 1000 --stores 80 --seed 7 --out sim.json
+
+- 時計を仮想時計に差し替え、客の操作・店の返信・タイマー（段階送信の窓・候補のまとめ送り）・
+  ジョブ（締切通知・15分前リマインド・店舗ダイジェスト）をすべて仮想時刻の順に実行する。
+- 客は署名付きの webhook（本番と同じ handle_webhook_body）で、届いたメッセージのボタンを押して進む：
+  言語 → 時間（確率 --multi ごとに第2・第3希望を足す）→ 人数 → 送迎（ホテル名）→ 照会 → 候補カードから予約
+  → 氏名 → 電話 → 確定。
+- 店は照会を受けると、希望時間ごとに確率 --ok で空いていて、空いている時間があれば一番希望順の早い時間で OK、
+  無ければ確率 --no で不可を返し、残りは返信しない（返信までの時間は指数分布）。照会箱のカルーセルで
+  まとめて届いたときは、カードごとに同じように答える（前に見た照会には答え直さない）。
+- --dead N 店は bot をブロックした店として push が 400 で失敗する（配信の健全性による隔離を確かめる）。
+- 最後に結果の内訳・整合性チェック・処理時間を表示する（チェックが1つでも NG なら終了コード 1）。
+"""
+import argparse, base64, collections, datetime, hashlib, hmac, io, json, os, random, sys, tempfile, time
+
+# app を import する前に、本番の送信・記録・ログを無効にする
+os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "simulate"
+os.environ["LINE_CHANNEL_SECRET"] = "simulate"
+os.environ["STORES_SHEET_CSV_URL"] = ""
+os.environ["WEBHOOK_RECORD_PATH"] = ""
+os.environ["TRACE_PATH"] = ""
+os.environ.setdefault("EVENT_LOG_PATH", "")
+os.environ.setdefault("JOBS_DB_PATH", os.path.join(tempfile.mkdtemp(prefix="simulate-"), "jobs.sqlite3"))
+
+import app  # noqa: E402
+from linebot.exceptions import LineBotApiError  # noqa: E402
+from linebot.models import Error  # noqa: E402
+
+
+# ====== LINE API の代わり（宛先ごとに客・店へ渡す） ======
+class SimLineApi:
+    def __init__(self, sim):
+        self.sim = sim
+        self.count = collections.Counter()
+
+    def reply_message(self, reply_token, messages, *args, **kwargs):
+        self.count["reply"] += 1
+        self.sim.deliver(reply_token.rsplit(":", 1)[0], messages)
+
+    def push_message(self, to, messages, *args, **kwargs):
+        self.count["push"] += 1
+        if to in self.sim.dead:
+            self.count["push_dead"] += 1
+            raise LineBotApiError(400, {}, error=Error(message="simulated: user blocked the bot"))
+        self.sim.deliver(to, messages)
+
+
+def _postbacks(node, out):
+    """メッセージ JSON の中の postback ボタン（quick reply・Flex）の data を集める"""
+    if isinstance(node, dict):
+        if node.get("type") == "postback" and "data" in node:
+            try:
+                out.append(json.loads(node["data"]))
+            except ValueError:
+                pass
+        for v in node.values():
+            _postbacks(v, out)
+    elif isinstance(node, list):
+        for v in node:
+            _postbacks(v, out)
+    return out
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    v = sorted(values)
+    pick = lambda q: round(v[min(len(v) - 1, int(q * len(v)))], 3)
+    return {"n": len(v), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(v[-1], 3)}
+
+
+# ====== 客と店 ======
+class Guest:
+    """届いたボタンを押して進む客。自分の操作への返信は操作のあとに、push は届いたときに見る"""
+
+    def __init__(self, sim, uid, lang, pickup):
+        self.sim, self.uid, self.lang, self.pickup = sim, uid, lang, pickup
+        self.state = "new"
+        self.pushes = 0
+
+    def start(self):
+        self.state = "started"
+        self.sim.postback(self, {"step": "lang", "v": self.lang})
+
+    def on_reply(self, pbs):
+        rnd = self.sim.rnd
+        steps = collections.defaultdict(list)
+        for d in pbs:
+            steps[d.get("step") or d.get("type")].append(d)
+        if self.state == "name":
+            self.state = "phone"
+            self.sim.later(self, "text", f"客{self.uid[-4:]}")
+        elif self.state == "phone":
+            self.state = "review"
+            digits = "".join(rnd.choice("0123456789") for _ in range(8))
+            self.sim.later(self, "text", "090" + digits if self.lang == "jp" else "+81 90" + digits)
+        elif self.state == "review":
+            yes = [d for d in steps["book_confirm"] if d.get("v") == "yes"]
+            if yes:
+                self.state = "booked"
+                self.sim.later(self, "postback", yes[0])
+        elif self.state == "hotel":
+            self.state = "started"
+            self.sim.later(self, "text", "Hotel Simulation")
+        elif steps["time"]:
+            self.sim.later(self, "postback", rnd.choice(steps["time"]))
+        elif steps["time_more"]:
+            more = [d for d in steps["time_more"] if d.get("iso")]
+            done = [d for d in steps["time_more"] if not d.get("iso")]
+            pick = rnd.choice(more) if more and rnd.random() < self.sim.p_multi else done[0]
+            self.sim.later(self, "postback", pick)
+        elif steps["pax"]:
+            picks = [d for d in steps["pax"] if d.get("v") not in ("5plus", "5+")]
+            self.sim.later(self, "postback", rnd.choice(picks or steps["pax"]))
+        elif steps["pickup"]:
+            want = "yes" if self.pickup else "no"
+            picks = [d for d in steps["pickup"] if d.get("v") == want] or steps["pickup"]
+            if picks[0].get("v") == "yes":
+                self.state = "hotel"
+            self.sim.later(self, "postback", picks[0])
+        elif self.state == "started":
+            yes = [d for d in steps["confirm"] if d.get("v") == "yes"]
+            if yes:
+                self.state = "waiting"
+                self.sim.later(self, "postback", yes[0])
+            elif not pbs:
+                self.state = "gave_up"  # 受付時間外・選べる時間なし
+
+    def on_push(self, pbs):
+        self.pushes += 1
+        books = [d for d in pbs if d.get("type") == "book"]
+        if books and self.state == "waiting":
+            self.state = "name"
+            self.sim.later(self, "postback", self.sim.rnd.choice(books))
+
+
+class StoreBot:
+    def __init__(self, sim, store):
+        self.sim, self.store = sim, store
+        self.inquiries = 0
+        self.messages = 0
+        self.digests = 0
+        self.seen = set()
+
+    def on_push(self, pbs):
+        by_req = collections.defaultdict(list)
+        for d in pbs:
+            if d.get("type") == "store_reply":
+                by_req[d["req_id"]].append(d)
+        if not by_req:
+            self.digests += 1
+            return
+        self.messages += 1
+        for req_id, replies in by_req.items():
+            if req_id not in self.seen:
+                self.seen.add(req_id)
+                self.answer(replies)
+
+    def answer(self, replies):
+        self.inquiries += 1
+        rnd = self.sim.rnd
+        free = [d for d in replies if d.get("status") == "ok" and rnd.random() < self.sim.p_ok]
+        if free:
+            data = free[0]
+        elif rnd.random() < self.sim.p_no / max(1 - self.sim.p_ok, 1e-9):
+            data = next(d for d in replies if d.get("status") == "no")
+        else:
+            data = None
+        if data:
+            delay = rnd.expovariate(1 / self.sim.store_reply_sec)
+            app.CLOCK.call_later(delay, self.sim.send, self.store["line_user_id"], "postback", data)
+
+
+# ====== シミュレーション ======
+class Simulation:
+    def __init__(self, guests=200, stores=30, seed=1, date=None, start="15:30", end="22:30", drain="23:30",
+                 p_ok=0.35, p_no=0.35, store_reply_sec=120.0, think_sec=8.0, pickup=0.2, multi=0.5, dead=0):
+        self.rnd = random.Random(seed)
+        random.seed(seed)  # app 側の乱数（ウェーブの並びなど）も固定する
+        self.p_ok, self.p_no, self.p_multi = p_ok, p_no, multi
+        self.store_reply_sec, self.think_sec = store_reply_sec, think_sec
+        day = date or app.now_jst().date()
+        at = lambda hhmm: datetime.datetime.combine(day, datetime.time(*map(int, hhmm.split(":"))), app.JST)
+        self.t_start, self.t_end, self.t_drain = at(start), at(end), at(drain)
+
+        self.api = SimLineApi(self)
+        self.store_bots = {}
+        self.guests = {}
+        self.handle_ms = []
+        self.capture = None
+        self.n_events = 0
+        self._install_stores(stores)
+        self.dead = {f"Usimstore{i:04d}" for i in range(min(dead, stores))}
+        for i in range(guests):
+            uid = f"Usimguest{i:05d}"
+            self.guests[uid] = Guest(self, uid, self.rnd.choice(app.LOCALES), self.rnd.random() < pickup)
+        self._arrivals = sorted(
+            (self.t_start + datetime.timedelta(seconds=self.rnd.uniform(0, (self.t_end - self.t_start).total_seconds())), uid)
+            for uid in self.guests)
+
+    def _install_stores(self, n):
+        """店舗シートと同じ CSV を作って parse_store_rows で読む"""
+        buf = io.StringIO()
+        buf.write(",".join(app.STORE_FIELDS) + "\n")
+        for i in range(n):
+            buf.write(f"SIM{i:03d},シミュ店 {i},,https://maps.example/{i},{'1' if self.rnd.random() < 0.5 else '0'},"
+                      f",,Usimstore{i:04d},,\n")
+        buf.seek(0)
+        stores, _ = app.parse_store_rows(buf)
+        app.STORES = stores
+        app.STORE_BY_ID = {s["store_id"]: s for s in stores}
+        app.STORE_BY_UID = {s["line_user_id"]: s for s in stores}
+        self.store_bots = {s["line_user_id"]: StoreBot(self, s) for s in stores}
+
+    # --- 送受信
+    def deliver(self, uid, messages):
+        msgs = messages if isinstance(messages, list) else [messages]
+        pbs = _postbacks([m.as_json_dict() for m in msgs], [])
+        if self.capture is not None and self.capture[0] == uid:
+            self.capture[1].extend(pbs)
+            self.capture[2] += 1
+        elif uid in self.store_bots:
+            self.store_bots[uid].on_push(pbs)
+        elif uid in self.guests:
+            self.guests[uid].on_push(pbs)
+
+    def send(self, uid, kind, payload):
+        """1イベントの webhook を署名付きで処理する"""
+        self.n_events += 1
+        ev = {"type": "postback" if kind == "postback" else "message", "mode": "active", "timestamp": int(app.CLOCK.time() * 1000),
+              "source": {"type": "user", "userId": uid}, "replyToken": f"{uid}:{self.n_events}",
+              "webhookEventId": f"SIM{self.n_events:08d}", "deliveryContext": {"isRedelivery": False}}
+        if kind == "postback":
+            ev["postback"] = {"data": json.dumps(payload, ensure_ascii=False)}
+        else:
+            ev["message"] = {"type": "text", "id": str(self.n_events), "text": payload}
+        body = json.dumps({"destination": "simulate", "events": [ev]}, ensure_ascii=False)
+        mac = hmac.new(app.LINE_CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256)
+        guest = self.guests.get(uid)
+        self.capture = [uid, [], 0] if guest else None
+        t0 = time.perf_counter()
+        try:
+            app.handle_webhook_body(body, base64.b64encode(mac.digest()).decode("ascii"))
+        finally:
+            self.handle_ms.append((time.perf_counter() - t0) * 1000)
+            captured, self.capture = self.capture, None
+        if guest and captured[2]:
+            guest.on_reply(captured[1])
+
+    def postback(self, guest, data):
+        self.send(guest.uid, "postback", data)
+
+    def later(self, guest, kind, payload):
+        """客が読んで押すまでの間をおいて送る"""
+        app.CLOCK.call_later(self.rnd.expovariate(1 / self.think_sec), self.send, guest.uid, kind, payload)
+
+    # --- 実行
+    def run(self):
+        clock = app.VirtualClock(self.t_start)
+        prev_api, prev_clock = app.line_bot_api, app.use_clock(clock)
+        app.line_bot_api = self.api
+        t0 = time.perf_counter()
+        try:
+            for at, uid in self._arrivals:
+                clock.advance_to(at)
+                self.guests[uid].start()
+            clock.advance_to(self.t_drain)
+        finally:
+            wall = time.perf_counter() - t0
+            app.line_bot_api = prev_api
+            app.use_clock(prev_clock)
+        return self.report(clock, wall)
+
+    def report(self, clock, wall):
+        mine = {rid: r for rid, r in app.REQUESTS.items() if r["user_id"] in self.guests}
+        with app._jobs_db() as conn:
+            jobs = collections.Counter(f"{r['kind']}:{r['status']}" for r in conn.execute("SELECT kind, status FROM jobs"))
+            left = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending','running') AND due_at <= ?",
+                                (self.t_drain.timestamp(),)).fetchone()[0]
+        confirmed = [r for r in mine.values() if r.get("confirmed")]
+        slots = {(r["store_id"], r["wanted_iso"]) for r in confirmed}
+        states = collections.Counter(g.state for g in self.guests.values())
+        simulated = (self.t_drain - self.t_start).total_seconds()
+        checks = {
+            "no pending jobs or timers after drain": left == 0 and clock.pending_timers() == 0,
+            "every booked guest got a confirmed request": states["booked"] == len(confirmed),
+            "one reminder per confirmed booking": jobs["reminder:done"] == len(confirmed),
+            "no job failed": not any(k.endswith(":failed") for k in jobs),
+            "at most one store digest per store and slot": jobs["store_digest:done"] <= len(slots),
+            "booked time is one of the guest's wanted times": all(r["wanted_iso"] in r["slots"] for r in confirmed),
+            "pushes to dead stores stop at quarantine (then probes only)": self.api.count["push_dead"] <= len(self.dead) * (
+                app.DELIVERY_QUARANTINE_AFTER + int(simulated // app.DELIVERY_PROBE_SEC) + 1),
+        }
+        return {
+            "guests": len(self.guests), "stores": len(self.store_bots),
+            "simulated_sec": simulated, "wall_sec": round(wall, 3), "speedup": round(simulated / max(wall, 1e-9)),
+            "webhook_events": self.n_events, "handle_ms": _percentiles(self.handle_ms),
+            "outbound": dict(self.api.count), "clock": dict(clock.fired),
+            "guest_states": dict(states), "requests": len(mine), "confirmed": len(confirmed),
+            "store_inquiries": sum(b.inquiries for b in self.store_bots.values()),
+            "store_inquiry_messages": sum(b.messages for b in self.store_bots.values()),
+            "multi_slot_requests": sum(len(r["slots"]) > 1 for r in mine.values()),
+            "pushes_per_booking": round(self.api.count["push"] / max(len(confirmed), 1), 2),
+            "quarantined": sorted(app.STORE_BY_UID[uid]["store_id"] for uid, h in app.DELIVERY.items() if h["quarantined"]),
+            "jobs": dict(sorted(jobs.items())), "checks": checks,
+        }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="仮想時計で一晩分の予約を流して結果と処理時間を見る")
+    ap.add_argument("--guests", type=int, default=200)
+    ap.add_argument("--stores", type=int, default=30)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--date", type=datetime.date.fromisoformat, help="日付（既定は今日）")
+    ap.add_argument("--start", default="15:30", help="最初の客が来る時刻")
+    ap.add_argument("--end", default="22:30", help="最後の客が来る時刻")
+    ap.add_argument("--drain", default="23:30", help="この時刻まで時計を進めてから集計")
+    ap.add_argument("--ok", type=float, default=0.35, help="店が OK を返す確率")
+    ap.add_argument("--no", type=float, default=0.35, help="店が不可を返す確率（残りは返信なし）")
+    ap.add_argument("--store-reply-sec", type=float, default=120.0, help="店の返信までの平均秒数")
+    ap.add_argument("--multi", type=float, default=0.5, help="客が第2・第3希望の時間を足す確率（0 で第1希望だけ）")
+    ap.add_argument("--dead", type=int, default=0, help="bot をブロックした（push が失敗する）店の数")
+    ap.add_argument("--out", help="結果を JSON で保存")
+    args = ap.parse_args(argv)
+
+    app.wait_stores_ready()
+    sim = Simulation(args.guests, args.stores, args.seed, args.date, args.start, args.end, args.drain,
+                     p_ok=args.ok, p_no=args.no, store_reply_sec=args.store_reply_sec, multi=args.multi,
+                     dead=args.dead)
+    result = sim.run()
+    print(f"[SIM] {result['guests']} guests / {result['stores']} stores: "
+          f"{result['simulated_sec'] / 3600:.1f}h simulated in {result['wall_sec']}s (x{result['speedup']})")
+    print(f"[SIM] events={result['webhook_events']} handle(ms)={result['handle_ms']} outbound={result['outbound']}")
+    print(f"[SIM] requests={result['requests']} (multi-slot {result['multi_slot_requests']}) "
+          f"confirmed={result['confirmed']} guests={result['guest_states']}")
+    print(f"[SIM] store_inquiries={result['store_inquiries']} (in {result['store_inquiry_messages']} messages) "
+          f"pushes_per_booking={result['pushes_per_booking']} "
+          f"quarantined={result['quarantined']}")
+    print(f"[SIM] jobs={result['jobs']}")
+    for name, ok in result["checks"].items():
+        print(f"[SIM] {'OK' if ok else 'NG'}  {name}")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, default=str)
+    sys.stdout.flush()
+    os._exit(0 if all(result["checks"].values()) else 1)
+
+
+if __name__ == "__main__":
+    main()
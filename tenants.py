@@ -0,0 +1,155 @@
+"""
+複数テナント（島・LINE チャネルごと）を1プロセスで動かす WSGI エントリ。
+
+    TENANTS_FILE=tenants.json gunicorn tenants:application
+
+    /webhook/<tenant>      … そのテナントの /webhook（LINE 側の Webhook URL にテナント名を付ける）
+    /t/<tenant>/admin/...  … そのテナントの管理 API（/t/<tenant>/readyz なども同じ）
+    /readyz                … 全テナントのウォームアップが済んだら 200
+
+tenants.json（TENANTS_JSON に直接書いてもよい）はテナント名 → 環境変数の上書き:
+
+    {
+      "ishigaki": {"LINE_CHANNEL_ACCESS_TOKEN": "env:ISHIGAKI_TOKEN",
+                   "LINE_CHANNEL_SECRET": "env:ISHIGAKI_SECRET",
+                   "STORES_SHEET_CSV_URL": "https://...", "SERVICE_CLOSE_HOUR": 23},
+      "miyako":   {...}
+    }
+
+"env:NAME" は環境変数 NAME の値に置き換える（秘密をファイルに書かないため）。
+書いていない設定は共通の環境変数を使う。ただしファイルに書き出すもの
+（JOBS_DB_PATH / EVENT_LOG_PATH / TRACE_PATH / WEBHOOK_RECORD_PATH）は、
+共通の値にテナント名を付けたパス（events.log → events-ishigaki.log）にしてテナント間で混ざらないようにする。
+
+テナントごとに app.py を別モジュール（app_tenant_<name>）として読み込むので、店舗一覧・
+セッション・照会・キャッシュなどの状態はテナントごとに分かれる。LINE API への HTTP 接続プールと
+ジョブのポーリングスレッドは全テナントで1つを共有する。
+"""
+import importlib.util, json, os, re, sys, threading, time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+# テナントごとに分けるファイル（app.py の既定値）
+PER_TENANT_PATHS = {"JOBS_DB_PATH": "jobs.sqlite3", "EVENT_LOG_PATH": "events.log",
+                    "TRACE_PATH": "", "WEBHOOK_RECORD_PATH": ""}
+JOBS_POLL_SEC = float(os.getenv("JOBS_POLL_SEC", "1"))
+_NAME_OK = re.compile(r"^[a-z0-9_-]+$")
+
+SHARED = {
+    "job_pollers": {},   # テナント名 → poll_jobs（http_session は最初のテナントが作る）
+}
+TENANTS = {}             # テナント名 → app.py モジュール
+_RUNNER = {"pid": None}
+_RUNNER_LOCK = threading.Lock()
+
+
+# ====== 設定 ======
+def load_tenant_config():
+    raw = os.getenv("TENANTS_JSON")
+    if not raw:
+        with open(os.getenv("TENANTS_FILE", "tenants.json"), encoding="utf-8") as f:
+            raw = f.read()
+    conf = json.loads(raw)
+    for name in conf:
+        if not _NAME_OK.match(name):
+            raise RuntimeError(f"bad tenant name: {name!r}（英小文字・数字・-_ のみ）")
+    return conf
+
+
+def _resolve(value):
+    if isinstance(value, str) and value.startswith("env:"):
+        return os.getenv(value[4:])
+    return value
+
+
+def tenant_env(name, overrides):
+    env = {k: _resolve(v) for k, v in overrides.items()}
+    for key, default in PER_TENANT_PATHS.items():
+        if key in env:
+            continue
+        base = os.getenv(key, default)
+        if base:
+            root, ext = os.path.splitext(base)
+            env[key] = f"{root}-{name}{ext}"
+    return env
+
+
+def load_tenant(name, overrides):
+    """app.py をテナント専用のモジュールとして読み込む（実行前に TENANT などを差し込む）"""
+    mod_name = f"app_tenant_{name.replace('-', '_')}"
+    spec = importlib.util.spec_from_file_location(mod_name, APP_PATH)
+    mod = importlib.util.module_from_spec(spec)
+    mod.TENANT = name
+    mod.TENANT_CONFIG = tenant_env(name, overrides)
+    mod.SHARED = SHARED
+    sys.modules[mod_name] = mod
+    try:
+        spec.loader.exec_module(mod)
+    except Exception:
+        sys.modules.pop(mod_name, None)
+        raise
+    print(f"[TENANT] loaded {name} stores={len(mod.STORES)}")
+    return mod
+
+
+# ====== ジョブ（全テナントを1本のスレッドで回す） ======
+def _job_loop():
+    while True:
+        for name, poll in list(SHARED["job_pollers"].items()):
+            try:
+                poll()
+            except Exception as e:
+                print(f"[JOBS] {name} poll failed:", e)
+        time.sleep(JOBS_POLL_SEC)
+
+
+def ensure_shared_runner():
+    """fork 後の子でも1回だけ起動する（テナント側の ensure_job_runner は登録だけ）"""
+    if _RUNNER["pid"] == os.getpid():
+        return
+    with _RUNNER_LOCK:
+        if _RUNNER["pid"] == os.getpid():
+            return
+        for mod in TENANTS.values():
+            mod.ensure_job_runner()
+        threading.Thread(target=_job_loop, name="job-runner-shared", daemon=True).start()
+        _RUNNER["pid"] = os.getpid()
+        print(f"[JOBS] shared runner started tenants={sorted(SHARED['job_pollers'])}")
+
+
+# ====== WSGI ======
+def _respond(start_response, status, body):
+    data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+    start_response(status, [("Content-Type", "application/json; charset=utf-8"), ("Content-Length", str(len(data)))])
+    return [data]
+
+
+def readyz(start_response):
+    tenants = {name: {"ready": mod.WARMUP["done"], "stores": len(mod.STORES)} for name, mod in TENANTS.items()}
+    ok = all(t["ready"] for t in tenants.values())
+    return _respond(start_response, "200 OK" if ok else "503 Service Unavailable", {"ready": ok, "tenants": tenants})
+
+
+def application(environ, start_response):
+    ensure_shared_runner()
+    path = environ.get("PATH_INFO", "")
+    parts = path.strip("/").split("/", 2)
+    if path.rstrip("/") == "/readyz":
+        return readyz(start_response)
+    if len(parts) >= 2 and parts[0] == "webhook":
+        name, sub, prefix = parts[1], "/webhook", ""
+    elif len(parts) >= 2 and parts[0] == "t":
+        name, sub, prefix = parts[1], "/" + (parts[2] if len(parts) > 2 else ""), f"/t/{parts[1]}"
+    else:
+        return _respond(start_response, "404 Not Found", {"error": "use /webhook/<tenant> or /t/<tenant>/..."})
+    mod = TENANTS.get(name)
+    if mod is None:
+        print(f"[TENANT] unknown tenant: {name}")
+        return _respond(start_response, "404 Not Found", {"error": f"unknown tenant: {name}"})
+    environ = dict(environ, PATH_INFO=sub, SCRIPT_NAME=environ.get("SCRIPT_NAME", "") + prefix)
+    return mod.app.wsgi_app(environ, start_response)
+
+
+for _name, _overrides in load_tenant_config().items():
+    TENANTS[_name] = load_tenant(_name, _overrides)
+
+ensure_shared_runner()